@@ -1,17 +1,45 @@
 import os
+import io
+import sys
+import base64
+import errno
+import argparse
+import json
+import time
+import functools
+import contextlib
+import random
+import hashlib
+import sqlite3
+import shutil
+import tempfile
+import tracemalloc
+import ctypes
+import select
+import struct
+import tarfile
+import zipfile
+import threading
+import heapq
+import csv
+import warnings
+import multiprocessing
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-import pydicom
-from pydicom.uid import UID
-from PIL import Image
-import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import logging
-from datetime import datetime
+from datetime import date, datetime
 # from pydicom.config import enforce_valid_values
 
-# 强制使用 pylibjpeg 解码器
+# pydicom、numpy、PIL 导入耗时较长（-X importtime 约 0.3s，打包为 exe 后更久），
+# 均在函数内按需导入，窗口显示后再在后台预热，避免拖慢启动
+
+# 不再全局强制使用 pylibjpeg 解码器：按传输语法使用标定得到的最快解码器顺序，失败时依次回退
 # enforce_valid_values()
-# pydicom.config.pixel_data_handlers.util.reset_pixel_data_handler("pylibjpeg")
+
+# 程序启动时刻，用于记录窗口显示耗时
+startup_time = time.perf_counter()
 
 # 初始化全局变量
 input_folder = None
@@ -20,10 +48,150 @@ dicom_output_folder = None
 log_folder = None
 structured_info_folder = None  # 结构化信息输出目录
 
-# 创建主窗口
-root = tk.Tk()
-root.title("DICOM 工具")
-convert_to_grayscale = tk.BooleanVar(value=True)  # 默认勾选灰度转换
+# 预读配置：输入目录通常是 SMB/NFS 挂载，单文件延迟远大于带宽开销
+PREFETCH_DEPTH = 16  # 提前读取的文件数
+PREFETCH_WORKERS = 4  # 预读线程数
+
+# 压缩包输入/输出：支持直接读取 ZIP/TAR 中的 DICOM，并可按检查输出为压缩包
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz")
+OUTPUT_FORMATS = {"目录": None, "ZIP": "zip", "TAR": "tar", "TAR.GZ": "tar.gz"}
+ARCHIVE_MAX_OPEN = 32  # 同时打开的输出压缩包数，超出时完成最久未写入的（受文件描述符数限制）
+archive_index = {}  # 压缩包成员虚拟路径 -> (压缩包路径, 成员名)
+
+# DICOMDIR：发现阶段从 DICOMDIR 记录得到的检查/序列信息，分组时无需再解析文件
+MEDIA_STORAGE_DIRECTORY_STORAGE = "1.2.840.10008.1.3.10"
+EXPLICIT_VR_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+DICOMDIR_HINT_KEYWORDS = ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "Modality")
+source_hints = {}  # 文件路径 -> {关键字: 值}
+
+# 运行状态库：去重等需要在并行进程和多次运行之间共享的状态
+# 路径可用 --state-db 指定（经环境变量传给工作进程）；各分片必须共用同一个库，日期偏移和 UID/审计密钥才一致
+STATE_DB_ENV = "DICOM_TOOL_STATE_DB"
+STATE_DB_FILE = os.environ.get(STATE_DB_ENV, "dicom_tool_state.sqlite")
+DEDUP_MODES = {"不去重": None, "跳过重复": "skip", "硬链接重复": "link"}
+
+# 输出传输语法策略：保持原样时不解码像素，封装像素数据按字节原样写出
+TRANSFER_SYNTAX_POLICIES = {
+    "保持原样": "preserve",
+    "解压为显式小端": "explicit",
+    "RLE 无损压缩": "rle",
+    "Deflate 压缩": "deflate",
+}
+
+# 日期偏移：每个患者一个随机但固定的天数偏移，保存在运行状态库中
+DATE_SHIFT_MAX_DAYS = 365  # 偏移范围 [-365, 365]，不含 0
+DATE_VRS = ("DA", "DT", "TM")
+# 偏移代替置空的日期只限检查时间线上的字段；出生日期等患者级日期仍按规则置空
+DATE_SHIFT_KEYWORD_PREFIXES = ("Study", "Series", "Acquisition", "Content")
+
+# PHI 验证：匿名化时收集原始标识（需显式开启），之后扫描输出中的字符串值是否仍包含这些标识
+# 原始标识按输出目录保存在单独的标识库中（不在运行状态库中），该文件应与原始数据同等保护
+PHI_IDENTIFIER_DB_FILE = "dicom_tool_phi_identifiers.sqlite"
+PHI_IDENTIFIER_KEYWORDS = ("PatientName", "PatientID", "OtherPatientIDs", "OtherPatientNames",
+                           "PatientBirthName", "PatientMotherBirthName", "AccessionNumber")
+PHI_MIN_PATTERN_LENGTH = 4  # ASCII 标识的最短长度，更短的容易误报（非 ASCII 如中文姓名至少 2 个字符）
+PHI_SCAN_VRS = ("AE", "AS", "CS", "LO", "LT", "PN", "SH", "ST", "UC", "UR", "UT", "UN")
+PHI_SCAN_BATCH = 256  # 每个验证任务扫描的文件数
+PHI_REPORT_FILE = "phi_verification_report.csv"
+
+# UID 替换：规则置空的 UID 改为由原 UID 确定性生成的新 UID（带密钥，密钥保存在运行状态库中），
+# 同一原 UID 在各次运行、各分片和各工作进程中得到同一新 UID，检查/序列结构保持不变且可以 C-STORE 转发
+UID_CACHE_SIZE = 65536
+
+# 修改审计：匿名化时就地记录每个文件被修改的标签（标签、动作、旧值哈希、新值），无需事后比对输入输出
+AUDIT_HASH_BYTES = 8  # 旧值哈希长度；哈希带密钥（保存在运行状态库中），不能由哈希穷举原值
+AUDIT_BATCH_FILES = 256  # 每批写入审计表的文件数
+
+# C-STORE 接收端（pynetdicom 为可选依赖，仅在命令行 scp 模式下导入）
+SCP_DEFAULT_AE_TITLE = "DICOMUTILS"
+SCP_DEFAULT_PORT = 11112
+SCP_MAX_ASSOCIATIONS = 10
+
+# 本地 HTTP 匿名化服务：POST DICOM 文件或 ZIP，返回匿名化结果
+SERVICE_DEFAULT_HOST = "127.0.0.1"
+SERVICE_DEFAULT_PORT = 8104
+SERVICE_MAX_CONCURRENT = 8  # 同时处理的请求数，超出的请求排队等待
+SERVICE_QUEUE_TIMEOUT = 10  # 排队超过该秒数返回 503
+SERVICE_MAX_BODY = 1 << 30  # 请求体上限（字节）
+SERVICE_TEMPLATE_CACHE = 1024  # 工作进程中缓存的序列模板数，超出后清空
+SERVICE_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# C-STORE 转发：输出经长连接关联发送到远端 SCP
+FORWARD_AE_TITLE = "DICOMUTILS"
+FORWARD_CONNECTIONS = 4  # 并发关联数
+FORWARD_RETRIES = 3
+FORWARD_BACKOFF = 0.5  # 首次重试前等待秒数，之后按指数增长
+FORWARD_MAX_CONTEXTS = 128  # 一个关联最多可请求的表示上下文数
+FORWARD_WARNING_STATUSES = (0xB000, 0xB006, 0xB007)  # 警告状态视为已存储
+
+# 监视文件夹：新文件按检查防抖，检查静默一段时间后才处理
+WATCH_QUIET_PERIOD = 30.0  # 检查最后一个文件到达后等待的秒数
+WATCH_POLL_INTERVAL = 5.0  # 无 inotify 时的轮询间隔
+WATCH_IDLE_WAKEUP = 60.0  # 空闲时最长阻塞时间
+WATCH_DONE_STATUSES = ("written", "skipped", "duplicate")  # 登记为已处理的文件状态，其余登记为失败，文件变化后重试
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x00000008, 0x00000080, 0x00000100
+IN_Q_OVERFLOW, IN_ISDIR = 0x00004000, 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# 按序列调度：同一序列的文件成批交给一个工作进程，批大小受限以控制内存
+SERIES_BATCH_MAX_FILES = 32
+SERIES_BATCH_MAX_BYTES = 32 * 1024 * 1024
+
+# 结构化信息：大值按长度摘要，不解析其内容
+STRUCTURED_INFO_BULK_VRS = ("OB", "OW", "OF", "OD", "OL", "OV", "UN", "OB or OW", "US or OW", "US or SS or OW")
+STRUCTURED_INFO_MAX_BYTES = 256  # 二进制/私有值超过该长度时只输出长度
+STRUCTURED_INFO_MAX_TEXT = 1024  # 文本值超过该长度时截断
+STRUCTURED_INFO_NAME_WIDTH = 35
+STRUCTURED_INFO_TEXT_VRS = ("AE", "AS", "CS", "DA", "DS", "DT", "IS", "LO", "LT", "PN", "SH", "ST", "TM", "UC",
+                            "UI", "UR", "UT")
+STRUCTURED_INFO_SINGLE_TEXT_VRS = ("LT", "ST", "UR", "UT")  # 不按反斜杠分多值
+STRUCTURED_INFO_NUMBER_FORMATS = {"US": "H", "SS": "h", "UL": "L", "SL": "l", "FL": "f", "FD": "d"}
+STRUCTURED_INFO_BUFFER = 1 << 20
+
+# PNG 导出时顺带计算的像素质控统计
+PIXEL_QC_TABLE = "pixel_qc.csv"
+PIXEL_QC_HU_EDGES = (-1024, -500, -100, 0, 100, 300, 1000, 3000)  # HU 直方图分箱边界，两端另设溢出箱
+# PNG 导出的任务监督：单个文件超时则结束并重启工作进程，瞬时 I/O 错误重试，最终失败的文件记入隔离清单
+TASK_TIMEOUT = 120  # 单个文件的处理时限（秒）
+TASK_RETRIES = 2  # 瞬时 I/O 错误的重试次数
+TASK_RETRY_BACKOFF = 0.5  # 首次重试前等待的秒数，之后每次加倍
+TRANSIENT_IO_ERRNOS = {getattr(errno, name) for name in ("EIO", "EAGAIN", "EBUSY", "EINTR", "ETIMEDOUT", "ECONNRESET",
+                                                          "ECONNABORTED", "ESTALE") if hasattr(errno, name)}
+QUARANTINE_TABLE = "quarantine.csv"
+# 序列拼图：每个序列一张拼图，切片直接降采样写入预分配画布的对应格位
+MOSAIC_COLUMNS = 8
+MOSAIC_TILE_SIZE = 128  # 每个格位的边长（像素）
+MOSAIC_HEADER_TAGS = ["SeriesInstanceUID", "InstanceNumber", "NumberOfFrames"]
+# 电影（多帧）导出：逐帧解码并流式写入动画 WebP/GIF
+CINE_FORMATS = ("webp", "gif")
+CINE_DEFAULT_FRAME_TIME = 40.0  # 头中没有帧时间时每帧的显示时长（毫秒）
+CINE_WEBP_QUALITY = 80
+# 试运行：按 (传输语法, 文件大小量级) 分层抽样，在样本上运行处理流程并外推总耗时、输出大小和峰值内存
+PLAN_PIPELINES = ("anonymize", "png")
+PLAN_SAMPLE_FRACTION = 0.01
+PLAN_MAX_SAMPLES = 500
+
+# 分片：按 StudyInstanceUID（或顶层目录）哈希将输入确定性地分给 N 个进程，整检查不拆分
+SHARD_MODES = ("study", "path")
+SHARD_DIR_NAME = ".shards"  # 分片清单和目录保存在输出目录下
+SHARD_LOG_NAME = "dicom_tool.shard-{index}-of-{count}.log"
+MERGED_LOG_NAME = "dicom_tool.merged.log"  # merge 每次重新生成，重复合并不会产生重复记录
+SHARD_MANIFEST_COLUMNS = ("源文件", "状态", "输出")
+
+# 输出写入：先写临时文件再重命名；可靠模式下按目录批量 fsync
+FSYNC_BATCH_SIZE = 64  # 可靠模式下每个目录累积多少个文件后统一 fsync
+
+# 匿名化/转码在工作进程中执行，主进程负责读取与写出
+WORKER_COUNT = max(1, (os.cpu_count() or 2) - 1)
+
+# 工具配置文件（像素遮盖规则等）
+CONFIG_FILE = "dicom_tool_config.json"
+# 像素遮盖规则按以下字段匹配，规则中未给出的字段视为任意值
+PIXEL_MASK_MATCH_KEYS = ("Modality", "Manufacturer", "Rows", "Columns")
+
+# 解码器标定：每种传输语法取若干样本文件计时
+CALIBRATION_SAMPLES_PER_SYNTAX = 3
+CALIBRATION_PROBE_FILES = 50  # 最多探测多少个文件以发现未标定的传输语法
 
 # 默认的 DICOM 标签修改规则
 default_tags_to_modify = {
@@ -72,10 +240,34 @@ default_tags_to_modify = {
 tags_to_modify = default_tags_to_modify.copy()
 
 
+# 读取或初始化工具配置
+def load_config():
+    try:
+        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# 保存工具配置
+def save_config(config):
+    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+# 加载工具配置
+# pixel_mask_rules 示例：
+# [{"Modality": "US", "Manufacturer": "GE", "Rows": 600, "Columns": 800, "regions": [[0, 0, 800, 60]]}]
+# regions 中每项为 [x0, y0, x1, y1]（列、行坐标，不含终点）
+app_config = load_config()
+# 各传输语法的解码器顺序（由 calibrate_pixel_handlers 生成并缓存在配置中）
+pixel_decoder_order = app_config.get("decoder_order", {})
+
+
 # 配置日志记录
-def setup_logging(log_path):
+def setup_logging(log_path, log_name="dicom_tool.log"):
     global log_file
-    log_file = os.path.join(log_path, "dicom_tool.log")
+    log_file = os.path.join(log_path, log_name)
     if not os.path.exists(log_path):
         os.makedirs(log_path)
 
@@ -109,6 +301,15 @@ def select_input_folder():
     logging.info(f"选择了输入文件夹: {input_folder}")
 
 
+def select_input_archive():
+    """选择输入压缩包（ZIP/TAR），直接读取其中的 DICOM 文件"""
+    global input_folder
+    input_folder = filedialog.askopenfilename(
+        filetypes=[("压缩包", "*.zip *.tar *.tar.gz *.tgz"), ("所有文件", "*.*")])
+    input_label.config(text=f"输入文件夹: {input_folder}")
+    logging.info(f"选择了输入压缩包: {input_folder}")
+
+
 def select_dicom_output_folder():
     """选择修改后的 DICOM 文件输出文件夹"""
     global dicom_output_folder
@@ -177,254 +378,4240 @@ def remove_tag_to_modify():
         logging.info(f"移除了标签修改规则: {tag_name}")
 
 
-def update_progress(current, total, progress_label):
-    """更新进度信息"""
-    progress = int((current / total) * 100)
-    progress_label.config(text=f"处理进度: {progress}% 完成")
-    progress_label.update()
+def is_archive(path):
+    """判断路径是否为支持的压缩包"""
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
 
 
-def modify_dicom_tags():
-    """修改 DICOM 标签"""
-    if not input_folder or not dicom_output_folder:
-        messagebox.showwarning("警告", "请先选择输入文件夹和 DICOM 输出文件夹！")
-        logging.warning("未选择输入文件夹或 DICOM 输出文件夹。")
-        return
+def is_dicom_candidate(name):
+    """遍历目录时作为输入的文件：.dcm 文件或支持的压缩包（DICOMDIR 单独处理）"""
+    return name.endswith(".dcm") or is_archive(name)
 
-    logging.info("DICOM 文件匿名化处理开始。")
-    start_time = datetime.now()
 
-    # 获取所有 DICOM 文件
+def archive_stem(path):
+    """去掉压缩包后缀后的路径"""
+    lower = path.lower()
+    for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+        if lower.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def archive_member_parts(name):
+    """将包内成员名拆分为路径片段，去掉 "./" 等空片段"""
+    return [part for part in name.split("/") if part not in ("", ".")]
+
+
+def list_archive_members(archive_path):
+    """列出压缩包中的 DICOM 成员，返回虚拟路径列表（保持包内顺序）"""
+    if archive_path.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as zf:
+            names = [info.filename for info in zf.infolist() if not info.is_dir()]
+    else:
+        # 以流方式遍历，.tar.gz 只解压一遍
+        with tarfile.open(archive_path, "r|*") as tf:
+            names = [member.name for member in tf if member.isfile()]
+    file_paths = []
+    for name in names:
+        if name.lower().endswith(".dcm"):
+            file_path = os.path.join(archive_path, *archive_member_parts(name))
+            archive_index[file_path] = (archive_path, name)
+            file_paths.append(file_path)
+    return file_paths
+
+
+def list_dicomdir_instances(dicomdir_path):
+    """读取 DICOMDIR 中登记的所有实例，记录各实例的检查/序列信息，返回文件路径列表"""
+    import pydicom
+    from pydicom.fileset import FileSet
+
+    file_set = FileSet(pydicom.dcmread(dicomdir_path))
+    file_paths = []
+    for instance in file_set:
+        file_path = os.path.normpath(instance.path)
+        hints = {}
+        for keyword in DICOMDIR_HINT_KEYWORDS:
+            try:
+                hints[keyword] = str(instance[keyword].value)
+            except KeyError:
+                pass
+        source_hints[file_path] = hints
+        file_paths.append(file_path)
+    return file_paths
+
+
+def collect_dicom_files(folder):
+    """获取所有 DICOM 文件，按目录局部性排序（同一目录的文件连续、目录按名称顺序）
+
+    folder 可以是目录或 ZIP/TAR 压缩包；目录中遇到的压缩包会展开为其中的成员。
+    目录中存在 DICOMDIR 时直接使用其登记的实例，不再遍历该目录树
+    （DICOMDIR 引用的文件通常没有 .dcm 后缀）。
+    """
+    if os.path.isfile(folder) and is_archive(folder):
+        return list_archive_members(folder)
     all_files = []
-    for _root, _, files in os.walk(input_folder):
-        for file in files:
-            if file.endswith(".dcm"):
+    for _root, dirs, files in os.walk(folder):
+        if "DICOMDIR" in files:
+            dicomdir_path = os.path.join(_root, "DICOMDIR")
+            try:
+                instances = list_dicomdir_instances(dicomdir_path)
+                logging.info(f"使用 {dicomdir_path} 登记的 {len(instances)} 个实例。")
+                all_files.extend(sorted(instances))
+                dirs[:] = []
+                continue
+            except Exception as e:
+                logging.warning(f"读取 {dicomdir_path} 失败，改为遍历目录: {e}")
+        dirs.sort()
+        for file in sorted(files):
+            if not is_dicom_candidate(file):
+                continue
+            if not is_archive(file):
                 all_files.append(os.path.join(_root, file))
+            else:
+                try:
+                    all_files.extend(list_archive_members(os.path.join(_root, file)))
+                except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+                    logging.error(f"读取压缩包 {os.path.join(_root, file)} 时出错: {e}")
+    return all_files
 
-    total_files = len(all_files)
-    logging.info(f"总共找到 {total_files} 个 DICOM 文件。")
 
-    # 创建进度窗口
-    progress_window = tk.Toplevel(root)
-    progress_window.title("处理进度")
-    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
-    progress_label.pack(pady=20)
+def get_source_hint(file_path, keyword):
+    """返回发现阶段记录的元数据（如来自 DICOMDIR），没有时返回 None"""
+    return source_hints.get(file_path, {}).get(keyword)
+
+
+@functools.lru_cache(maxsize=16)
+def input_base(input_root):
+    """相对路径的基准目录：输入为压缩包文件时为其所在目录（每个输入只判断一次）"""
+    if os.path.isfile(input_root) and is_archive(input_root):
+        return os.path.dirname(input_root)
+    return input_root
+
+
+def relative_source_path(file_path, input_root):
+    """文件相对于输入根的路径；压缩包成员以“压缩包名（去后缀）/包内路径”表示"""
+    input_root = input_base(input_root)
+    if file_path in archive_index:
+        archive_path, name = archive_index[file_path]
+        return os.path.join(os.path.relpath(archive_stem(archive_path), input_root), *archive_member_parts(name))
+    return os.path.relpath(file_path, input_root)
+
+
+class ArchiveReader:
+    """压缩包成员读取器，供多个预读线程共享
+
+    ZIP 支持多线程随机读取；TAR（尤其 .tar.gz）只能顺序解压，因此按包内顺序
+    流式读取，先到的成员暂存，直到被请求为止。由于 collect_dicom_files 按包内
+    顺序列出成员、预读按顺序请求，暂存量不超过预读深度。wanted 为 {(压缩包路径, 成员名)} 时
+    只暂存其中的成员，其余直接跳过（只读取部分成员时使用，如试运行抽样）。
+    """
+
+    def __init__(self, wanted=None):
+        self._lock = threading.Lock()
+        self._zips = {}
+        self._tars = {}
+        self.wanted = wanted
+
+    def read(self, archive_path, name):
+        if archive_path.lower().endswith(".zip"):
+            with self._lock:
+                zf = self._zips.get(archive_path)
+                if zf is None:
+                    zf = self._zips[archive_path] = zipfile.ZipFile(archive_path)
+            return zf.read(name)
+        with self._lock:
+            state = self._tars.get(archive_path)
+            if state is None:
+                tf = tarfile.open(archive_path, "r|*")
+                state = self._tars[archive_path] = (tf, iter(tf), {})
+            tf, members, stash = state
+            while name not in stash:
+                member = next(members, None)
+                if member is None:
+                    raise FileNotFoundError(f"{archive_path} 中不存在 {name}")
+                if member.isfile() and member.name.lower().endswith(".dcm") \
+                        and (self.wanted is None or (archive_path, member.name) in self.wanted):
+                    stash[member.name] = tf.extractfile(member).read()
+            return stash.pop(name)
+
+    def close(self):
+        with self._lock:
+            for zf in self._zips.values():
+                zf.close()
+            for tf, _, _ in self._tars.values():
+                tf.close()
+            self._zips.clear()
+            self._tars.clear()
+
+
+def read_file_bytes(file_path, opener=open, archive_reader=None):
+    """一次性读取文件全部内容；压缩包成员直接从包内读取，不解压到磁盘"""
+    if file_path in archive_index:
+        archive_path, name = archive_index[file_path]
+        return archive_reader.read(archive_path, name)
+    with opener(file_path, "rb") as f:
+        return f.read()
+
+
+def prefetch_files(file_paths, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS, opener=open):
+    """预读后续 depth 个文件的内容，按原顺序产出 (路径, Future)
+
+    读取在线程池中进行，与调用方的解析/写出重叠；调用方通过 future.result()
+    取得 bytes，读取失败时在该处抛出原异常，因此可以沿用逐文件的 try/except。
+    """
+    file_iter = iter(file_paths)
+    pending = deque()
+    archive_reader = ArchiveReader()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+    try:
+        for file_path in file_iter:
+            pending.append((file_path, executor.submit(read_file_bytes, file_path, opener, archive_reader)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            file_path, future = pending.popleft()
+            next_path = next(file_iter, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(read_file_bytes, next_path, opener, archive_reader)))
+            yield file_path, future
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        archive_reader.close()
+
+
+class LatencyOpener:
+    """为每次打开文件注入固定延迟的文件打开器，用于在本地模拟网络挂载盘"""
+
+    def __init__(self, latency=0.02):
+        self.latency = latency
+
+    def __call__(self, file_path, mode="rb"):
+        time.sleep(self.latency)
+        return open(file_path, mode)
+
+
+def benchmark_prefetch(folder, latency=0.02, depth=PREFETCH_DEPTH, workers=PREFETCH_WORKERS):
+    """对比顺序读取与预读在注入延迟下的吞吐量，返回 (顺序 MB/s, 预读 MB/s)"""
+    all_files = collect_dicom_files(folder)
+    opener = LatencyOpener(latency)
+    results = []
+    for mode_depth, mode_workers in ((1, 1), (depth, workers)):
+        start = time.perf_counter()
+        total_bytes = 0
+        for _, future in prefetch_files(all_files, mode_depth, mode_workers, opener):
+            total_bytes += len(future.result())
+        elapsed = time.perf_counter() - start
+        results.append(total_bytes / 1024 / 1024 / elapsed if elapsed else 0.0)
+        logging.info(f"预读深度 {mode_depth}, 线程 {mode_workers}: {len(all_files)} 个文件, "
+                     f"{total_bytes} 字节, 耗时 {elapsed:.2f}s, {results[-1]:.1f} MB/s")
+    return tuple(results)
+
+
+def dataset_to_bytes(ds):
+    """将数据集序列化为 DICOM 文件内容（内存中完成，不产生临时文件）"""
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    return buffer.getvalue()
+
+
+def study_archive_name(study_uid):
+    """按原始 StudyInstanceUID 生成输出压缩包名，不在文件名中暴露原 UID"""
+    if not study_uid:
+        return "unknown_study"
+    return hashlib.sha1(str(study_uid).encode("ascii", "ignore")).hexdigest()[:16]
+
+
+def fsync_path(path, directory=False):
+    """对文件或目录执行 fsync（Windows 不支持目录 fsync，直接跳过）"""
+    if directory:
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    else:
+        fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AtomicWriter:
+    """原子写出：先写到同目录的临时文件再重命名，崩溃时不会留下看似完整的截断文件
 
-    for index, file_path in enumerate(all_files, start=1):
+    已创建的目录在本次运行内缓存，避免每个文件重复 stat/makedirs（网络盘上开销大）。
+    durable 为 True 时，临时文件按目录累积，批量 fsync 后再统一重命名并对目录
+    fsync 一次，而不是每个文件单独 fsync。
+    """
+
+    def __init__(self, durable=False, batch_size=FSYNC_BATCH_SIZE):
+        self.durable = durable
+        self.batch_size = batch_size
+        self.created_dirs = set()
+        self.pending = {}  # 目录 -> [(临时路径, 目标路径)]
+
+    def ensure_dir(self, directory):
+        """确保目录存在，同一目录只创建/检查一次"""
+        if directory and directory not in self.created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.created_dirs.add(directory)
+
+    @staticmethod
+    def temp_path(path):
+        return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+
+    @contextlib.contextmanager
+    def open(self, path, mode="wb", **kwargs):
+        """以临时文件打开 path，退出时提交；发生异常时删除临时文件"""
+        directory = os.path.dirname(path)
+        self.ensure_dir(directory)
+        tmp_path = self.temp_path(path)
         try:
-            ds = pydicom.dcmread(file_path)
-            # 修改配置的标签
-            for tag, value in tags_to_modify.items():
-                if hasattr(ds, tag):
-                    setattr(ds, tag, value)
-            # 保存修改后的文件到输出文件夹
-            relative_path = os.path.relpath(os.path.dirname(file_path), input_folder)
-            output_dir = os.path.join(dicom_output_folder, relative_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            output_path = os.path.join(output_dir, os.path.basename(file_path))
-            ds.save_as(output_path)
-            logging.info(f"文件 {os.path.basename(file_path)} 的 DICOM 标签已修改并保存到 {output_path}")
-        except Exception as e:
-            logging.error(f"处理文件 {os.path.basename(file_path)} 时出错: {e}")
-        finally:
-            update_progress(index, total_files, progress_label)
+            with open(tmp_path, mode, **kwargs) as f:
+                yield f
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        self.commit(tmp_path, path)
 
-    end_time = datetime.now()
-    logging.info(f"DICOM 文件匿名化处理完成。耗时: {end_time - start_time}")
-    progress_window.destroy()
-    messagebox.showinfo("完成", "DICOM 文件匿名化处理完成！")
+    def write(self, path, data):
+        with self.open(path, "wb") as f:
+            f.write(data)
+        return path
 
+    def commit(self, tmp_path, path):
+        """将已写完的临时文件提交为目标文件"""
+        if not self.durable:
+            os.replace(tmp_path, path)
+            return
+        directory = os.path.dirname(path)
+        batch = self.pending.setdefault(directory, [])
+        batch.append((tmp_path, path))
+        if len(batch) >= self.batch_size:
+            self.flush(directory)
 
-def convert_dicom_to_png():
-    """将 DICOM 文件转换为 PNG"""
-    if not input_folder or not png_output_folder:
-        messagebox.showwarning("警告", "请先选择输入文件夹和 PNG 输出文件夹！")
-        logging.warning("未选择输入文件夹或 PNG 输出文件夹。")
+    def flush(self, directory=None):
+        """可靠模式下提交某目录（默认全部目录）累积的文件"""
+        directories = [directory] if directory is not None else list(self.pending)
+        for directory in directories:
+            batch = self.pending.pop(directory, [])
+            for tmp_path, _ in batch:
+                fsync_path(tmp_path)
+            for tmp_path, path in batch:
+                os.replace(tmp_path, path)
+            if batch:
+                fsync_path(directory or ".", directory=True)
+
+    def close(self):
+        self.flush()
+
+
+class DirectorySink:
+    """按输入目录结构写出到输出目录"""
+
+    def __init__(self, output_root, durable=False):
+        self.output_root = output_root
+        self.writer = AtomicWriter(durable)
+
+    def output_path(self, relative_path):
+        return os.path.join(self.output_root, relative_path)
+
+    def write(self, relative_path, data, study_uid=None):
+        return self.writer.write(self.output_path(relative_path), data)
+
+    def link(self, relative_path, existing_path):
+        """以硬链接方式输出与已有输出内容相同的文件"""
+        output_path = self.output_path(relative_path)
+        if os.path.abspath(output_path) != os.path.abspath(existing_path):
+            self.writer.ensure_dir(os.path.dirname(output_path))
+            tmp_path = self.writer.temp_path(output_path)
+            os.link(existing_path, tmp_path)
+            os.replace(tmp_path, output_path)
+        return output_path
+
+    def close(self):
+        self.writer.close()
+
+
+class ArchiveSink:
+    """将输出按检查流式写入压缩包，每个检查一个 ZIP/TAR，不落临时文件
+
+    压缩包先以 .part 后缀写出，完成时再重命名为最终文件名。同时打开的压缩包不超过
+    ARCHIVE_MAX_OPEN 个：输入按检查连续排列，通常只有少数几个处于打开状态；超出时完成最久
+    未写入的一个，该检查之后再有实例时 ZIP/TAR 以追加方式重新打开，TAR.GZ 无法追加，另写一卷
+    （检查名.2.tar.gz）。
+    """
+
+    def __init__(self, output_root, archive_format="zip", durable=False):
+        self.output_root = output_root
+        self.archive_format = archive_format
+        self.durable = durable
+        self._archives = OrderedDict()  # 检查名 -> (最终路径, 打开的压缩包)，按最近写入排序
+        self._finished = {}  # 检查名 -> 本次运行中已完成的最终路径
+        self._volumes = {}  # 检查名 -> TAR.GZ 卷数
+        self._written = False
+
+    def _open(self, study_uid):
+        name = study_archive_name(study_uid)
+        entry = self._archives.get(name)
+        if entry is not None:
+            self._archives.move_to_end(name)
+            return entry
+        while len(self._archives) >= ARCHIVE_MAX_OPEN:
+            self._finish(*self._archives.popitem(last=False))
+        os.makedirs(self.output_root, exist_ok=True)
+        archive_path = self._finished.pop(name, None)
+        mode = "w"
+        if archive_path is None:
+            archive_path = os.path.join(self.output_root, f"{name}.{self.archive_format}")
+        elif self.archive_format == "tar.gz":
+            volume = self._volumes[name] = self._volumes.get(name, 1) + 1
+            archive_path = os.path.join(self.output_root, f"{name}.{volume}.{self.archive_format}")
+        else:
+            os.replace(archive_path, archive_path + ".part")
+            mode = "a"
+        part_path = archive_path + ".part"
+        if self.archive_format == "zip":
+            archive = zipfile.ZipFile(part_path, mode, compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+        else:
+            archive = tarfile.open(part_path, "w:gz" if self.archive_format == "tar.gz" else mode)
+        entry = self._archives[name] = (archive_path, archive)
+        return entry
+
+    def _finish(self, name, entry):
+        archive_path, archive = entry
+        archive.close()
+        if self.durable:
+            fsync_path(archive_path + ".part")
+        os.replace(archive_path + ".part", archive_path)
+        self._finished[name] = archive_path
+        self._written = True
+
+    def write(self, relative_path, data, study_uid=None):
+        archive_path, archive = self._open(study_uid)
+        member = relative_path.replace(os.sep, "/")
+        if isinstance(archive, zipfile.ZipFile):
+            archive.writestr(member, data)
+        else:
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+        return f"{archive_path}:{member}"
+
+    def close(self):
+        while self._archives:
+            self._finish(*self._archives.popitem(last=False))
+        if self.durable and self._written:
+            fsync_path(self.output_root, directory=True)
+
+
+def parse_destination(destination):
+    """解析 AE@主机:端口 形式的远端地址"""
+    ae_title, _, address = destination.rpartition("@")
+    host, _, port = address.rpartition(":")
+    if not ae_title or not host or not port.isdigit():
+        raise ValueError(f"远端地址格式应为 AE@主机:端口: {destination}")
+    return ae_title, host, int(port)
+
+
+class ForwardSink:
+    """以 C-STORE 将输出转发到远端 SCP，替代写出到本地
+
+    每个发送线程持有一个长连接关联，跨文件复用；已协商的表示上下文按 (SOP Class, 传输语法) 缓存，
+    遇到新的组合时带上所有已知组合重新建立关联，远端拒绝的组合直接判为失败。连接中断或远端
+    资源不足时按指数退避重试。发送在后台进行，失败数在关闭时汇总到 failed。
+    """
+
+    def __init__(self, destination, connections=FORWARD_CONNECTIONS, retries=FORWARD_RETRIES):
+        self.ae_title, self.host, self.port = parse_destination(destination)
+        self.retries = retries
+        self.contexts = {}  # (SOP Class, 传输语法) -> 远端是否接受
+        self.associations = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix="forward")
+        self.in_flight = deque()
+        self.max_in_flight = connections * 4
+        self.sent = self.failed = self.retried = self.sent_bytes = 0
+        self.failed_paths = set()  # 发送失败的相对路径
+        self.started = time.perf_counter()
+
+    def _associate(self, key):
+        """用 key 及其余已知可用的上下文建立关联，并更新上下文缓存"""
+        from pynetdicom import AE
+
+        ae = AE(ae_title=FORWARD_AE_TITLE)
+        with self.lock:
+            requested = [key] + [known for known, accepted in self.contexts.items()
+                                 if accepted is not False and known != key][:FORWARD_MAX_CONTEXTS - 1]
+        for sop_class, transfer_syntax in requested:
+            ae.add_requested_context(sop_class, transfer_syntax)
+        assoc = ae.associate(self.host, self.port, ae_title=self.ae_title)
+        accepted = {(cx.abstract_syntax, cx.transfer_syntax[0]) for cx in assoc.accepted_contexts}
+        rejected = {(cx.abstract_syntax, cx.transfer_syntax[0]) for cx in assoc.rejected_contexts}
+        with self.lock:
+            for requested_key in requested:
+                if requested_key in accepted or requested_key in rejected:
+                    self.contexts[requested_key] = requested_key in accepted
+            if assoc.is_established:
+                self.associations.append(assoc)
+        if not assoc.is_established:
+            # 所有上下文都被拒绝时远端会中止关联，此时不应重试
+            if key in rejected:
+                raise ValueError(f"远端不接受 SOP Class {key[0]} / 传输语法 {key[1]}")
+            raise ConnectionError(f"无法与 {self.ae_title}@{self.host}:{self.port} 建立关联")
+        self.local.assoc = assoc
+        self.local.accepted = accepted
+        return assoc
+
+    def _assoc_for(self, key):
+        """返回当前线程可发送 key 上下文的关联；需要时重新协商"""
+        assoc = getattr(self.local, "assoc", None)
+        if assoc is not None and assoc.is_established and key in self.local.accepted:
+            return assoc
+        if self.contexts.get(key) is False:
+            raise ValueError(f"远端不接受 SOP Class {key[0]} / 传输语法 {key[1]}")
+        if assoc is not None and assoc.is_established:
+            assoc.release()
+        assoc = self._associate(key)
+        if key not in self.local.accepted:
+            raise ValueError(f"远端不接受 SOP Class {key[0]} / 传输语法 {key[1]}")
+        return assoc
+
+    def _abort_assoc(self):
+        """中止当前线程的关联（发送 A-ABORT 并释放套接字），之后重新建立"""
+        assoc = getattr(self.local, "assoc", None)
+        self.local.assoc = None
+        if assoc is not None and not assoc.is_aborted and not assoc.is_released:
+            try:
+                assoc.abort()
+            except Exception as e:
+                logging.debug(f"中止关联时出错: {e}")
+
+    def _send(self, relative_path, data):
+        import pydicom
+
+        ds = pydicom.dcmread(io.BytesIO(data))
+        key = (str(ds.file_meta.MediaStorageSOPClassUID), str(ds.file_meta.TransferSyntaxUID))
+        error = None
+        if not ds.get("SOPInstanceUID"):
+            # C-STORE 要求实例 UID 非空（规则置空的 UID 在匿名化时已替换，只有原文件缺少时才会出现）
+            error = ValueError("输出缺少 SOPInstanceUID，无法转发")
+        for attempt in range(self.retries + 1 if error is None else 0):
+            try:
+                status = self._assoc_for(key).send_c_store(ds)
+                code = status.get("Status") if status else None
+                if code is not None and (code == 0x0000 or code in FORWARD_WARNING_STATUSES):
+                    with self.lock:
+                        self.sent += 1
+                        self.sent_bytes += len(data)
+                    return
+                if code is not None and not 0xA700 <= code <= 0xA7FF:
+                    raise ValueError(f"远端返回失败状态 0x{code:04X}")
+                # 无响应（关联中断）或资源不足：中止关联后重试
+                self._abort_assoc()
+                error = ConnectionError("关联中断" if code is None else f"远端资源不足 0x{code:04X}")
+            except (ConnectionError, OSError, RuntimeError) as e:
+                self._abort_assoc()
+                error = e
+            except Exception as e:
+                error = e
+                break
+            if attempt < self.retries:
+                with self.lock:
+                    self.retried += 1
+                time.sleep(FORWARD_BACKOFF * 2 ** attempt * (1 + random.random()))
+        with self.lock:
+            self.failed += 1
+            self.failed_paths.add(relative_path)
+        logging.error(f"转发 {relative_path} 到 {self.ae_title} 失败: {error}")
+
+    def write(self, relative_path, data, study_uid=None):
+        while len(self.in_flight) >= self.max_in_flight:
+            self.in_flight.popleft().result()
+        self.in_flight.append(self.executor.submit(self._send, relative_path, data))
+        return f"{self.ae_title}@{self.host}:{self.port}/{relative_path}"
+
+    def metrics(self):
+        """发送吞吐统计"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {"sent": self.sent, "failed": self.failed, "retried": self.retried, "bytes": self.sent_bytes,
+                "associations": len(self.associations), "instances_per_second": self.sent / elapsed,
+                "megabytes_per_second": self.sent_bytes / elapsed / 1024 / 1024}
+
+    def close(self):
+        self.executor.shutdown()
+        for assoc in self.associations:
+            if assoc.is_established:
+                assoc.release()
+        metrics = self.metrics()
+        logging.info(f"转发到 {self.ae_title}@{self.host}:{self.port}：成功 {metrics['sent']} 个，失败 {metrics['failed']} 个，"
+                     f"重试 {metrics['retried']} 次，使用 {metrics['associations']} 个关联，"
+                     f"{metrics['instances_per_second']:.1f} 实例/s，{metrics['megabytes_per_second']:.1f} MB/s")
+
+
+def create_output_sink(output_root, output_format=None, durable=False):
+    """根据输出格式创建输出端：None 为目录，forward 为 C-STORE 转发（output_root 为 AE@主机:端口），
+    否则为按检查打包的压缩包"""
+    if output_format == "forward":
+        return ForwardSink(output_root)
+    if output_format:
+        return ArchiveSink(output_root, output_format, durable)
+    return DirectorySink(output_root, durable)
+
+
+def use_state_db(db_path):
+    """切换运行状态库路径，并通过环境变量传给之后启动的工作进程"""
+    global STATE_DB_FILE
+    STATE_DB_FILE = os.environ[STATE_DB_ENV] = os.path.abspath(db_path)
+
+
+def open_state_db(db_path=None):
+    """打开运行状态库（WAL 模式，允许多个进程同时读写）；默认为 STATE_DB_FILE"""
+    conn = sqlite3.connect(db_path or STATE_DB_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class DedupIndex:
+    """重复实例索引：以 SOPInstanceUID + 内容哈希识别同一实例的重复副本
+
+    索引保存在运行状态库中，可被并行进程和后续运行共享。重复副本在本次运行中
+    已处理，或其先前的输出文件仍然存在时，才会被跳过或硬链接。新登记的实例先留在内存中，
+    攒够一批后在一个短事务中写入，不长时间占用状态库的写锁（日期偏移、身份标识等共用同一个库）。
+    硬链接的重复副本与原实例的 SOPInstanceUID 相同，同一文件集中不能重复登记，因此不写入 DICOMDIR。
+    """
+
+    def __init__(self, mode, db_path=None):
+        self.mode = mode
+        self.conn = open_state_db(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dedup ("
+            "sop_instance_uid TEXT NOT NULL, content_hash TEXT NOT NULL, "
+            "output_path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "PRIMARY KEY (sop_instance_uid, content_hash))")
+        self.conn.commit()
+        self.seen = set()
+        self.pending = {}  # 键 -> (输出路径, 大小)，尚未写入状态库
+        self.duplicates = 0
+        self.linked = 0
+        self.saved_bytes = 0
+
+    @staticmethod
+    def key(data):
+        """从文件头读取 SOPInstanceUID（不解析像素），并计算内容哈希"""
+        import pydicom
+
+        header = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True,
+                                 specific_tags=["SOPInstanceUID"], force=True)
+        return str(header.get("SOPInstanceUID", "")), hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def lookup(self, key):
+        """返回重复实例已有的输出路径；不是重复或原输出不可用时返回 None"""
+        if not key[0]:
+            return None
+        if key in self.pending:
+            return self.pending[key][0]
+        row = self.conn.execute(
+            "SELECT output_path FROM dedup WHERE sop_instance_uid = ? AND content_hash = ?", key).fetchone()
+        if row is None:
+            return None
+        if key in self.seen or os.path.isfile(row[0]):
+            return row[0]
+        return None
+
+    def record(self, key, output_path, size):
+        """登记一个已写出的实例"""
+        self.seen.add(key)
+        self.pending[key] = (os.path.abspath(output_path), size)
+        if len(self.pending) >= 100:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany("INSERT OR REPLACE INTO dedup VALUES (?, ?, ?, ?)",
+                                  [key + value for key, value in self.pending.items()])
+            self.conn.commit()
+            self.pending.clear()
+
+    def count_duplicate(self, size, linked=False):
+        self.duplicates += 1
+        self.saved_bytes += size
+        if linked:
+            self.linked += 1
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class DicomdirBuilder:
+    """在处理过程中逐个登记输出实例，结束时一次性生成 DICOMDIR，无需重新读取输出文件"""
+
+    PATIENT_KEYWORDS = ("PatientID", "PatientName")
+    STUDY_KEYWORDS = ("StudyInstanceUID", "StudyDate", "StudyTime", "StudyDescription",
+                      "AccessionNumber", "StudyID", "ReferringPhysicianName")
+    SERIES_KEYWORDS = ("SeriesInstanceUID", "Modality", "SeriesNumber")
+    IMAGE_KEYWORDS = ("InstanceNumber",)
+    SUMMARY_KEYWORDS = PATIENT_KEYWORDS + STUDY_KEYWORDS + SERIES_KEYWORDS + IMAGE_KEYWORDS + (
+        "SOPClassUID", "SOPInstanceUID")
+
+    def __init__(self):
+        self.patients = {}
+        self.count = 0
+        self.entries = []  # (摘要, file_id)，用于保存分片目录
+
+    @staticmethod
+    def _values(summary, keywords):
+        return {keyword: summary.get(keyword, "") for keyword in keywords}
+
+    def add(self, summary, file_id):
+        """登记一个已写出的实例；summary 为 instance_summary() 的结果，file_id 为相对输出根目录的路径"""
+        patient_id = str(summary.get("PatientID", ""))
+        study_uid = str(summary.get("StudyInstanceUID", ""))
+        series_uid = str(summary.get("SeriesInstanceUID", ""))
+        patient = self.patients.setdefault(patient_id, (self._values(summary, self.PATIENT_KEYWORDS), {}))
+        study = patient[1].setdefault(study_uid, (self._values(summary, self.STUDY_KEYWORDS), {}))
+        series = study[1].setdefault(series_uid, (self._values(summary, self.SERIES_KEYWORDS), []))
+        image = self._values(summary, self.IMAGE_KEYWORDS)
+        image["ReferencedFileID"] = [part for part in file_id.replace(os.sep, "/").split("/") if part]
+        image["ReferencedSOPClassUIDInFile"] = summary.get("SOPClassUID", "")
+        image["ReferencedSOPInstanceUIDInFile"] = summary.get("SOPInstanceUID", "")
+        image["ReferencedTransferSyntaxUIDInFile"] = summary.get("TransferSyntaxUID") or EXPLICIT_VR_LITTLE_ENDIAN
+        series[1].append(image)
+        self.entries.append((summary, file_id))
+        self.count += 1
+
+    def save_catalog(self, path, writer=None):
+        """将登记的实例保存为 JSON Lines 目录（分片运行时代替 DICOMDIR，合并后再统一生成）"""
+        keywords = self.SUMMARY_KEYWORDS + ("TransferSyntaxUID",)
+        writer = writer or AtomicWriter()
+        with writer.open(path, "w", encoding="utf-8") as f:
+            for summary, file_id in self.entries:
+                values = {keyword: str(summary.get(keyword, "")) for keyword in keywords}
+                f.write(json.dumps({"file_id": file_id.replace(os.sep, "/"), "summary": values}, ensure_ascii=False) + "\n")
+        return path
+
+    @classmethod
+    def from_catalogs(cls, paths):
+        """由多个分片目录重建，用于合并后生成完整的 DICOMDIR"""
+        builder = cls()
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    builder.add(entry["summary"], entry["file_id"])
+        return builder
+
+    @staticmethod
+    def _record(record_type, values):
+        from pydicom.dataset import Dataset
+
+        record = Dataset()
+        record.OffsetOfTheNextDirectoryRecord = 0
+        record.RecordInUseFlag = 0xFFFF
+        record.OffsetOfReferencedLowerLevelDirectoryEntity = 0
+        record.DirectoryRecordType = record_type
+        for keyword, value in values.items():
+            setattr(record, keyword, value)
+        return record
+
+    def _nodes(self):
+        """构建 (记录, 子节点列表) 形式的层级树"""
+        patients = []
+        for patient_values, studies in self.patients.values():
+            study_nodes = []
+            for study_values, series_map in studies.values():
+                series_nodes = []
+                for series_values, images in series_map.values():
+                    image_nodes = [(self._record("IMAGE", image), []) for image in images]
+                    series_nodes.append((self._record("SERIES", series_values), image_nodes))
+                study_nodes.append((self._record("STUDY", study_values), series_nodes))
+            patients.append((self._record("PATIENT", patient_values), study_nodes))
+        return patients
+
+    def write(self, output_root, writer=None):
+        """在输出根目录写出 DICOMDIR，返回其路径"""
+        import pydicom
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = MEDIA_STORAGE_DIRECTORY_STORAGE
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.FileSetID = ""
+        ds.OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity = 0
+        ds.OffsetOfTheLastDirectoryRecordOfTheRootDirectoryEntity = 0
+        ds.FileSetConsistencyFlag = 0
+
+        # 深度优先展开为 Directory Record Sequence
+        # ReferencedFileID 沿用输出文件的实际路径，不满足 8 字符大写的介质规范，屏蔽逐条的 CS 校验警告
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            roots = self._nodes()
+        ordered = []
+
+        def flatten(nodes):
+            for node in nodes:
+                ordered.append(node)
+                flatten(node[1])
+
+        flatten(roots)
+        ds.DirectoryRecordSequence = [record for record, _ in ordered]
+
+        # 偏移量字段均为定长 UL，先以 0 编码一次得到每条记录的位置，再填入偏移量
+        buffer = io.BytesIO()
+        pydicom.dcmwrite(buffer, ds, write_like_original=False)
+        encoded = pydicom.dcmread(io.BytesIO(buffer.getvalue()), force=True)
+        offsets = {id(record): item.seq_item_tell
+                   for record, item in zip(ds.DirectoryRecordSequence, encoded.DirectoryRecordSequence)}
+
+        def link(nodes):
+            for index, (record, children) in enumerate(nodes):
+                if index + 1 < len(nodes):
+                    record.OffsetOfTheNextDirectoryRecord = offsets[id(nodes[index + 1][0])]
+                if children:
+                    record.OffsetOfReferencedLowerLevelDirectoryEntity = offsets[id(children[0][0])]
+                    link(children)
+
+        link(roots)
+        if roots:
+            ds.OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity = offsets[id(roots[0][0])]
+            ds.OffsetOfTheLastDirectoryRecordOfTheRootDirectoryEntity = offsets[id(roots[-1][0])]
+        dicomdir_path = os.path.join(output_root, "DICOMDIR")
+        writer = writer or AtomicWriter()
+        with writer.open(dicomdir_path, "wb") as f:
+            pydicom.dcmwrite(f, ds, write_like_original=False)
+        writer.flush()
+        return dicomdir_path
+
+
+def instance_summary(ds):
+    """提取输出实例的少量元数据（可跨进程传递），用于生成 DICOMDIR 等"""
+    summary = {keyword: ds.get(keyword, "") for keyword in DicomdirBuilder.SUMMARY_KEYWORDS}
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is not None:
+        summary["SOPClassUID"] = file_meta.get("MediaStorageSOPClassUID", summary["SOPClassUID"])
+        summary["TransferSyntaxUID"] = file_meta.get("TransferSyntaxUID", "")
+    return summary
+
+
+def apply_transfer_syntax_policy(ds, policy):
+    """按输出策略调整传输语法
+
+    preserve: 不做任何处理，封装像素数据按字节原样写出，不加载任何解码器；
+    explicit: 压缩像素解压后以显式 VR 小端写出；
+    rle: 以 RLE 无损重新编码（已是 RLE 时保持原字节）；
+    deflate: 像素解压后整个数据集以 Deflated Explicit VR Little Endian 写出。
+    """
+    from pydicom.uid import UID, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, RLELossless
+
+    if policy == "preserve" or getattr(ds, "file_meta", None) is None:
         return
+    transfer_syntax = UID(ds.file_meta.get("TransferSyntaxUID", ExplicitVRLittleEndian))
+    if policy == "rle" and transfer_syntax == RLELossless:
+        return
+    arr = None
+    if transfer_syntax.is_compressed and "PixelData" in ds:
+        arr = decode_pixel_data(ds, decompress=True)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    if policy == "rle" and "PixelData" in ds:
+        # pydicom 2.x 的 decompress() 保留原压缩字节，写出时才替换为 pixel_array：
+        # 编码时传入解码后的数组，编码后清除解压标记，否则写出时会以未压缩像素覆盖 RLE 数据
+        ds.compress(RLELossless, arr)
+        ds.is_decompressed = False
+    elif policy == "deflate":
+        ds.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
 
-    logging.info("DICOM 文件转换为 PNG 开始。")
-    start_time = datetime.now()
 
-    # 获取所有 DICOM 文件
-    all_files = []
-    for _root, _, files in os.walk(input_folder):
-        for file in files:
-            if file.endswith(".dcm"):
-                all_files.append(os.path.join(_root, file))
+def available_pixel_handlers():
+    """检测已安装且可用的像素解码器，按 pydicom 默认顺序返回 {名称: 模块}"""
+    import pydicom
 
-    total_files = len(all_files)
-    logging.info(f"总共找到 {total_files} 个 DICOM 文件。")
+    handlers = {}
+    for handler in pydicom.config.pixel_data_handlers:
+        name = handler.__name__.rsplit(".", 1)[-1].replace("_handler", "")
+        try:
+            if handler.is_available():
+                handlers[name] = handler
+        except Exception:
+            pass
+    return handlers
 
-    # 创建进度窗口
-    progress_window = tk.Toplevel(root)
-    progress_window.title("处理进度")
-    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
-    progress_label.pack(pady=20)
 
-    for index, file_path in enumerate(all_files, start=1):
+@functools.lru_cache(maxsize=None)
+def pixel_handler_order(transfer_syntax):
+    """某传输语法的解码器尝试顺序：先按标定结果，再补充其余支持该语法的可用解码器"""
+    from pydicom.uid import UID
+
+    handlers = available_pixel_handlers()
+    order = [name for name in pixel_decoder_order.get(transfer_syntax, []) if name in handlers]
+    for name, handler in handlers.items():
+        if name not in order and handler.supports_transfer_syntax(UID(transfer_syntax)):
+            order.append(name)
+    return tuple(order)
+
+
+def decode_pixel_data(ds, decompress=False):
+    """按解码器顺序解码像素，某个解码器失败时回退到下一个，全部失败才抛出异常
+
+    decompress 为 True 时同时将数据集就地解压为未压缩传输语法。返回像素数组。
+    """
+    transfer_syntax = str(ds.file_meta.get("TransferSyntaxUID", EXPLICIT_VR_LITTLE_ENDIAN))
+    last_error = None
+    for name in pixel_handler_order(transfer_syntax):
         try:
-            ds = pydicom.dcmread(file_path)
-            # 获取图像数据
-            image = ds.pixel_array
-            if ds.PhotometricInterpretation == "MONOCHROME1":
-                image = np.amax(image) - image
-            if convert_to_grayscale.get():
-                image = Image.fromarray(image).convert("L")  # 转换为灰度图像
+            if decompress:
+                ds.decompress(handler_name=name)
             else:
-                image = Image.fromarray(image)
-            # 保存 PNG 文件
-            relative_path = os.path.relpath(os.path.dirname(file_path), input_folder)
-            output_dir = os.path.join(png_output_folder, relative_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            output_path = os.path.join(output_dir, os.path.basename(file_path).replace(".dcm", ".png"))
-            image.save(output_path)
-            logging.info(f"文件 {os.path.basename(file_path)} 已成功转换为 PNG 并保存到 {output_path}")
+                ds.convert_pixel_data(handler_name=name)
+            return ds.pixel_array
         except Exception as e:
-            logging.error(f"处理文件 {os.path.basename(file_path)} 时出错: {e}")
-        finally:
-            update_progress(index, total_files, progress_label)
+            logging.warning(f"解码器 {name} 解码 {transfer_syntax} 失败，尝试下一个: {e}")
+            last_error = e
+    if last_error is None:
+        raise NotImplementedError(f"没有可用的解码器支持传输语法 {transfer_syntax}")
+    raise last_error
 
-    end_time = datetime.now()
-    logging.info(f"DICOM 文件转换为 PNG 完成。耗时: {end_time - start_time}")
-    progress_window.destroy()
-    messagebox.showinfo("完成", "DICOM 文件转换为 PNG 完成！")
 
+def calibration_worker(conn):
+    """解码器标定的工作进程：逐个接收 (解码器名, 样本列表)，回送 (错误, 解码耗时)"""
+    import pydicom
 
-def save_structured_info():
-    """为每个 DICOM 文件单独保存结构化信息"""
-    if not input_folder or not structured_info_folder:
-        messagebox.showwarning("警告", "请先选择输入文件夹和结构化信息输出文件夹！")
-        logging.warning("未选择输入文件夹或结构化信息输出文件夹。")
-        return
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        name, syntax_samples = task
+        try:
+            elapsed = 0.0
+            for data in syntax_samples:
+                ds = pydicom.dcmread(io.BytesIO(data))
+                start = time.perf_counter()
+                ds.convert_pixel_data(handler_name=name)
+                elapsed += time.perf_counter() - start
+            conn.send((None, elapsed))
+        except Exception as e:
+            conn.send((task_error(e), None))
+    conn.close()
 
-    logging.info("保存结构化信息开始。")
-    start_time = datetime.now()
 
-    # 获取所有 DICOM 文件
-    all_files = []
-    for _root, _, files in os.walk(input_folder):
-        for file in files:
-            if file.endswith(".dcm"):
-                all_files.append(os.path.join(_root, file))
+def calibrate_pixel_handlers(file_paths, force=False, timeout=TASK_TIMEOUT):
+    """对样本文件按传输语法逐个解码器计时，将最快且可用的顺序保存到配置
 
-    total_files = len(all_files)
-    logging.info(f"总共找到 {total_files} 个 DICOM 文件。")
+    只探测前 CALIBRATION_PROBE_FILES 个文件；已标定的传输语法除非 force 否则跳过。
+    探测解码与导出一样在受监督的工作进程中进行（只用一个，计时互不干扰），
+    超过 timeout 秒或崩溃的解码器不计入标定顺序（只作为最后的备选），也不会拖垮整个运行。
+    """
+    import pydicom
+    from pydicom.uid import UID
 
-    # 创建进度窗口
-    progress_window = tk.Toplevel(root)
-    progress_window.title("处理进度")
-    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
-    progress_label.pack(pady=20)
+    handlers = available_pixel_handlers()
+    samples = {}
+    for file_path, future in prefetch_files(file_paths[:CALIBRATION_PROBE_FILES]):
+        try:
+            data = future.result()
+            header = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True)
+            transfer_syntax = str(header.file_meta.TransferSyntaxUID)
+        except Exception:
+            continue
+        if not force and transfer_syntax in pixel_decoder_order:
+            continue
+        syntax_samples = samples.setdefault(transfer_syntax, [])
+        if len(syntax_samples) < CALIBRATION_SAMPLES_PER_SYNTAX:
+            syntax_samples.append(data)
 
-    for index, file_path in enumerate(all_files, start=1):
+    timings = {transfer_syntax: {} for transfer_syntax in samples}
+    probes = deque((transfer_syntax, name) for transfer_syntax in samples for name, handler in handlers.items()
+                   if handler.supports_transfer_syntax(UID(transfer_syntax)))
+    if probes:
+        supervisor = TaskSupervisor(calibration_worker, workers=1, timeout=timeout)
         try:
-            ds = pydicom.dcmread(file_path)
-            # 为每个 DICOM 文件生成一个单独的结构化信息文件
-            relative_path = os.path.relpath(os.path.dirname(file_path), input_folder)
-            output_dir = os.path.join(structured_info_folder, relative_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            output_file_name = os.path.basename(file_path).replace(".dcm", "_info.txt")
-            output_path = os.path.join(output_dir, output_file_name)
-            with open(output_path, "w") as file:
-                file.write(f"文件: {os.path.basename(file_path)}\n")
-                for element in ds:
-                    file.write(f"  {element}\n")
-            logging.info(f"文件 {os.path.basename(file_path)} 的结构化信息已保存到 {output_path}")
-        except Exception as e:
-            logging.error(f"处理文件 {os.path.basename(file_path)} 时出错: {e}")
+            while probes or supervisor.busy:
+                if probes and supervisor.idle:
+                    transfer_syntax, name = probes.popleft()
+                    supervisor.submit((transfer_syntax, name), (name, samples[transfer_syntax]))
+                    continue
+                for (transfer_syntax, name), error, elapsed in supervisor.collect():
+                    if error is None:
+                        timings[transfer_syntax][name] = elapsed
+                    else:
+                        logging.info(f"解码器 {name} 无法解码 {transfer_syntax}: {error[0]}: {error[1]}")
         finally:
-            update_progress(index, total_files, progress_label)
+            supervisor.close()
 
-    end_time = datetime.now()
-    logging.info(f"保存结构化信息完成。耗时: {end_time - start_time}")
-    progress_window.destroy()
-    messagebox.showinfo("完成", "结构化信息保存完成！")
+    for transfer_syntax, syntax_timings in timings.items():
+        order = sorted(syntax_timings, key=syntax_timings.get)
+        pixel_decoder_order[transfer_syntax] = order
+        logging.info(f"传输语法 {UID(transfer_syntax).name} 解码器顺序: "
+                     + ", ".join(f"{name} {syntax_timings[name] * 1000:.1f}ms" for name in order))
+
+    if samples:
+        pixel_handler_order.cache_clear()
+        app_config["decoder_order"] = pixel_decoder_order
+        save_config(app_config)
+    return pixel_decoder_order
 
 
+def match_pixel_mask_regions(ds, mask_rules):
+    """返回与数据集匹配的所有遮盖区域，按 Modality/Manufacturer/Rows/Columns 匹配规则"""
+    regions = []
+    for rule in mask_rules:
+        if all(str(ds.get(key, "")) == str(rule[key]) for key in PIXEL_MASK_MATCH_KEYS if key in rule):
+            regions.extend(tuple(region) for region in rule.get("regions", []))
+    return tuple(regions)
 
-# 日志显示区域
-# log_text = tk.Text(root, height=10, width=60)
-# log_text.pack(pady=10)
-# log_text.config(state="disabled")  # 禁止用户编辑
 
-# 文件夹选择区域
-folder_frame = ttk.LabelFrame(root, text="文件夹选择")
-folder_frame.pack(pady=10, padx=10, fill=tk.X)
+@functools.lru_cache(maxsize=128)
+def build_pixel_mask(rows, columns, regions):
+    """按图像尺寸和遮盖区域生成布尔遮罩，同一几何只生成一次"""
+    import numpy as np
 
-input_label = tk.Label(folder_frame, text="输入文件夹: 未选择")
-input_label.grid(row=0, column=0, padx=5, pady=5, sticky="w")
-input_button = tk.Button(folder_frame, text="选择", command=select_input_folder)
-input_button.grid(row=0, column=1, padx=5, pady=5)
+    mask = np.zeros((rows, columns), dtype=bool)
+    for x0, y0, x1, y1 in regions:
+        mask[max(0, y0):min(rows, y1), max(0, x0):min(columns, x1)] = True
+    mask.flags.writeable = False
+    return mask
 
-dicom_output_label = tk.Label(folder_frame, text="DICOM 输出文件夹: 未选择")
-dicom_output_label.grid(row=1, column=0, padx=5, pady=5, sticky="w")
-dicom_output_button = tk.Button(folder_frame, text="选择", command=select_dicom_output_folder)
-dicom_output_button.grid(row=1, column=1, padx=5, pady=5)
 
-# png_output_label = tk.Label(folder_frame, text="PNG 输出文件夹: 未选择")
-# png_output_label.grid(row=2, column=0, padx=5, pady=5, sticky="w")
-# png_output_button = tk.Button(folder_frame, text="选择", command=select_png_output_folder)
-# png_output_button.grid(row=2, column=1, padx=5, pady=5)
+def apply_pixel_mask(ds, regions):
+    """遮盖像素中烧录的标注信息：所有帧一次向量化赋值，结果以未压缩像素写回
 
-structured_info_label = tk.Label(folder_frame, text="结构化信息输出文件夹: 未选择")
-structured_info_label.grid(row=3, column=0, padx=5, pady=5, sticky="w")
-structured_info_button = tk.Button(folder_frame, text="选择", command=select_structured_info_folder)
-structured_info_button.grid(row=3, column=1, padx=5, pady=5)
+    原为压缩传输语法时先解压，之后由输出传输语法策略决定是否重新压缩。
+    """
+    from pydicom.uid import UID
 
-log_label = tk.Label(folder_frame, text="日志文件夹: 未选择")
-log_label.grid(row=4, column=0, padx=5, pady=5, sticky="w")
-log_button = tk.Button(folder_frame, text="选择", command=select_log_folder)
-log_button.grid(row=4, column=1, padx=5, pady=5)
+    if "PixelData" not in ds:
+        return False
+    transfer_syntax = UID(ds.file_meta.get("TransferSyntaxUID", EXPLICIT_VR_LITTLE_ENDIAN))
+    arr = decode_pixel_data(ds, decompress=transfer_syntax.is_compressed)
+    if not arr.flags.writeable:
+        arr = arr.copy()
+    mask = build_pixel_mask(int(ds.Rows), int(ds.Columns), regions)
+    bits_stored = int(ds.get("BitsStored", arr.dtype.itemsize * 8))
+    if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+        fill = (1 << bits_stored) - 1
+    elif ds.get("PixelRepresentation", 0) == 1:
+        fill = -(1 << (bits_stored - 1))
+    else:
+        fill = 0
+    if int(ds.get("NumberOfFrames", 1) or 1) > 1:
+        arr[:, mask] = fill
+    else:
+        arr[mask] = fill
+    if int(ds.get("SamplesPerPixel", 1)) > 1:
+        ds.PlanarConfiguration = 0  # pixel_array 为交错排列
+    ds.PixelData = arr.tobytes()
+    return True
+
+
+_state_conn = None  # 当前进程的运行状态库连接（工作进程各自打开）
+_date_offsets = {}  # 患者键 -> 偏移天数（进程内缓存）
+
+
+def get_state_conn():
+    """返回当前进程的运行状态库连接"""
+    global _state_conn
+    if _state_conn is None:
+        _state_conn = open_state_db()
+        _state_conn.execute(
+            "CREATE TABLE IF NOT EXISTS date_shift (patient_key TEXT PRIMARY KEY, offset_days INTEGER NOT NULL)")
+        _state_conn.commit()
+    return _state_conn
+
+
+def patient_shift_key(ds):
+    """患者键：原始 PatientID（缺失时用 PatientName）的哈希，状态库中不保存原始标识"""
+    identifier = str(ds.get("PatientID", "") or ds.get("PatientName", ""))
+    return hashlib.sha256(identifier.encode("utf-8")).hexdigest()
 
-# 配置化修改 DICOM 标签
-config_frame = ttk.LabelFrame(root, text="DICOM匿名化字段配置")
-config_frame.pack(pady=10, padx=10, fill=tk.X)
 
-tk.Label(config_frame, text="标签名称").grid(row=0, column=0, padx=5, pady=5)
-tag_name_entry = tk.Entry(config_frame)
-tag_name_entry.grid(row=0, column=1, padx=5, pady=5)
+def get_date_offset(patient_key):
+    """返回患者的日期偏移天数
+
+    首次遇到时随机生成并写入运行状态库（INSERT OR IGNORE），并发的工作进程和
+    后续运行都读到同一个值。
+    """
+    offset = _date_offsets.get(patient_key)
+    if offset is None:
+        conn = get_state_conn()
+        candidate = random.SystemRandom().choice(
+            [days for days in range(-DATE_SHIFT_MAX_DAYS, DATE_SHIFT_MAX_DAYS + 1) if days])
+        conn.execute("INSERT OR IGNORE INTO date_shift VALUES (?, ?)", (patient_key, candidate))
+        conn.commit()
+        offset = conn.execute("SELECT offset_days FROM date_shift WHERE patient_key = ?",
+                              (patient_key,)).fetchone()[0]
+        _date_offsets[patient_key] = offset
+    return offset
+
+
+@functools.lru_cache(maxsize=4096)
+def shift_date_string(value, days):
+    """偏移单个 DA/DT 值的日期部分，时间、小数秒和时区保持不变
+
+    按固定位置切片解析 YYYYMMDD，结果按 (值, 偏移) 缓存，同一检查内重复出现的日期
+    只计算一次。精度不足到日（如 DT 仅有 YYYY）时按月初/年初补齐后偏移再截回原精度。
+    无效或偏移后超出范围的日期（如占位值 00000000、20230230）无法偏移，按置空处理。
+    """
+    text = value.strip()
+    legacy = len(text) >= 10 and text[4] == "." and text[7] == "."  # 旧式 YYYY.MM.DD
+    digits = text[:4] + text[5:7] + text[8:10] if legacy else text[:8]
+    if len(digits) < 4 or not digits.isdigit():
+        return value
+    precision = len(digits)
+    padded = digits + "0101"[precision - 4:]
+    try:
+        shifted = date.fromordinal(date(int(padded[:4]), int(padded[4:6]), int(padded[6:8])).toordinal() + days)
+    except (ValueError, OverflowError):
+        logging.warning("无法偏移的无效日期值，已置空")
+        return ""
+    shifted_digits = shifted.strftime("%Y%m%d")[:precision]
+    if legacy:
+        return f"{shifted_digits[:4]}.{shifted_digits[4:6]}.{shifted_digits[6:8]}{text[10:]}"
+    return shifted_digits + text[precision:]
+
+
+def shift_dates(ds, days, changes=None):
+    """偏移数据集（含序列内）所有 DA/DT 元素；按整天偏移，TM 保持不变
+
+    changes 不为 None 时追加 (标签, 旧值, 新值)，供修改审计使用。
+    """
+    def shift_element(dataset, elem):
+        if elem.VR in ("DA", "DT") and elem.value:
+            old_value = elem.value
+            if isinstance(elem.value, str):
+                elem.value = "\\".join(shift_date_string(part, days) if part else part
+                                       for part in elem.value.split("\\"))
+            else:
+                elem.value = [shift_date_string(str(part), days) if part else part for part in elem.value]
+            if changes is not None and audit_text(elem.value) != audit_text(old_value):
+                changes.append((elem.tag, old_value, elem.value))
 
-tk.Label(config_frame, text="新值").grid(row=0, column=2, padx=5, pady=5)
-new_value_entry = tk.Entry(config_frame)
-new_value_entry.grid(row=0, column=3, padx=5, pady=5)
+    ds.walk(shift_element)
 
-add_button = tk.Button(config_frame, text="添加", command=add_tag_to_modify)
-add_button.grid(row=0, column=4, padx=5, pady=5)
 
-remove_button = tk.Button(config_frame, text="移除", command=remove_tag_to_modify)
-remove_button.grid(row=0, column=5, padx=5, pady=5)
+def collect_identifiers(ds):
+    """收集数据集中的原始身份标识（姓名及其各组成部分、ID、检查号），用于事后 PHI 验证"""
+    identifiers = set()
+    for keyword in PHI_IDENTIFIER_KEYWORDS:
+        if keyword not in ds or ds.data_element(keyword).VM == 0:
+            continue
+        elem = ds.data_element(keyword)
+        for item in (elem.value if elem.VM > 1 else [elem.value]):
+            text = str(item).strip()
+            candidates = {text}
+            # 姓名按字母/表意/拼音分组和 ^ 分隔的各部分分别登记
+            for group in text.split("="):
+                candidates.add(group)
+                candidates.update(group.split("^"))
+            for candidate in candidates:
+                candidate = candidate.strip().casefold()
+                if len(candidate) >= PHI_MIN_PATTERN_LENGTH or (not candidate.isascii() and len(candidate) >= 2):
+                    identifiers.add(candidate)
+    return identifiers
 
-reset_button = tk.Button(config_frame, text="重置为默认值", command=reset_tags_to_default)
-reset_button.grid(row=0, column=6, padx=5, pady=5)
 
-tag_listbox = tk.Listbox(config_frame, height=10, width=50)
-tag_listbox.grid(row=1, column=0, columnspan=7, padx=5, pady=5)
+def effective_rules(options):
+    """解析标签规则，返回 [(关键字, 新值)]
+
+    按患者偏移日期时剔除置空检查/序列/采集/内容日期时间（DA/DT/TM）的规则，改为偏移；
+    其余日期（如 PatientBirthDate）仍置空。
+    """
+    from pydicom.datadict import dictionary_VR, tag_for_keyword
+
+    rules = []
+    for tag, value in options["rules"].items():
+        if options.get("date_shift", False) and value == "" and tag_for_keyword(tag) is not None \
+                and dictionary_VR(tag_for_keyword(tag)) in DATE_VRS and tag.startswith(DATE_SHIFT_KEYWORD_PREFIXES):
+            continue
+        rules.append((tag, value))
+    return rules
+
+
+def rule_tags(rules):
+    """将 [(关键字, 新值)] 解析为 [(标签, 新值)]，未知关键字忽略"""
+    from pydicom.datadict import tag_for_keyword
+
+    return [(tag_for_keyword(keyword), value) for keyword, value in rules if tag_for_keyword(keyword) is not None]
+
+
+def apply_rule_template(ds, rules, template):
+    """按规则替换数据集中已存在的元素
+
+    template 按 (StudyInstanceUID, SeriesInstanceUID) 缓存：新数据元素在序列中首次遇到该标签时以原元素的
+    VR 构造（与 setattr 修改已有元素的结果一致），之后的实例只做字典替换，不再按关键字查找、
+    将原始元素转换为数据元素或重新转换新值。规则值与实例无关，实例级的 SOPInstanceUID、
+    ContentTime 等同样由模板替换；日期偏移仍逐实例进行。
+    """
+    from pydicom.dataelem import DataElement
+
+    for tag, value in rules:
+        if tag not in ds:
+            continue
+        element = template.get(tag)
+        if element is None:
+            element = template[tag] = DataElement(tag, ds[tag].VR, value)
+        ds[tag] = element
+
+
+def get_state_key(name):
+    """返回运行状态库中保存的密钥（uid: UID 替换，audit: 审计旧值哈希）：首次使用时随机生成，之后各次运行共用"""
+    conn = get_state_conn()
+    conn.execute("CREATE TABLE IF NOT EXISTS state_keys (name TEXT PRIMARY KEY, key BLOB NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO state_keys VALUES (?, ?)", (name, os.urandom(32)))
+    conn.commit()
+    return conn.execute("SELECT key FROM state_keys WHERE name = ?", (name,)).fetchone()[0]
+
+
+def split_uid_rules(rules):
+    """从 [(标签, 新值)] 中分出置空 UI 元素的规则，返回 (其余规则, 需替换的 UID 标签)"""
+    from pydicom.datadict import dictionary_VR
+
+    uid_tags = [tag for tag, value in rules if value == "" and dictionary_VR(tag) == "UI"]
+    return [(tag, value) for tag, value in rules if tag not in uid_tags], uid_tags
+
+
+def rule_context(options):
+    """anonymize_bytes 的共享上下文：options 含 uid_key 时置空 UID 的规则改为替换 UID"""
+    rules = rule_tags(effective_rules(options))
+    rules, uid_tags = split_uid_rules(rules) if options.get("uid_key") else (rules, [])
+    return {"rules": rules, "uid_tags": uid_tags, "templates": {}}
+
+
+@functools.lru_cache(maxsize=UID_CACHE_SIZE)
+def replacement_uid(uid, key):
+    """由原 UID 和密钥确定性生成新 UID（2.25 加 128 位整数，PS3.5 B.2），不能由新 UID 反推原 UID"""
+    digest = hashlib.blake2b(uid.encode("ascii", "ignore"), digest_size=16, key=key).digest()
+    return f"2.25.{int.from_bytes(digest, 'big')}"
+
+
+def replace_uids(ds, uid_tags, key):
+    """替换数据集中的 UID，返回 [(标签, 新值)]；SOPInstanceUID 同时更新文件头中的 MediaStorageSOPInstanceUID"""
+    replaced = []
+    for tag in uid_tags:
+        if tag not in ds or not ds[tag].value:
+            continue
+        elem = ds[tag]
+        if elem.VM > 1:
+            elem.value = [replacement_uid(str(uid), key) if uid else uid for uid in elem.value]
+        else:
+            elem.value = replacement_uid(str(elem.value), key)
+        replaced.append((tag, elem.value))
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is not None and "SOPInstanceUID" in ds and any(tag == 0x00080018 for tag, _ in replaced):
+        file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    return replaced
+
+
+def audit_text(value):
+    """元素值的文本形式：多值以反斜杠连接，与文件中存储的形式一致"""
+    from pydicom.multival import MultiValue
+
+    if value is None:
+        return ""
+    if isinstance(value, (list, MultiValue)):
+        return "\\".join("" if item is None else str(item) for item in value)
+    return str(value)
+
+
+def audit_hash(value, key):
+    """旧值的带密钥哈希；bytes 为文件中存储的原始字节，其余按文本形式，均去掉结尾填充"""
+    if not isinstance(value, bytes):
+        value = audit_text(value).encode("utf-8")
+    return hashlib.blake2b(value.rstrip(b" \0"), digest_size=AUDIT_HASH_BYTES, key=key).digest()
+
+
+def audit_rule_changes(originals, rules, key):
+    """规则修改的审计记录 [(标签, 动作, 旧值哈希, 新值)]；originals 为修改前取出的元素，值未变化的不记录"""
+    records = []
+    for tag, value in rules:
+        original = originals.get(tag)
+        if original is None:
+            continue
+        old_value = original.value if original.value is not None else b""
+        new_value = audit_text(value)
+        if isinstance(old_value, bytes):
+            unchanged = old_value.rstrip(b" \0") == new_value.encode("utf-8")
+        else:
+            unchanged = audit_text(old_value) == new_value
+        if not unchanged:
+            records.append((int(tag), "empty" if new_value == "" else "replace", audit_hash(old_value, key), new_value))
+    return records
+
+
+def anonymize_bytes(data, options, context=None):
+    """匿名化单个 DICOM 文件内容（在工作进程中执行），返回 (输出内容, 实例摘要)
+
+    options 为可序列化的字典：rules 为标签修改规则，ts_policy 为输出传输语法策略，
+    mask_rules 为像素遮盖规则（为空时不解码像素），date_shift 为 True 时按患者偏移日期：
+    规则中置空的检查/序列/采集/内容日期时间不再置空，而是与其他所有日期一起按患者偏移（出生日期等仍置空）。
+    context 为同一序列各实例共享的字典，与实例无关的准备工作只做一次。
+    options 含 uid_key（运行选项 replace_uids）时规则中置空的 UID 改为确定性生成的新 UID（见 replacement_uid）。
+    options 含 audit_key 时在修改的同时生成审计记录（摘要中的 audit），不需要事后重读输入输出比对。
+    """
+    import pydicom
+
+    if context is None:
+        context = {}
+    if "rules" not in context:
+        context.update(rule_context(options))
+    ds = pydicom.dcmread(io.BytesIO(data))
+    audit_key = options.get("audit_key")
+    audit = None
+    if audit_key:
+        # 在元素被访问（转换）之前取出规则涉及的原始元素，旧值哈希按文件中存储的字节计算
+        audit, date_changes = [], []
+        originals = {tag: ds.get_item(tag) for tag in [tag for tag, _ in context["rules"]] + context["uid_tags"]
+                     if tag in ds}
+    original_study_uid = ds.get("StudyInstanceUID")
+    identifiers = collect_identifiers(ds) if options.get("collect_identifiers") else None
+    # 在修改标签之前按原始 Modality/Manufacturer 匹配遮盖规则
+    mask_regions = match_pixel_mask_regions(ds, options.get("mask_rules") or ())
+    date_shift = options.get("date_shift", False)
+    if date_shift:
+        shift_dates(ds, get_date_offset(patient_shift_key(ds)), date_changes if audit is not None else None)
+    # 修改配置的标签：同一序列的实例共用一份替换模板
+    template = context["templates"].setdefault((original_study_uid, ds.get("SeriesInstanceUID")), {})
+    apply_rule_template(ds, context["rules"], template)
+    replaced_uids = replace_uids(ds, context["uid_tags"], options["uid_key"]) if context["uid_tags"] else []
+    masked = apply_pixel_mask(ds, mask_regions) if mask_regions else False
+    if audit is not None:
+        audit.extend((int(tag), "shift" if audit_text(new_value).strip("\\") else "empty",
+                      audit_hash(old_value, audit_key), audit_text(new_value))
+                     for tag, old_value, new_value in date_changes)
+        audit.extend(audit_rule_changes(originals, context["rules"] + replaced_uids, audit_key))
+        if masked:
+            audit.append((0x7FE00010, "mask", None, ";".join(",".join(map(str, region)) for region in mask_regions)))
+    apply_transfer_syntax_policy(ds, options.get("ts_policy", "preserve"))
+    summary = instance_summary(ds)
+    summary["OriginalStudyInstanceUID"] = original_study_uid
+    if identifiers is not None:
+        summary["identifiers"] = identifiers
+    if audit is not None:
+        summary["audit"] = audit
+    return dataset_to_bytes(ds), summary
+
+
+def anonymize_series(batch, options):
+    """在一个工作进程中依次匿名化同一序列的一批文件内容，共享序列级准备工作
+
+    返回与 batch 一一对应的结果：成功为 (输出内容, 实例摘要)，失败为异常对象。
+    """
+    context = {}
+    results = []
+    for data in batch:
+        try:
+            results.append(anonymize_bytes(data, options, context))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def series_group_key(file_path):
+    """序列分组键：优先使用 DICOMDIR 记录的 SeriesInstanceUID，否则按所在目录（路径启发）"""
+    series_uid = get_source_hint(file_path, "SeriesInstanceUID")
+    if series_uid:
+        return "uid:" + series_uid
+    if file_path in archive_index:
+        archive_path, name = archive_index[file_path]
+        return "dir:" + os.path.join(archive_path, *archive_member_parts(name)[:-1])
+    return "dir:" + os.path.dirname(file_path)
+
+
+class InlineExecutor:
+    """在当前进程中同步执行任务的执行器，接口与 concurrent.futures 一致（workers=0 时使用）"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def create_executor(workers):
+    """workers 为 0 时在当前进程执行，否则使用进程池"""
+    if workers <= 0:
+        return InlineExecutor()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def anonymization_task_options(options):
+    """从运行选项中取出传给工作进程 anonymize_bytes 的部分"""
+    return {
+        "rules": options["rules"],
+        "ts_policy": options.get("ts_policy", "preserve"),
+        "mask_rules": options.get("mask_rules") or [],
+        "date_shift": options.get("date_shift", False),
+        "collect_identifiers": options.get("collect_identifiers", False),
+        "uid_key": get_state_key("uid") if options.get("replace_uids") else None,
+        "audit_key": get_state_key("audit") if options.get("audit") else None,
+    }
+
+
+def run_anonymization(all_files, input_root, output_root, options, progress=None):
+    """匿名化一批文件：预读 -> 去重 -> 按序列分批 -> 工作进程匿名化/转码 -> 输出端写出
+
+    options 除 anonymize_bytes 所需字段（rules、ts_policy、mask_rules、date_shift）外，还包括 output_format、write_dicomdir、
+    dedup_mode、durable、skip_existing、workers、audit（记录修改审计），以及分片运行时的 shard=(序号, 总数) 和 shard_dir。
+    progress(已完成数, 总数) 在每个文件完成后调用。
+    返回统计信息字典；分片运行或 options 中 manifest 为 True 时，其中的 manifest 为逐文件的
+    [(相对路径, 状态, 输出路径)]，状态为 written/skipped/duplicate/failed。
+    """
+    total_files = len(all_files)
+    archive_format = options.get("output_format")
+    workers = options.get("workers", WORKER_COUNT)
+    sink = create_output_sink(output_root, archive_format, options.get("durable", False))
+    # 输出经原子写入，按名称存在的输出文件一定完整，可安全跳过（仅目录输出）
+    skip_existing = options.get("skip_existing") and not archive_format
+    dicomdir_builder = DicomdirBuilder() if options.get("write_dicomdir") and not archive_format else None
+    dedup_mode = options.get("dedup_mode")
+    dedup_index = DedupIndex(dedup_mode) if dedup_mode else None
+    identifier_store = IdentifierStore(output_root) if options.get("collect_identifiers") else None
+    audit_log = AuditLog() if options.get("audit") else None
+    task_options = anonymization_task_options(options)
+    stats = {"total": total_files, "written": 0, "skipped": 0, "duplicates": 0, "failed": 0}
+    done = 0
+    # 分片运行时记录清单，DICOMDIR 以分片目录代替，由 merge 统一生成
+    shard = options.get("shard")
+    manifest = [] if shard or options.get("manifest") else None
+
+    def file_done(relative_path, status, output_path=""):
+        nonlocal done
+        done += 1
+        if manifest is not None:
+            manifest.append((relative_path, status, output_path))
+        if progress is not None:
+            progress(done, total_files)
+
+    # 已提交但尚未完成的实例：去重键 -> 等待它完成的重复副本 [(文件路径, 相对路径, 大小)]
+    pending_duplicates = {}
+
+    def resolve_duplicate(file_path, relative_path, size, existing_path):
+        output_path = ""
+        if dedup_mode == "link" and not archive_format:
+            output_path = sink.link(relative_path, existing_path)
+            dedup_index.count_duplicate(size, linked=True)
+            logging.info(f"文件 {file_path} 与 {existing_path} 重复，已硬链接到 {output_path}")
+        else:
+            dedup_index.count_duplicate(size)
+            logging.info(f"文件 {file_path} 与 {existing_path} 重复，已跳过")
+        stats["duplicates"] += 1
+        file_done(relative_path, "duplicate", output_path)
+
+    def finish_duplicates(dedup_key, file_path, output_path):
+        """首个副本完成后处理等待它的重复副本；首个副本失败时重复副本同样记为失败（内容相同）"""
+        for duplicate_path, relative_path, size in pending_duplicates.pop(dedup_key, ()):
+            try:
+                if not output_path:
+                    raise ValueError(f"与处理失败的 {os.path.basename(file_path)} 内容相同")
+                resolve_duplicate(duplicate_path, relative_path, size, output_path)
+            except Exception as e:
+                stats["failed"] += 1
+                logging.error(f"处理文件 {os.path.basename(duplicate_path)} 时出错: {e}")
+                file_done(relative_path, "failed")
+
+    def finish_batch(entries, future):
+        try:
+            results = future.result()
+        except Exception as e:
+            results = [e] * len(entries)
+        for entry, result in zip(entries, results):
+            finish(*entry, result)
+
+    def finish(file_path, relative_path, dedup_key, size, result):
+        status, output_path = "failed", ""
+        try:
+            if isinstance(result, Exception):
+                raise result
+            output_bytes, summary = result
+            if identifier_store is not None:
+                identifier_store.add(summary.pop("identifiers", ()))
+            output_path = sink.write(relative_path, output_bytes, summary.get("OriginalStudyInstanceUID"))
+            if audit_log is not None:
+                audit_log.add(relative_path, output_path, summary.pop("audit", ()))
+            if dedup_index is not None:
+                dedup_index.record(dedup_key, output_path, size)
+            if dicomdir_builder is not None:
+                dicomdir_builder.add(summary, relative_path)
+            stats["written"] += 1
+            status = "written"
+            logging.info(f"文件 {os.path.basename(file_path)} 的 DICOM 标签已修改并保存到 {output_path}")
+        except Exception as e:
+            stats["failed"] += 1
+            logging.error(f"处理文件 {os.path.basename(file_path)} 时出错: {e}")
+        finally:
+            file_done(relative_path, status, output_path)
+        if dedup_key in pending_duplicates:
+            finish_duplicates(dedup_key, file_path, output_path if status == "written" else "")
+
+    if skip_existing:
+        # 在预读之前过滤，已存在输出的文件不会被读取
+        pending_files = []
+        for file_path in all_files:
+            relative_path = relative_source_path(file_path, input_root)
+            if os.path.exists(sink.output_path(relative_path)):
+                stats["skipped"] += 1
+                file_done(relative_path, "skipped", sink.output_path(relative_path))
+            else:
+                pending_files.append(file_path)
+        all_files = pending_files
+        if stats["skipped"]:
+            logging.info(f"跳过 {stats['skipped']} 个已存在输出的文件。")
+
+    # 同一序列的文件成批交给一个工作进程；按提交顺序收取结果，在途批数受限以控制内存
+    in_flight = deque()
+    max_in_flight = max(1, workers) * 2
+    batch, batch_key, batch_bytes = [], None, 0
+    try:
+        with create_executor(workers) as executor:
+
+            def submit_batch():
+                nonlocal batch, batch_bytes
+                if batch:
+                    future = executor.submit(anonymize_series, [entry[-1] for entry in batch], task_options)
+                    in_flight.append(([entry[:-1] for entry in batch], future))
+                    batch, batch_bytes = [], 0
+                while len(in_flight) >= max_in_flight:
+                    finish_batch(*in_flight.popleft())
+
+            for file_path, read_future in prefetch_files(all_files):
+                relative_path = relative_source_path(file_path, input_root)
+                try:
+                    data = read_future.result()
+                    dedup_key = None
+                    if dedup_index is not None:
+                        dedup_key = dedup_index.key(data)
+                        existing_path = dedup_index.lookup(dedup_key)
+                        if existing_path is not None:
+                            resolve_duplicate(file_path, relative_path, len(data), existing_path)
+                            continue
+                        if dedup_key in pending_duplicates:
+                            # 首个副本仍在处理中，完成后再按其输出跳过或硬链接
+                            pending_duplicates[dedup_key].append((file_path, relative_path, len(data)))
+                            continue
+                    key = series_group_key(file_path)
+                    if key != batch_key or len(batch) >= SERIES_BATCH_MAX_FILES \
+                            or batch_bytes >= SERIES_BATCH_MAX_BYTES:
+                        submit_batch()
+                        batch_key = key
+                    batch.append((file_path, relative_path, dedup_key, len(data), data))
+                    batch_bytes += len(data)
+                    if dedup_key is not None and dedup_key[0]:
+                        pending_duplicates[dedup_key] = []
+                except Exception as e:
+                    stats["failed"] += 1
+                    logging.error(f"处理文件 {os.path.basename(file_path)} 时出错: {e}")
+                    file_done(relative_path, "failed")
+            submit_batch()
+            while in_flight:
+                finish_batch(*in_flight.popleft())
+        if shard:
+            shard_dir = options.get("shard_dir") or default_shard_dir(output_root, archive_format)
+            manifest_path = save_shard_manifest(manifest, shard_artifact_path(shard_dir, "manifest", shard))
+            logging.info(f"分片 {shard[0]}/{shard[1]} 的清单已保存到 {manifest_path}")
+            if dicomdir_builder is not None:
+                catalog_path = dicomdir_builder.save_catalog(shard_artifact_path(shard_dir, "catalog", shard))
+                logging.info(f"分片目录已保存到 {catalog_path}，合并分片后生成 DICOMDIR")
+        elif dicomdir_builder is not None and stats["skipped"]:
+            # 跳过的输出未登记，生成的 DICOMDIR 会不完整，保留原有的 DICOMDIR
+            logging.warning(f"跳过了 {stats['skipped']} 个已存在的输出，未重新生成 DICOMDIR。")
+        elif dicomdir_builder is not None:
+            dicomdir_path = dicomdir_builder.write(output_root, sink.writer)
+            logging.info(f"已为 {dicomdir_builder.count} 个输出实例生成 {dicomdir_path}")
+            if dedup_index is not None and dedup_index.linked:
+                logging.info(f"硬链接的 {dedup_index.linked} 个重复实例与原实例 SOPInstanceUID 相同，未登记到 DICOMDIR。")
+    finally:
+        sink.close()
+        # 转发输出端在后台发送，发送失败在关闭时才能确定
+        late_failures = getattr(sink, "failed", 0)
+        stats["written"] -= late_failures
+        stats["failed"] += late_failures
+        if late_failures and manifest is not None:
+            manifest[:] = [(entry[0], "failed", "") if entry[0] in sink.failed_paths else entry for entry in manifest]
+        if dedup_index is not None:
+            logging.info(f"去重: 发现 {dedup_index.duplicates} 个重复实例（硬链接 {dedup_index.linked} 个），"
+                         f"节省 {dedup_index.saved_bytes / 1024 / 1024:.1f} MB 的解析与写出。")
+            dedup_index.close()
+        if identifier_store is not None:
+            identifier_store.close()
+        if audit_log is not None:
+            audit_log.close()
+    if options.get("manifest"):
+        stats["manifest"] = manifest
+    return stats
+
+
+class MemoryWriter:
+    """与 AtomicWriter 接口相同，但只把写出的内容留在内存中（试运行时代替真正的写出）"""
+
+    def __init__(self):
+        self.data = b""
+
+    @contextlib.contextmanager
+    def open(self, path, mode="wb", **kwargs):
+        buffer = io.BytesIO()
+        yield buffer
+        self.data = buffer.getvalue()
+
+    def write(self, path, data):
+        self.data = data
+        return path
+
+    def close(self):
+        pass
+
+
+def file_transfer_syntax(file_path, data=None):
+    """只读取文件元信息得到传输语法；已读出内容（压缩包成员）时从内容中解析，无法识别时返回 "未知"。"""
+    import pydicom
+    from pydicom.filereader import read_file_meta_info
+
+    try:
+        if data is None:
+            return str(read_file_meta_info(file_path).get("TransferSyntaxUID", "未知"))
+        header = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True, specific_tags=["SOPClassUID"])
+        return str(header.file_meta.get("TransferSyntaxUID", "未知"))
+    except Exception:
+        return "未知"
+
+
+def plan_strata(all_files):
+    """按 (传输语法, 文件大小的二进制量级) 分层，返回 {层: [(输入序号, 文件路径, 大小)]}
+
+    普通文件只读取文件元信息（并行），压缩包成员按包内顺序读出后解析。
+    """
+    entries = {}
+    plain = [(index, file_path) for index, file_path in enumerate(all_files) if file_path not in archive_index]
+
+    def probe(item):
+        index, file_path = item
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        return index, file_path, size, file_transfer_syntax(file_path)
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+        for index, file_path, size, transfer_syntax in pool.map(probe, plain):
+            entries[index] = (file_path, size, transfer_syntax)
+    members = [file_path for file_path in all_files if file_path in archive_index]
+    member_index = {file_path: index for index, file_path in enumerate(all_files) if file_path in archive_index}
+    for file_path, future in prefetch_files(members):
+        try:
+            data = future.result()
+            entries[member_index[file_path]] = (file_path, len(data), file_transfer_syntax(file_path, data))
+        except Exception:
+            entries[member_index[file_path]] = (file_path, 0, "未知")
+    strata = {}
+    for index in sorted(entries):
+        file_path, size, transfer_syntax = entries[index]
+        strata.setdefault((transfer_syntax, size.bit_length()), []).append((index, file_path, size))
+    return strata
+
+
+def plan_sample(strata, fraction=PLAN_SAMPLE_FRACTION, max_samples=PLAN_MAX_SAMPLES, seed=0):
+    """每层按比例随机抽样（至少 1 个，总数不超过 max_samples），返回 [(输入序号, 文件路径, 大小, 权重, 层)]"""
+    rng = random.Random(seed)
+    wanted = {stratum: max(1, round(len(files) * fraction)) for stratum, files in strata.items()}
+    if sum(wanted.values()) > max_samples:
+        scale = max_samples / sum(wanted.values())
+        wanted = {stratum: max(1, int(count * scale)) for stratum, count in wanted.items()}
+    sample = []
+    for stratum, files in strata.items():
+        chosen = rng.sample(files, min(wanted[stratum], len(files)))
+        weight = len(files) / len(chosen)
+        sample.extend((index, file_path, size, weight, stratum) for index, file_path, size in chosen)
+    return sorted(sample)  # 按输入顺序读取，压缩包成员可顺序解压
+
+
+def existing_outputs(all_files, input_root, output_root, pipeline, options):
+    """已存在输出的文件（只对本地目录输出可知）"""
+    if pipeline == "png":
+        return [file_path for file_path in all_files
+                if os.path.exists(png_output_path(file_path, input_root, output_root))]
+    if options.get("output_format"):
+        return []
+    return [file_path for file_path in all_files
+            if os.path.exists(os.path.join(output_root, relative_source_path(file_path, input_root)))]
+
+
+def plan_run(all_files, input_root, output_root, pipeline="anonymize", options=None,
+             fraction=PLAN_SAMPLE_FRACTION, max_samples=PLAN_MAX_SAMPLES):
+    """试运行：分层抽样并在当前进程中对样本运行处理流程，不写出最终输出，外推全部文件的耗时、输出大小和峰值内存
+
+    样本输出写入输出目录下的临时目录以计入写出开销，结束后删除（转发输出不计网络发送）。
+    返回计划字典，同时以日志输出计划。
+    """
+    options = options or {}
+    start = time.perf_counter()
+    existing = set(existing_outputs(all_files, input_root, output_root, pipeline, options))
+    skipping = pipeline == "anonymize" and options.get("skip_existing") and not options.get("output_format")
+    pending = [file_path for file_path in all_files if file_path not in existing] if skipping else list(all_files)
+    strata = plan_strata(pending)
+    sample = plan_sample(strata, fraction, max_samples)
+
+    if pipeline == "png":
+        memory_writer = MemoryWriter()
+        grayscale = options.get("grayscale", True)
+
+        def run_pipeline(data):
+            render_png(data, "", grayscale, memory_writer)
+            return memory_writer.data
+    else:
+        task_options = anonymization_task_options(options)
+        context = {}
+
+        def run_pipeline(data):
+            return anonymize_bytes(data, task_options, context)[0]
+
+    measure_writes = options.get("output_format") != "forward"
+    created_root = not os.path.exists(output_root) and measure_writes
+    if measure_writes:
+        os.makedirs(output_root, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix=".dryrun-", dir=output_root) if measure_writes else None
+    writer = AtomicWriter(options.get("durable", False))
+    totals = {"read": 0.0, "process": 0.0, "write": 0.0, "output_bytes": 0.0, "input_bytes": 0.0}
+    largest = {}  # 层 -> (大小, 文件路径)，用于测量峰值内存
+    failed = 0
+    archive_reader = ArchiveReader({archive_index[file_path] for _, file_path, _, _, _ in sample
+                                    if file_path in archive_index})
+    try:
+        for index, file_path, size, weight, stratum in sample:
+            try:
+                tick = time.perf_counter()
+                data = read_file_bytes(file_path, archive_reader=archive_reader)
+                read_done = time.perf_counter()
+                output = run_pipeline(data)
+                process_done = time.perf_counter()
+                if scratch is not None:
+                    writer.write(os.path.join(scratch, f"{index}.out"), output)
+                write_done = time.perf_counter()
+            except Exception as e:
+                failed += 1
+                logging.warning(f"样本文件 {file_path} 处理失败: {e}")
+                continue
+            totals["read"] += (read_done - tick) * weight
+            totals["process"] += (process_done - read_done) * weight
+            totals["write"] += (write_done - process_done) * weight
+            totals["output_bytes"] += len(output) * weight
+            totals["input_bytes"] += len(data) * weight
+            if len(data) > largest.get(stratum, (-1, None))[0]:
+                largest[stratum] = (len(data), file_path)
+        writer.flush()
+        # 峰值内存按每层最大的样本测量（tracemalloc 会拖慢运行，因此不与计时同时进行）
+        task_peak = 0
+        for size, file_path in largest.values():
+            data = read_file_bytes(file_path, archive_reader=ArchiveReader())
+            tracemalloc.start()
+            try:
+                run_pipeline(data)
+                task_peak = max(task_peak, tracemalloc.get_traced_memory()[1])
+            except Exception:
+                pass
+            finally:
+                tracemalloc.stop()
+    finally:
+        archive_reader.close()
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+        if created_root:
+            shutil.rmtree(output_root, ignore_errors=True)
+
+    max_size = max((size for _, _, size, _, _ in sample), default=0)
+    sizes = [size for files in strata.values() for _, _, size in files]
+    mean_size = sum(sizes) / len(sizes) if sizes else 0
+    output_ratio = totals["output_bytes"] / totals["input_bytes"] if totals["input_bytes"] else 1.0
+    worker_counts = sorted({count for count in (1, 2, 4, 8, 16, 32, 64) if count < WORKER_COUNT} | {WORKER_COUNT})
+    estimates = []
+    for workers in worker_counts:
+        if pipeline == "png":
+            # 工作进程解码、编码并写出，主进程预读后经管道发送
+            elapsed = max((totals["process"] + totals["write"]) / workers, totals["read"] / PREFETCH_WORKERS)
+            peak = PREFETCH_DEPTH * max_size + workers * (max_size + task_peak)
+        else:
+            # 工作进程按序列批处理，主进程预读并串行写出，在途批数为工作进程数的两倍
+            elapsed = max(totals["process"] / workers, totals["read"] / PREFETCH_WORKERS, totals["write"])
+            batch = min(SERIES_BATCH_MAX_FILES * mean_size, SERIES_BATCH_MAX_BYTES) + max_size
+            peak = (PREFETCH_DEPTH * max_size + 2 * workers * batch * (1 + output_ratio)
+                    + workers * (task_peak + batch * (1 + output_ratio)))
+        estimates.append({"workers": workers, "seconds": elapsed, "peak_bytes": peak})
+
+    plan = {
+        "pipeline": pipeline, "total": len(all_files), "pending": len(pending), "existing": len(existing),
+        "skipping_existing": bool(skipping), "strata": {stratum: len(files) for stratum, files in strata.items()},
+        "samples": len(sample), "failed_samples": failed, "input_bytes": sum(sizes),
+        "output_bytes": totals["output_bytes"], "task_peak_bytes": task_peak, "estimates": estimates,
+        "planning_seconds": time.perf_counter() - start,
+    }
+    for line in format_plan(plan, measure_writes):
+        logging.info(line)
+    return plan
+
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if count < 1024 or unit == "TB":
+            return f"{count:.1f} {unit}"
+        count /= 1024
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def format_plan(plan, measure_writes=True):
+    """试运行计划的文本表示"""
+    from pydicom.uid import UID
+
+    lines = [f"试运行（{plan['pipeline']}）：共 {plan['total']} 个文件，待处理 {plan['pending']} 个，"
+             f"输入 {format_bytes(plan['input_bytes'])}，抽样 {plan['samples']} 个（失败 {plan['failed_samples']} 个），"
+             f"规划耗时 {plan['planning_seconds']:.1f}s"]
+    if plan["existing"]:
+        action = "将被跳过" if plan["skipping_existing"] else "已存在输出，将被覆盖"
+        lines.append(f"  {plan['existing']} 个文件{action}")
+    for (transfer_syntax, magnitude), count in sorted(plan["strata"].items()):
+        name = UID(transfer_syntax).name if transfer_syntax != "未知" else transfer_syntax
+        lines.append(f"  分层 {name}，{format_bytes(2 ** max(0, magnitude - 1))} - {format_bytes(2 ** magnitude)}：{count} 个")
+    lines.append(f"  预计输出 {format_bytes(plan['output_bytes'])}，单个任务峰值内存 {format_bytes(plan['task_peak_bytes'])}"
+                 + ("" if measure_writes else "（转发输出，未计入网络发送时间）"))
+    for estimate in plan["estimates"]:
+        lines.append(f"  {estimate['workers']:>3} 个工作进程：约 {format_duration(estimate['seconds'])}，"
+                     f"峰值内存约 {format_bytes(estimate['peak_bytes'])}（不含各进程的解释器与模块）")
+    return lines
+
+
+def parse_shard(text):
+    """解析 "i/N" 形式的分片参数（i 从 0 开始）"""
+    index, _, count = text.partition("/")
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"分片序号应在 0 到 {count - 1} 之间: {text}")
+    return index, count
+
+
+def shard_of(key, count):
+    """稳定哈希（不受进程的哈希随机化影响），同一键在任何进程中都落到同一分片"""
+    digest = hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shard_key(file_path, input_root, mode="study"):
+    """分片键：study 模式取 StudyInstanceUID（DICOMDIR 记录或只读文件头），取不到时与 path 模式
+    一样使用相对路径的顶层目录"""
+    if mode == "study":
+        study_uid = get_source_hint(file_path, "StudyInstanceUID")
+        if not study_uid and file_path not in archive_index:
+            import pydicom
+
+            try:
+                header = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["StudyInstanceUID"])
+                study_uid = header.get("StudyInstanceUID")
+            except Exception:
+                study_uid = None
+        if study_uid:
+            return "study:" + str(study_uid)
+    return "path:" + relative_source_path(file_path, input_root).replace(os.sep, "/").split("/")[0]
+
+
+def select_shard(all_files, input_root, shard, mode="study"):
+    """返回属于该分片的文件；文件头探测并行进行"""
+    index, count = shard
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+        keys = list(pool.map(lambda file_path: shard_key(file_path, input_root, mode), all_files))
+    selected = [file_path for file_path, key in zip(all_files, keys) if shard_of(key, count) == index]
+    logging.info(f"分片 {index}/{count}（按 {mode}）：{len(selected)}/{len(all_files)} 个文件。")
+    return selected
+
+
+def default_shard_dir(output_root, output_format=None):
+    """分片产物目录：本地输出时位于输出目录下，转发时位于当前目录"""
+    if output_format == "forward":
+        return SHARD_DIR_NAME
+    return os.path.join(output_root, SHARD_DIR_NAME)
+
+
+def shard_artifact_path(shard_dir, kind, shard):
+    extension = {"manifest": "csv", "catalog": "jsonl"}[kind]
+    return os.path.join(shard_dir, f"{kind}.shard-{shard[0]}-of-{shard[1]}.{extension}")
+
+
+def save_shard_manifest(rows, path):
+    with AtomicWriter().open(path, "w", encoding="utf-8-sig", newline="") as f:
+        table = csv.writer(f)
+        table.writerow(SHARD_MANIFEST_COLUMNS)
+        table.writerows(rows)
+    return path
+
+
+def find_shard_artifacts(directory, prefix, suffix):
+    """返回 {(序号, 总数): 路径}"""
+    found = {}
+    if not os.path.isdir(directory):
+        return found
+    for name in os.listdir(directory):
+        if name.startswith(prefix + ".shard-") and name.endswith(suffix):
+            index, _, count = name[len(prefix) + len(".shard-"):-len(suffix)].partition("-of-")
+            if index.isdigit() and count.isdigit():
+                found[(int(index), int(count))] = os.path.join(directory, name)
+    return found
+
+
+def log_records(path):
+    """按日志记录读取（异常堆栈等续行归入上一条），用于按时间归并"""
+    record = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if record and not line[:4].isdigit():
+                record.append(line)
+                continue
+            if record:
+                yield "".join(record)
+            record = [line]
+    if record:
+        yield "".join(record)
+
+
+def merge_shards(output_root, shard_dir=None, log_dir=None, output_format=None):
+    """合并各分片的清单、目录和日志：清单合并为 manifest.csv，目录合并后生成 DICOMDIR，
+    日志按时间归并写入 MERGED_LOG_NAME。各结果每次整体重写，可重复执行。返回缺失的分片序号列表。"""
+    shard_dir = shard_dir or default_shard_dir(output_root, output_format)
+    manifests = find_shard_artifacts(shard_dir, "manifest", ".csv")
+    if not manifests:
+        raise FileNotFoundError(f"{shard_dir} 中没有分片清单")
+    count = max(shard[1] for shard in manifests)
+    missing = [index for index in range(count) if (index, count) not in manifests]
+
+    if log_dir:
+        shard_logs = find_shard_artifacts(log_dir, "dicom_tool", ".log")
+        if shard_logs:
+            # 各分片日志各自有序，按记录开头的时间戳归并
+            merged_log_path = os.path.join(log_dir, MERGED_LOG_NAME)
+            with AtomicWriter().open(merged_log_path, "w", encoding="utf-8") as merged_log:
+                merged_log.writelines(heapq.merge(*(log_records(path) for path in shard_logs.values()),
+                                                  key=lambda record: record[:23]))
+            logging.info(f"已按时间归并 {len(shard_logs)} 个分片日志到 {merged_log_path}")
+    if missing:
+        logging.warning(f"缺少分片 {missing}（共 {count} 个），合并结果不完整。")
+
+    merged_path = os.path.join(shard_dir if output_format == "forward" else output_root, "manifest.csv")
+    rows = 0
+    with AtomicWriter().open(merged_path, "w", encoding="utf-8-sig", newline="") as f:
+        table = csv.writer(f)
+        table.writerow(SHARD_MANIFEST_COLUMNS + ("分片",))
+        for shard in sorted(manifests):
+            with open(manifests[shard], encoding="utf-8-sig", newline="") as shard_file:
+                reader = csv.reader(shard_file)
+                next(reader, None)
+                for row in reader:
+                    table.writerow(row + [f"{shard[0]}/{shard[1]}"])
+                    rows += 1
+    logging.info(f"已合并 {len(manifests)} 个分片清单（{rows} 行）到 {merged_path}")
+
+    catalogs = find_shard_artifacts(shard_dir, "catalog", ".jsonl")
+    if catalogs and output_format != "forward":
+        builder = DicomdirBuilder.from_catalogs([catalogs[shard] for shard in sorted(catalogs)])
+        dicomdir_path = builder.write(output_root)
+        logging.info(f"已由 {len(catalogs)} 个分片目录为 {builder.count} 个实例生成 {dicomdir_path}")
+
+    return missing
+
+
+class IdentifierStore:
+    """原始身份标识库（PHI_IDENTIFIER_DB_FILE 中的 phi_identifiers 表），供事后 PHI 验证使用
+
+    只在开启收集时创建；标识按输出目录登记，验证某个输出目录时只使用写入该目录的运行收集的标识。
+    PHI 验证需要按子串匹配原文，因此保存的是原始标识，该文件应与原始数据同等保护，验证后可删除。
+    """
+
+    def __init__(self, output_root, db_path=PHI_IDENTIFIER_DB_FILE):
+        self.output_root = os.path.abspath(output_root)
+        self.conn = open_state_db(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS phi_identifiers ("
+                          "output_root TEXT NOT NULL, pattern TEXT NOT NULL, PRIMARY KEY (output_root, pattern))")
+        self.conn.commit()
+        self.pending = set()
+
+    def add(self, identifiers):
+        self.pending.update(identifiers)
+        if len(self.pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany("INSERT OR IGNORE INTO phi_identifiers VALUES (?, ?)",
+                                  [(self.output_root, pattern) for pattern in self.pending])
+            self.conn.commit()
+            self.pending.clear()
+
+    def patterns(self):
+        self.flush()
+        return [row[0] for row in self.conn.execute("SELECT pattern FROM phi_identifiers WHERE output_root = ?",
+                                                    (self.output_root,))]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class AuditLog:
+    """修改审计表（运行状态库中的 audit_files 和 audit_changes 表），按批写入
+
+    audit_files 每个输出文件一行（记录时间、来源、输出路径）；audit_changes 每个修改一行：
+    标签以整数保存，动作为 replace/empty/shift/mask，旧值只保存带密钥的哈希（密钥见 get_state_key）。
+    并行的分片进程共用同一个库，因此待写记录在内存中攒够一批后才在一个短事务中写入。
+    """
+
+    def __init__(self, db_path=None):
+        self.conn = open_state_db(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS audit_files ("
+                          "id INTEGER PRIMARY KEY, recorded_at TEXT NOT NULL, source TEXT NOT NULL, output TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS audit_changes ("
+                          "file_id INTEGER NOT NULL, tag INTEGER NOT NULL, action TEXT NOT NULL, "
+                          "old_hash BLOB, new_value TEXT)")
+        self.conn.commit()
+        self.pending = []
+        self.files = 0
+        self.changes = 0
+
+    def add(self, source, output, records):
+        self.pending.append((datetime.now().isoformat(timespec="seconds"), source, output, records))
+        if len(self.pending) >= AUDIT_BATCH_FILES:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        changes = []
+        for recorded_at, source, output, records in self.pending:
+            file_id = self.conn.execute("INSERT INTO audit_files (recorded_at, source, output) VALUES (?, ?, ?)",
+                                        (recorded_at, source, output)).lastrowid
+            changes.extend((file_id,) + tuple(record) for record in records)
+        self.conn.executemany("INSERT INTO audit_changes VALUES (?, ?, ?, ?, ?)", changes)
+        self.conn.commit()
+        self.files += len(self.pending)
+        self.changes += len(changes)
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+        if self.files:
+            logging.info(f"修改审计: 记录 {self.files} 个文件的 {self.changes} 处修改。")
+
+
+class AhoCorasick:
+    """多模式字符串匹配自动机：一次扫描文本即可找出所有出现的模式，耗时与模式数量无关"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            self.output[state] = self.output[state] + (pattern,)
+        # 按层次（BFS）建立失配指针，并合并后缀模式的输出
+        queue = deque(self.goto[0].values())  # 第一层的失配指针均指向根
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """返回文本中出现的所有模式"""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+_phi_matcher = None  # 验证工作进程中的匹配自动机
+
+
+def init_phi_worker(matcher):
+    """验证工作进程初始化：自动机只传递一次"""
+    global _phi_matcher
+    _phi_matcher = matcher
+
+
+def element_text(elem):
+    """将字符串类元素的值转为用于匹配的小写文本"""
+    value = elem.value
+    if isinstance(value, bytes):
+        value = value[:65536].decode("utf-8", "ignore")
+    elif elem.VM > 1:
+        value = "\\".join(str(item) for item in value)
+    return str(value).casefold()
+
+
+def scan_files_for_phi(items, matcher=None):
+    """只读文件头，扫描所有字符串类元素（含序列内），返回 [(文件, 标签, 关键字, 命中模式)]
+
+    items 为 [(显示路径, 文件路径或文件内容 bytes)]。
+    """
+    import pydicom
+
+    matcher = matcher or _phi_matcher
+    leaks = []
+    for display_path, source in items:
+        try:
+            fp = io.BytesIO(source) if isinstance(source, bytes) else source
+            ds = pydicom.dcmread(fp, stop_before_pixels=True, force=True)
+        except Exception as e:
+            leaks.append((display_path, "", "读取失败", f"{type(e).__name__}: {e}"))
+            continue
+
+        def check(dataset, elem):
+            if elem.VR in PHI_SCAN_VRS and elem.value:
+                for pattern in matcher.search(element_text(elem)):
+                    leaks.append((display_path, str(elem.tag), elem.keyword or elem.name, pattern))
+
+        ds.walk(check)
+    return leaks
+
+
+def verify_outputs(output_root, patterns, workers=WORKER_COUNT, progress=None):
+    """并行扫描输出中是否残留原始身份标识，返回泄漏列表，并写出 CSV 报告"""
+    matcher = AhoCorasick(set(patterns))
+    all_files = collect_dicom_files(output_root)
+    total_files = len(all_files)
+    batches = [all_files[i:i + PHI_SCAN_BATCH] for i in range(0, total_files, PHI_SCAN_BATCH)]
+    # 压缩包成员由主进程读出后传递；所有批次共用一个读取器，TAR 只需顺序解压一遍
+    archive_reader = ArchiveReader()
+
+    def batch_items(batch):
+        # 普通文件由工作进程自行读取文件头
+        return [(file_path, read_file_bytes(file_path, archive_reader=archive_reader)
+                 if file_path in archive_index else file_path) for file_path in batch]
+
+    leaks = []
+    done = 0
+
+    def finish(batch, batch_leaks):
+        nonlocal done
+        leaks.extend(batch_leaks)
+        done += len(batch)
+        if progress is not None:
+            progress(done, total_files)
+
+    # 按提交顺序收取结果，在途批数受限，读出的压缩包成员不会全部积压在主进程内存中
+    in_flight = deque()
+    max_in_flight = max(1, workers) * 2
+    executor = None
+    try:
+        if workers <= 0:
+            for batch in batches:
+                finish(batch, scan_files_for_phi(batch_items(batch), matcher))
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_phi_worker, initargs=(matcher,))
+            for batch in batches:
+                in_flight.append((batch, executor.submit(scan_files_for_phi, batch_items(batch))))
+                while len(in_flight) >= max_in_flight:
+                    batch, future = in_flight.popleft()
+                    finish(batch, future.result())
+            while in_flight:
+                batch, future = in_flight.popleft()
+                finish(batch, future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        archive_reader.close()
+
+    report_path = os.path.join(log_folder or ".", PHI_REPORT_FILE)
+    with AtomicWriter().open(report_path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["文件", "标签", "关键字", "命中标识"])
+        writer.writerows(leaks)
+    for file_path, tag, keyword, pattern in leaks:
+        logging.warning(f"PHI 泄漏: {file_path} {tag} {keyword} 包含 {pattern!r}")
+    logging.info(f"PHI 验证完成：扫描 {total_files} 个文件、{len(matcher.output)} 个自动机状态，"
+                 f"发现 {len(leaks)} 处问题，报告已保存到 {report_path}")
+    return leaks
+
+
+class StoreReceiver:
+    """C-STORE 接收端：收到的实例在内存中交给工作进程匿名化后写出，原始数据不落盘
+
+    pynetdicom 为每个关联启动一个线程调用 handle_store，多个关联的实例并发进入工作进程池；
+    输出端和运行状态库只在单独的写出线程中使用。
+    """
+
+    def __init__(self, output_root, options):
+        self.executor = create_executor(options.get("workers", WORKER_COUNT))
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scp-writer")
+        self.sink = create_output_sink(output_root, options.get("output_format"), options.get("durable", False))
+        self.identifier_store = self.writer.submit(IdentifierStore, output_root).result() \
+            if options.get("collect_identifiers") else None
+        self.audit_log = self.writer.submit(AuditLog).result() if options.get("audit") else None
+        self.task_options = anonymization_task_options(options)
+        self.stats = {"received": 0, "written": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def write(self, calling_ae, sop_instance_uid, output_bytes, summary):
+        """在写出线程中执行：输出路径为 原始检查哈希/原始实例哈希.dcm，不暴露原 UID"""
+        if self.identifier_store is not None:
+            self.identifier_store.add(summary.pop("identifiers", ()))
+        study_uid = summary.get("OriginalStudyInstanceUID")
+        relative_path = os.path.join(study_archive_name(study_uid),
+                                     hashlib.sha1(str(sop_instance_uid).encode("ascii", "ignore")).hexdigest()[:16] + ".dcm")
+        output_path = self.sink.write(relative_path, output_bytes, study_uid)
+        if self.audit_log is not None:
+            self.audit_log.add(f"C-STORE {calling_ae}", output_path, summary.pop("audit", ()))
+        return output_path
+
+    def handle_store(self, event):
+        """EVT_C_STORE 处理函数，返回 C-STORE 状态码"""
+        self.count("received")
+        calling_ae = event.assoc.requestor.ae_title
+        sop_instance_uid = event.request.AffectedSOPInstanceUID
+        try:
+            output_bytes, summary = self.executor.submit(
+                anonymize_bytes, event.encoded_dataset(), self.task_options).result()
+        except Exception as e:
+            self.count("failed")
+            logging.error(f"匿名化来自 {calling_ae} 的实例时出错: {e}")
+            return 0xC210  # 无法理解的数据集
+        try:
+            output_path = self.writer.submit(self.write, calling_ae, sop_instance_uid, output_bytes, summary).result()
+        except Exception as e:
+            self.count("failed")
+            logging.error(f"写出来自 {calling_ae} 的实例时出错: {e}")
+            return 0xA700  # 资源不足
+        self.count("written")
+        logging.info(f"已接收来自 {calling_ae} 的实例并匿名化保存到 {output_path}")
+        return 0x0000
+
+    def close(self):
+        self.executor.shutdown()
+
+        def close_outputs():
+            self.sink.close()
+            if self.identifier_store is not None:
+                self.identifier_store.close()
+            if self.audit_log is not None:
+                self.audit_log.close()
+
+        self.writer.submit(close_outputs).result()
+        self.writer.shutdown()
+        logging.info(f"C-STORE 接收结束：收到 {self.stats['received']} 个实例，写出 {self.stats['written']} 个，"
+                     f"失败 {self.stats['failed']} 个")
+
+
+def start_store_scp(output_root, options, port=SCP_DEFAULT_PORT, ae_title=SCP_DEFAULT_AE_TITLE, host="",
+                    max_associations=SCP_MAX_ASSOCIATIONS):
+    """启动 Storage SCP（非阻塞），返回 (server, receiver)；停止时先 server.shutdown() 再 receiver.close()"""
+    from pynetdicom import AE, ALL_TRANSFER_SYNTAXES, StoragePresentationContexts, evt
+    from pynetdicom.sop_class import Verification
+
+    receiver = StoreReceiver(output_root, options)
+    ae = AE(ae_title=ae_title)
+    ae.maximum_associations = max_associations
+    ae.add_supported_context(Verification)
+    # 接受所有传输语法，压缩数据按 ts_policy 在工作进程中处理
+    for context in StoragePresentationContexts:
+        ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+    server = ae.start_server((host, port), block=False, evt_handlers=[(evt.EVT_C_STORE, receiver.handle_store)])
+    logging.info(f"C-STORE 接收端已启动：{ae_title}@{host or '0.0.0.0'}:{port}，输出到 {output_root}")
+    return server, receiver
+
+
+_service_state = {}  # HTTP 服务工作进程中预加载的选项和序列共享上下文
+
+
+def init_service_worker(task_options):
+    """HTTP 服务工作进程初始化：预先解析规则、导入模块并载入日期偏移缓存，请求到来时直接复用"""
+    import pydicom  # noqa: F401
+
+    _service_state["options"] = task_options
+    _service_state["context"] = rule_context(task_options)
+    if task_options.get("date_shift"):
+        _date_offsets.update(get_state_conn().execute("SELECT patient_key, offset_days FROM date_shift").fetchall())
+
+
+def service_anonymize(data):
+    """在预加载的工作进程中匿名化一个实例；序列模板跨请求保留"""
+    context = _service_state["context"]
+    if len(context["templates"]) > SERVICE_TEMPLATE_CACHE:
+        context["templates"].clear()
+    return anonymize_bytes(data, _service_state["options"], context)
+
+
+class ServiceMetrics:
+    """服务指标（Prometheus 文本格式）：请求数、文件数、字节数、并发数和请求耗时直方图"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = {}  # 状态码 -> 请求数
+        self.counters = {"files": 0, "files_failed": 0, "bytes_received": 0, "bytes_sent": 0}
+        self.buckets = [0] * len(SERVICE_LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.in_flight = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                if key == "in_flight":
+                    self.in_flight += value
+                else:
+                    self.counters[key] += value
+
+    def observe(self, status, seconds):
+        with self.lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+            self.latency_sum += seconds
+            for index, bound in enumerate(SERVICE_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[index] += 1
+
+    def render(self):
+        with self.lock:
+            uptime = time.monotonic() - self.started
+            total = sum(self.requests.values())
+            lines = ["# TYPE dicom_service_requests_total counter"]
+            lines += [f'dicom_service_requests_total{{status="{status}"}} {count}'
+                      for status, count in sorted(self.requests.items())]
+            for key, value in self.counters.items():
+                lines += [f"# TYPE dicom_service_{key}_total counter", f"dicom_service_{key}_total {value}"]
+            lines += ["# TYPE dicom_service_in_flight gauge", f"dicom_service_in_flight {self.in_flight}",
+                      "# TYPE dicom_service_uptime_seconds gauge", f"dicom_service_uptime_seconds {uptime:.3f}",
+                      "# TYPE dicom_service_files_per_second gauge",
+                      f"dicom_service_files_per_second {self.counters['files'] / uptime if uptime else 0:.3f}",
+                      "# TYPE dicom_service_request_seconds histogram"]
+            lines += [f'dicom_service_request_seconds_bucket{{le="{bound}"}} {count}'
+                      for bound, count in zip(SERVICE_LATENCY_BUCKETS, self.buckets)]
+            lines += [f'dicom_service_request_seconds_bucket{{le="+Inf"}} {total}',
+                      f"dicom_service_request_seconds_sum {self.latency_sum:.6f}",
+                      f"dicom_service_request_seconds_count {total}"]
+        return "\n".join(lines) + "\n"
+
+
+class ChunkedWriter:
+    """以 HTTP 分块传输编码写出响应体，供 zipfile 流式写出（不可 seek，zipfile 使用数据描述符）"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.written = 0
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n" % len(data) + bytes(data) + b"\r\n")
+            self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class AnonymizationService:
+    """本地 HTTP 匿名化服务：持久的工作进程池（预加载规则和日期偏移），限制并发请求数
+
+    POST /anonymize 的请求体为单个 DICOM 文件时返回匿名化后的文件；为 ZIP 时逐个成员匿名化，
+    按成员顺序以分块传输流式返回 ZIP，处理失败的成员记入末尾的 errors.csv。GET /metrics 返回指标。
+    结果直接返回给客户端，本地没有可供 PHI 验证的输出，因此不收集原始标识；修改审计在单独的写出线程中登记。
+    """
+
+    def __init__(self, options, max_concurrent=SERVICE_MAX_CONCURRENT):
+        self.task_options = anonymization_task_options(options)
+        self.workers = options.get("workers", WORKER_COUNT)
+        if self.workers <= 0:
+            init_service_worker(self.task_options)
+            self.executor = InlineExecutor()
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_service_worker,
+                                                initargs=(self.task_options,))
+            # 启动时即创建全部工作进程并完成预加载（也避免工作进程继承随后创建的监听套接字）
+            for future in [self.executor.submit(int) for _ in range(self.workers)]:
+                future.result()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="service-writer")
+        self.audit_log = self.writer.submit(AuditLog).result() if options.get("audit") else None
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.metrics = ServiceMetrics()
+
+    def record(self, source, summary):
+        """修改审计交给写出线程登记"""
+        if self.audit_log is not None:
+            self.writer.submit(self.audit_log.add, source, "", summary.pop("audit", ()))
+
+    def anonymize(self, data):
+        """匿名化一个实例"""
+        output_bytes, summary = self.executor.submit(service_anonymize, data).result()
+        self.record("HTTP", summary)
+        return output_bytes
+
+    def stream_zip(self, data, out):
+        """逐个成员匿名化并按顺序写入流式 ZIP；在途成员数受限以控制内存，返回 (成功数, 失败数)"""
+        in_flight = deque()
+        max_in_flight = max(1, self.workers) * 2
+        errors = []
+        written = 0
+        with zipfile.ZipFile(io.BytesIO(data)) as source, \
+                zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as target:
+
+            def finish(name, future):
+                nonlocal written
+                try:
+                    output_bytes, summary = future.result()
+                except Exception as e:
+                    errors.append((name, type(e).__name__, str(e)))
+                    return
+                self.record(f"HTTP {name}", summary)
+                target.writestr(name, output_bytes)
+                written += 1
+
+            for info in source.infolist():
+                if info.is_dir():
+                    continue
+                in_flight.append((info.filename, self.executor.submit(service_anonymize, source.read(info))))
+                while len(in_flight) >= max_in_flight:
+                    finish(*in_flight.popleft())
+            while in_flight:
+                finish(*in_flight.popleft())
+            if errors:
+                buffer = io.StringIO()
+                table = csv.writer(buffer)
+                table.writerow(("成员", "异常类型", "错误信息"))
+                table.writerows(errors)
+                target.writestr("errors.csv", buffer.getvalue().encode("utf-8-sig"))
+        return written, len(errors)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.audit_log is not None:
+            self.writer.submit(self.audit_log.close).result()
+        self.writer.shutdown()
+
+
+def service_handler(service):
+    """为服务构造请求处理类"""
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.info(f"{self.client_address[0]} {format % args}")
+
+        def send_body(self, status, body, content_type="text/plain; charset=utf-8"):
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if status == 503:
+                self.send_header("Retry-After", "1")
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+            return len(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self.send_body(200, service.metrics.render(), "text/plain; version=0.0.4")
+            else:
+                self.send_body(404, "未知路径\n")
+
+        def do_POST(self):
+            start = time.perf_counter()
+            status = self.handle_anonymize()
+            service.metrics.observe(status, time.perf_counter() - start)
+
+        def handle_anonymize(self):
+            if self.path.split("?")[0] != "/anonymize":
+                self.send_body(404, "未知路径\n")
+                return 404
+            length = self.headers.get("Content-Length")
+            if length is None or not length.isdigit():
+                self.send_body(411, "需要 Content-Length\n")
+                return 411
+            if int(length) > SERVICE_MAX_BODY:
+                self.close_connection = True
+                self.send_body(413, f"请求体超过 {SERVICE_MAX_BODY} 字节\n")
+                return 413
+            # 先取得处理名额再读取请求体，排队的请求不占用内存；未读取请求体时不能复用连接
+            if not service.slots.acquire(timeout=SERVICE_QUEUE_TIMEOUT):
+                self.close_connection = True
+                self.send_body(503, "服务繁忙，请稍后重试\n")
+                return 503
+            service.metrics.add(in_flight=1)
+            try:
+                data = self.rfile.read(int(length))
+                service.metrics.add(bytes_received=len(data))
+                if data[:4] == b"PK\x03\x04":
+                    return self.respond_zip(data)
+                try:
+                    output_bytes = service.anonymize(data)
+                except Exception as e:
+                    service.metrics.add(files_failed=1)
+                    logging.error(f"匿名化来自 {self.client_address[0]} 的文件时出错: {e}")
+                    self.send_body(422, f"无法匿名化: {type(e).__name__}: {e}\n")
+                    return 422
+                service.metrics.add(files=1, bytes_sent=self.send_body(200, output_bytes, "application/dicom"))
+                return 200
+            finally:
+                service.metrics.add(in_flight=-1)
+                service.slots.release()
+
+        def respond_zip(self, data):
+            if not zipfile.is_zipfile(io.BytesIO(data)):
+                self.send_body(400, "无法读取 ZIP\n")
+                return 400
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            out = ChunkedWriter(self.wfile)
+            try:
+                written, failed = service.stream_zip(data, out)
+            except Exception as e:
+                # 响应已开始，只能中断连接让客户端察觉
+                logging.error(f"流式返回 ZIP 时出错: {e}")
+                self.close_connection = True
+                return 500
+            out.close()
+            service.metrics.add(files=written, files_failed=failed, bytes_sent=out.written)
+            logging.info(f"ZIP 请求完成：匿名化 {written} 个成员，失败 {failed} 个")
+            return 200
+
+    return Handler
+
+
+def start_anonymization_service(options, host=SERVICE_DEFAULT_HOST, port=SERVICE_DEFAULT_PORT,
+                                max_concurrent=SERVICE_MAX_CONCURRENT):
+    """启动 HTTP 匿名化服务（非阻塞），返回 (server, service)；停止时先 server.shutdown() 再 service.close()"""
+    from http.server import ThreadingHTTPServer
+
+    service = AnonymizationService(options, max_concurrent)
+    server = ThreadingHTTPServer((host, port), service_handler(service))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="http-service", daemon=True).start()
+    logging.info(f"HTTP 匿名化服务已启动：http://{host}:{server.server_address[1]}/anonymize，"
+                 f"指标见 /metrics，最多同时处理 {max_concurrent} 个请求")
+    return server, service
+
+
+def scan_tree(root):
+    """返回目录树中所有候选输入文件（见 is_dicom_candidate）的 {路径: (mtime_ns, size)}"""
+    snapshot = {}
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and is_dicom_candidate(entry.name):
+                        stat = entry.stat(follow_symlinks=False)
+                        snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            continue
+    return snapshot
+
+
+class PollingWatcher:
+    """定期扫描目录树，比较 mtime/大小找出变化的文件（不支持 inotify 时使用）"""
+
+    def __init__(self, root, poll_interval=WATCH_POLL_INTERVAL):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.snapshot = {}
+
+    def wait(self, timeout=None):
+        """等待至多 timeout 秒，返回变化的文件路径"""
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        snapshot = scan_tree(self.root)
+        changed = [path for path, signature in snapshot.items() if self.snapshot.get(path) != signature]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """基于 Linux inotify 的目录树监视：文件写完（关闭或移入）时才上报，空闲时阻塞不占用 CPU"""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.watches = {}
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        """监视目录及其子目录，返回监视建立前已存在的文件"""
+        existing = []
+        for directory, dirnames, filenames in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"无法监视 {directory}")
+            self.watches[wd] = directory
+            existing.extend(os.path.join(directory, name) for name in filenames if is_dicom_candidate(name))
+        return existing
+
+    def wait(self, timeout=None):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        changed = []
+        buffer = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，重新扫描整个目录树
+                logging.warning("inotify 事件队列溢出，重新扫描输入文件夹。")
+                changed.extend(scan_tree(self.root))
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # 新建或移入的子目录：加入监视，并补上其中已有的文件
+                changed.extend(self.add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_dicom_candidate(os.path.basename(path)):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_folder_watcher(root, poll_interval=WATCH_POLL_INTERVAL):
+    """优先使用 inotify，不可用时（如 Windows）退回轮询；返回 (watcher, 已存在的文件)"""
+    try:
+        watcher = InotifyWatcher(root)
+        return watcher, list(scan_tree(root))
+    except (OSError, AttributeError, TypeError) as e:
+        logging.info(f"inotify 不可用（{e}），改为每 {poll_interval}s 轮询。")
+        watcher = PollingWatcher(root, poll_interval)
+        watcher.snapshot = scan_tree(root)
+        return watcher, list(watcher.snapshot)
+
+
+class WatchState:
+    """监视模式文件登记（运行状态库中的 watch_processed / watch_failed 表），重启后不重复处理
+
+    处理失败的文件（如不完整的压缩包）同样按 (mtime_ns, size) 登记，文件变化后才重试。
+    """
+
+    TABLES = ("watch_processed", "watch_failed")
+
+    def __init__(self, db_path=None):
+        self.conn = open_state_db(db_path)
+        self.seen = {}
+        for table in self.TABLES:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL)")
+            self.seen[table] = {row[0]: (row[1], row[2]) for row in self.conn.execute(f"SELECT * FROM {table}")}
+        self.conn.commit()
+
+    def signature(self, path):
+        """文件未处理过或处理后又被修改时返回其 (mtime_ns, size)，否则返回 None"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        path = os.path.abspath(path)
+        return None if any(seen.get(path) == signature for seen in self.seen.values()) else signature
+
+    def mark(self, signatures, failed=False):
+        table, other = self.TABLES[::-1] if failed else self.TABLES
+        rows = [(os.path.abspath(path), *signature) for path, signature in signatures.items()]
+        self.conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)", rows)
+        self.conn.executemany(f"DELETE FROM {other} WHERE path = ?", [row[:1] for row in rows])
+        self.conn.commit()
+        self.seen[table].update((row[0], row[1:]) for row in rows)
+        for row in rows:
+            self.seen[other].pop(row[0], None)
+
+    def close(self):
+        self.conn.close()
+
+
+def study_key(file_path):
+    """只读文件头取 StudyInstanceUID 作为分组键；读取失败时按所在目录分组"""
+    import pydicom
+
+    try:
+        header = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["StudyInstanceUID"])
+        if header.get("StudyInstanceUID"):
+            return str(header.StudyInstanceUID)
+    except Exception:
+        pass
+    return "dir:" + os.path.dirname(file_path)
+
+
+def watch_folder(input_root, output_root, options, quiet_period=WATCH_QUIET_PERIOD,
+                 poll_interval=WATCH_POLL_INTERVAL, stop_event=None, idle_wakeup=WATCH_IDLE_WAKEUP):
+    """监视输入文件夹，按检查增量匿名化新到达的文件
+
+    只处理 collect_dicom_files 同样接受的文件（.dcm 与压缩包，压缩包展开为成员）。
+    每个新文件按 StudyInstanceUID 归入待处理检查（压缩包单独成组），检查在最后一个文件到达
+    quiet_period 秒后整体处理；处理过的文件（路径、mtime、大小）登记在运行状态库中，
+    失败的文件单独登记，文件变化后才重试。stop_event 被设置后在下一次唤醒时退出。
+    """
+    watcher, changed = create_folder_watcher(input_root, poll_interval)
+    state = WatchState()
+    pending = {}  # 检查键 -> {"files": {路径: (签名, DICOM 文件列表)}, "deadline": 截止时间}
+    logging.info(f"开始监视 {input_root}（{type(watcher).__name__}，静默期 {quiet_period}s）。")
+    try:
+        while stop_event is None or not stop_event.is_set():
+            now = time.monotonic()
+            for file_path in changed:
+                signature = state.signature(file_path)
+                if signature is None:
+                    continue
+                if is_archive(file_path):
+                    try:
+                        members = list_archive_members(file_path)
+                    except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+                        # 多为尚未复制完的压缩包，文件变化后再试
+                        logging.error(f"读取压缩包 {file_path} 时出错: {e}")
+                        state.mark({file_path: signature}, failed=True)
+                        continue
+                    key = "archive:" + file_path
+                else:
+                    members = [file_path]
+                    key = study_key(file_path)
+                study = pending.setdefault(key, {"files": {}, "deadline": now})
+                study["files"][file_path] = (signature, members)
+                study["deadline"] = now + quiet_period
+            for key in [key for key, study in pending.items() if study["deadline"] <= now]:
+                files = pending.pop(key)["files"]
+                # 压缩包成员保持包内顺序，流式读取 TAR 时无需暂存
+                dicom_files = [member for file_path in sorted(files) for member in files[file_path][1]]
+                logging.info(f"检查已静默，开始处理 {len(dicom_files)} 个新文件。")
+                stats = run_anonymization(dicom_files, input_root, output_root, dict(options, manifest=True))
+                # 文件（压缩包则为其全部成员）都完成时登记为已处理，否则登记为失败，均在文件变化后才重新处理
+                statuses = {relative_path: status for relative_path, status, _ in stats["manifest"]}
+                done, failed = {}, {}
+                for file_path, (signature, members) in files.items():
+                    finished = all(statuses.get(relative_source_path(member, input_root)) in WATCH_DONE_STATUSES
+                                   for member in members)
+                    (done if finished else failed)[file_path] = signature
+                state.mark(done)
+                if failed:
+                    state.mark(failed, failed=True)
+                    logging.warning(f"{len(failed)} 个文件处理失败，文件变化后重试。")
+                logging.info(f"处理完成：写出 {stats['written']} 个，失败 {stats['failed']} 个。")
+            timeout = idle_wakeup
+            if pending:
+                timeout = min(timeout, max(0.0, min(study["deadline"] for study in pending.values()) - time.monotonic()))
+            changed = watcher.wait(timeout)
+    finally:
+        watcher.close()
+        state.close()
+
+
+def warm_up_imports():
+    """在后台线程中预先导入 pydicom/numpy/PIL 并检测解码器，首个任务无需等待"""
+    start = time.perf_counter()
+    import pydicom  # noqa: F401
+    import numpy  # noqa: F401
+    from PIL import Image  # noqa: F401
+    available_pixel_handlers()
+    logging.info(f"后台模块加载完成，耗时 {time.perf_counter() - start:.2f}s")
+
+
+def on_window_shown():
+    """窗口显示后再加载可选子系统"""
+    logging.info(f"窗口已显示，启动耗时 {time.perf_counter() - startup_time:.2f}s")
+    threading.Thread(target=warm_up_imports, name="warm-up", daemon=True).start()
+
+
+def update_progress(current, total, progress_label):
+    """更新进度信息"""
+    progress = int((current / total) * 100)
+    progress_label.config(text=f"处理进度: {progress}% 完成")
+    progress_label.update()
+
+
+def modify_dicom_tags():
+    """修改 DICOM 标签"""
+    if not input_folder or not dicom_output_folder:
+        messagebox.showwarning("警告", "请先选择输入文件夹和 DICOM 输出文件夹！")
+        logging.warning("未选择输入文件夹或 DICOM 输出文件夹。")
+        return
+
+    logging.info("DICOM 文件匿名化处理开始。")
+    start_time = datetime.now()
+
+    # 获取所有 DICOM 文件
+    all_files = collect_dicom_files(input_folder)
+
+    total_files = len(all_files)
+    logging.info(f"总共找到 {total_files} 个 DICOM 文件。")
+
+    # 创建进度窗口
+    progress_window = tk.Toplevel(root)
+    progress_window.title("处理进度")
+    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
+    progress_label.pack(pady=20)
+
+    options = {
+        "rules": dict(tags_to_modify),
+        "ts_policy": TRANSFER_SYNTAX_POLICIES.get(transfer_syntax_option.get(), "preserve"),
+        "output_format": OUTPUT_FORMATS.get(output_format.get()),
+        "write_dicomdir": write_dicomdir.get(),
+        "dedup_mode": DEDUP_MODES.get(dedup_option.get()),
+        "mask_rules": app_config.get("pixel_mask_rules", []) if mask_burned_in.get() else [],
+        "date_shift": shift_dates_option.get(),
+        "audit": audit_changes.get(),
+        "replace_uids": replace_uids_option.get(),
+        "collect_identifiers": collect_phi_identifiers.get(),
+        "durable": durable_writes.get(),
+        "skip_existing": skip_existing_outputs.get(),
+        "workers": WORKER_COUNT,
+    }
+    run_anonymization(all_files, input_folder, dicom_output_folder, options,
+                      lambda current, total: update_progress(current, total, progress_label))
+
+    end_time = datetime.now()
+    logging.info(f"DICOM 文件匿名化处理完成。耗时: {end_time - start_time}")
+    progress_window.destroy()
+    messagebox.showinfo("完成", "DICOM 文件匿名化处理完成！")
+
+
+def verify_phi():
+    """验证 DICOM 输出中是否残留匿名化前收集的原始身份标识"""
+    if not dicom_output_folder:
+        messagebox.showwarning("警告", "请先选择 DICOM 输出文件夹！")
+        logging.warning("未选择 DICOM 输出文件夹。")
+        return
+    identifier_store = IdentifierStore(dicom_output_folder)
+    patterns = identifier_store.patterns()
+    identifier_store.close()
+    if not patterns:
+        messagebox.showwarning("警告", "尚未收集到该输出目录的原始身份标识，请勾选“收集标识供 PHI 验证”后执行匿名化！")
+        return
+
+    logging.info(f"PHI 验证开始，共 {len(patterns)} 个原始标识。")
+    start_time = datetime.now()
+
+    # 创建进度窗口
+    progress_window = tk.Toplevel(root)
+    progress_window.title("处理进度")
+    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
+    progress_label.pack(pady=20)
+
+    leaks = verify_outputs(dicom_output_folder, patterns,
+                           progress=lambda current, total: update_progress(current, total, progress_label))
+
+    end_time = datetime.now()
+    logging.info(f"PHI 验证完成。耗时: {end_time - start_time}")
+    progress_window.destroy()
+    if leaks:
+        messagebox.showwarning("完成", f"发现 {len(leaks)} 处可能的 PHI 残留，详见 {PHI_REPORT_FILE}！")
+    else:
+        messagebox.showinfo("完成", "PHI 验证完成，未发现残留！")
+
+
+def pixel_qc_columns():
+    """质控结果表的列名"""
+    edges = PIXEL_QC_HU_EDGES
+    bins = [f"HU<{edges[0]}"] + [f"HU[{low},{high})" for low, high in zip(edges, edges[1:])] + [f"HU>={edges[-1]}"]
+    return ["文件", "行", "列", "帧数", "最小值", "最大值", "均值", "HU最小", "HU最大", "HU均值",
+            "饱和比例", "空白帧数", *bins]
+
+
+def pixel_qc_stats(ds, image):
+    """在已解码的像素数组上计算质控统计，返回与 pixel_qc_columns() 对应的值（不含文件列）
+
+    全部为向量化运算且不生成 HU 浮点副本：逐帧最小/最大值同时给出全局极值和空白帧（帧内无变化），
+    HU 统计由存储值按 RescaleSlope/Intercept 线性换算，直方图将 HU 边界换算为存储值后统计。
+    """
+    import numpy as np
+
+    frame_count = int(ds.get("NumberOfFrames", 1) or 1)
+    frames = image.reshape(frame_count, -1)
+    frame_min = frames.min(axis=1)
+    frame_max = frames.max(axis=1)
+    low, high = frame_min.min().item(), frame_max.max().item()
+    mean = frames.mean(dtype=np.float64)
+    blank_frames = int(np.count_nonzero(frame_min == frame_max))
+    # 达到存储位深上限（有符号时还包括下限）的像素视为饱和
+    bits_stored = int(ds.get("BitsStored", image.dtype.itemsize * 8))
+    if ds.get("PixelRepresentation", 0) == 1:
+        saturated = np.count_nonzero(image >= 2 ** (bits_stored - 1) - 1) + np.count_nonzero(image <= -2 ** (bits_stored - 1))
+    else:
+        saturated = np.count_nonzero(image >= 2 ** bits_stored - 1)
+    row = [ds.get("Rows", ""), ds.get("Columns", ""), frame_count, low, high, round(mean, 3)]
+    if "RescaleSlope" in ds or "RescaleIntercept" in ds:
+        slope = float(ds.get("RescaleSlope", 1) or 1)
+        intercept = float(ds.get("RescaleIntercept", 0) or 0)
+        hu_low, hu_high = sorted((low * slope + intercept, high * slope + intercept))
+        edges = np.sort((np.asarray(PIXEL_QC_HU_EDGES, dtype=np.float64) - intercept) / slope)
+        counts, _ = np.histogram(image, bins=np.concatenate(([-np.inf], edges, [np.inf])))
+        if slope < 0:
+            counts = counts[::-1]
+        row += [round(hu_low, 3), round(hu_high, 3), round(mean * slope + intercept, 3)]
+    else:
+        counts = [""] * (len(PIXEL_QC_HU_EDGES) + 1)
+        row += ["", "", ""]
+    row += [round(saturated / image.size, 6), blank_frames, *(int(count) if count != "" else "" for count in counts)]
+    return row
+
+
+def is_transient_error(e):
+    """网络盘抖动、设备忙等可重试的瞬时 I/O 错误"""
+    return isinstance(e, ConnectionError) or (isinstance(e, OSError) and e.errno in TRANSIENT_IO_ERRNOS)
+
+
+def task_error(e):
+    """异常的可传递描述：(异常类名, 信息, 是否可重试)"""
+    return type(e).__name__, str(e), is_transient_error(e)
+
+
+class TaskSupervisor:
+    """在受监督的工作进程中逐个执行任务
+
+    每个工作进程通过管道接收任务，同一时间只执行一个。任务超过 timeout 秒未返回时结束并重启
+    该工作进程，工作进程崩溃（如解码器段错误）时同样重启，两种情况都只影响当前任务。
+    target(conn, *args) 循环接收任务，收到 None 时退出，每个任务回送 (错误, 结果)。
+    """
+
+    def __init__(self, target, args=(), workers=WORKER_COUNT, timeout=TASK_TIMEOUT):
+        self.target = target
+        self.args = args
+        self.timeout = timeout
+        self.idle = [self._spawn() for _ in range(max(1, workers))]
+        self.busy = {}  # 连接 -> (进程, 任务标识, 截止时间)
+        self.restarts = 0
+
+    def _spawn(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=self.target, args=(child_conn, *self.args), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _restart(self, process, conn):
+        process.kill()
+        process.join()
+        conn.close()
+        self.restarts += 1
+        self.idle.append(self._spawn())
+
+    def submit(self, task_id, task):
+        """将任务交给一个空闲的工作进程，调用前应确认 self.idle 非空"""
+        process, conn = self.idle.pop()
+        conn.send(task)
+        self.busy[conn] = (process, task_id, time.monotonic() + self.timeout)
+
+    def collect(self, max_wait=None):
+        """等待任务结束或超时，返回 [(任务标识, 错误, 结果)]；错误为 task_error() 的格式或 None"""
+        from multiprocessing.connection import wait
+
+        timeout = max(0.0, min(deadline for _, _, deadline in self.busy.values()) - time.monotonic())
+        if max_wait is not None:
+            timeout = min(timeout, max(0.0, max_wait))
+        results = []
+        for conn in wait(list(self.busy), timeout):
+            process, task_id, _ = self.busy.pop(conn)
+            try:
+                error, result = conn.recv()
+            except (EOFError, OSError):
+                process.join(1)
+                results.append((task_id, ("WorkerCrashed", f"工作进程意外退出（退出码 {process.exitcode}）", False), None))
+                self._restart(process, conn)
+                continue
+            self.idle.append((process, conn))
+            results.append((task_id, error, result))
+        now = time.monotonic()
+        for conn, (process, task_id, deadline) in list(self.busy.items()):
+            if deadline <= now:
+                del self.busy[conn]
+                results.append((task_id, ("TimeoutError", f"超过 {self.timeout} 秒未完成，已结束工作进程", False), None))
+                self._restart(process, conn)
+        return results
+
+    def close(self):
+        for process, conn in self.idle:
+            with contextlib.suppress(OSError):
+                conn.send(None)
+        for conn, (process, _, _) in self.busy.items():
+            process.kill()
+        for process, conn in self.idle + [(process, conn) for conn, (process, _, _) in self.busy.items()]:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            conn.close()
+        self.idle, self.busy = [], {}
+
+
+def output_stem(name):
+    """输出文件名的主干：去掉 .dcm/.dicom 后缀（不区分大小写）
+
+    DICOMDIR 引用的文件通常没有后缀，以 UID 命名的文件名中又含有点号，因此不使用 splitext。
+    """
+    for suffix in (".dcm", ".dicom"):
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def png_output_path(file_path, input_root, output_root):
+    relative_path = relative_source_path(file_path, input_root)
+    output_dir = os.path.join(output_root, os.path.dirname(relative_path))
+    return os.path.join(output_dir, output_stem(os.path.basename(file_path)) + ".png")
+
+
+def render_png(data, output_path, grayscale, writer):
+    """解码一个 DICOM 文件并保存为 PNG，返回同一次解码得到的像素质控统计"""
+    import pydicom
+    import numpy as np
+    from PIL import Image
+
+    ds = pydicom.dcmread(io.BytesIO(data))
+    # 获取图像数据
+    image = decode_pixel_data(ds)
+    stats = pixel_qc_stats(ds, image)
+    if ds.PhotometricInterpretation == "MONOCHROME1":
+        image = np.amax(image) - image
+    if grayscale:
+        image = Image.fromarray(image).convert("L")  # 转换为灰度图像
+    else:
+        image = Image.fromarray(image)
+    # 保存 PNG 文件
+    with writer.open(output_path, "wb") as f:
+        image.save(f, format="PNG")
+    return stats
+
+
+def png_worker(conn, grayscale):
+    """PNG 导出的工作进程：逐个接收 (输出路径, 文件内容)，回送 (错误, 质控统计)"""
+    writer = AtomicWriter()
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        output_path, data = task
+        try:
+            conn.send((None, render_png(data, output_path, grayscale, writer)))
+        except Exception as e:
+            conn.send((task_error(e), None))
+    conn.close()
+
+
+def export_png(all_files, input_root, output_root, grayscale=True, progress=None, workers=WORKER_COUNT,
+               timeout=TASK_TIMEOUT, retries=TASK_RETRIES):
+    """将 DICOM 文件转换为 PNG，同一次解码中计算像素质控统计并写入输出目录下的结果表
+
+    解码和编码在受监督的工作进程中进行（workers 为 0 时也使用一个）：单个文件超过 timeout 秒
+    即结束并重启工作进程，读写时的瞬时 I/O 错误最多重试 retries 次，最终失败的文件以完整路径
+    和异常类型记入输出目录下的隔离清单，因此损坏的文件不会让整个导出卡住。
+    返回成功转换的文件数。
+    """
+    # 为尚未标定的传输语法选择最快的解码器
+    calibrate_pixel_handlers(all_files, timeout=timeout)
+    total_files = len(all_files)
+    writer = AtomicWriter()
+    qc_rows = {}  # 输入序号 -> 质控行，最后按输入顺序写出
+    quarantine = []
+    retry_heap = []  # (可重试时间, 输入序号, 尝试次数)
+    done = 0
+
+    def file_done(index, error=None, attempt=1):
+        nonlocal done
+        done += 1
+        if error is not None:
+            file_path = all_files[index]
+            quarantine.append((os.path.abspath(file_path), error[0], error[1], attempt))
+            logging.error(f"处理文件 {file_path} 时出错（{error[0]}，共尝试 {attempt} 次）: {error[1]}")
+        if progress is not None:
+            progress(done, total_files)
+
+    def failed(index, attempt, error):
+        if error[2] and attempt <= retries:
+            delay = TASK_RETRY_BACKOFF * 2 ** (attempt - 1)
+            logging.warning(f"文件 {all_files[index]} 出现瞬时错误（{error[0]}: {error[1]}），{delay:.1f}s 后重试")
+            heapq.heappush(retry_heap, (time.monotonic() + delay, index, attempt + 1))
+        else:
+            file_done(index, error, attempt)
+
+    def submit(index, attempt, future=None):
+        file_path = all_files[index]
+        try:
+            data = future.result() if future is not None else read_file_bytes(file_path, archive_reader=archive_reader)
+        except Exception as e:
+            failed(index, attempt, task_error(e))
+            return
+        supervisor.submit((index, attempt), (png_output_path(file_path, input_root, output_root), data))
+
+    prefetched = prefetch_files(all_files)
+    source = enumerate(prefetched)
+    archive_reader = ArchiveReader()  # 重试时重新读取压缩包成员
+    supervisor = TaskSupervisor(png_worker, (grayscale,), min(workers, total_files), timeout)
+    try:
+        exhausted = False
+        while True:
+            while supervisor.idle:
+                if retry_heap and retry_heap[0][0] <= time.monotonic():
+                    _, index, attempt = heapq.heappop(retry_heap)
+                    submit(index, attempt)
+                elif not exhausted:
+                    item = next(source, None)
+                    if item is None:
+                        exhausted = True
+                    else:
+                        index, (_, future) = item
+                        submit(index, 1, future)
+                else:
+                    break
+            next_retry = retry_heap[0][0] - time.monotonic() if retry_heap else None
+            if not supervisor.busy:
+                if next_retry is None and exhausted:
+                    break
+                time.sleep(max(0.0, next_retry or 0.0))
+                continue
+            for (index, attempt), error, stats in supervisor.collect(next_retry):
+                if error is not None:
+                    failed(index, attempt, error)
+                    continue
+                relative_path = relative_source_path(all_files[index], input_root)
+                qc_rows[index] = [relative_path, *stats]
+                output_path = png_output_path(all_files[index], input_root, output_root)
+                logging.info(f"文件 {all_files[index]} 已成功转换为 PNG 并保存到 {output_path}")
+                file_done(index)
+    finally:
+        supervisor.close()
+        archive_reader.close()
+        prefetched.close()
+    if supervisor.restarts:
+        logging.warning(f"共有 {supervisor.restarts} 次因超时或崩溃重启了工作进程。")
+
+    qc_path = os.path.join(output_root, PIXEL_QC_TABLE)
+    with writer.open(qc_path, "w", encoding="utf-8-sig", newline="") as f:
+        table = csv.writer(f)
+        table.writerow(pixel_qc_columns())
+        table.writerows(qc_rows[index] for index in sorted(qc_rows))
+    logging.info(f"像素质控统计已保存到 {qc_path}（{len(qc_rows)} 行）")
+    quarantine_path = os.path.join(output_root, QUARANTINE_TABLE)
+    if quarantine:
+        with writer.open(quarantine_path, "w", encoding="utf-8-sig", newline="") as f:
+            table = csv.writer(f)
+            table.writerow(("源文件", "异常类型", "错误信息", "尝试次数"))
+            table.writerows(quarantine)
+        logging.warning(f"{len(quarantine)} 个文件转换失败，已记入隔离清单 {quarantine_path}")
+    elif os.path.exists(quarantine_path):
+        os.remove(quarantine_path)  # 上次运行的隔离清单已不再适用
+    writer.close()
+    return len(qc_rows)
+
+
+def read_header(file_path, archive_reader, tags):
+    """只读取文件头中的指定标签；压缩包成员先读出内容"""
+    import pydicom
+
+    if file_path in archive_index:
+        data = read_file_bytes(file_path, archive_reader=archive_reader)
+        return pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True, specific_tags=tags)
+    return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=tags)
+
+
+def group_series_frames(all_files, input_root):
+    """按序列分组并按 InstanceNumber 排序，返回 {序列键: [(文件路径, 帧序号)]}；文件头并行读取"""
+    archive_reader = ArchiveReader()
+
+    def probe(file_path):
+        try:
+            return read_header(file_path, archive_reader, MOSAIC_HEADER_TAGS)
+        except Exception as e:
+            logging.error(f"读取文件头 {file_path} 时出错: {e}")
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as pool:
+            headers = list(pool.map(probe, all_files))
+    finally:
+        archive_reader.close()
+    series = {}
+    for file_path, header in zip(all_files, headers):
+        if header is None:
+            continue
+        key = str(header.get("SeriesInstanceUID") or os.path.dirname(relative_source_path(file_path, input_root)))
+        instance = header.get("InstanceNumber")
+        frames = int(header.get("NumberOfFrames", 1) or 1)
+        entries = series.setdefault(key, [])
+        entries.extend(((int(instance) if instance not in (None, "") else 0, file_path, frame), file_path, frame)
+                       for frame in range(frames))
+    return {key: [(file_path, frame) for _, file_path, frame in sorted(entries)] for key, entries in series.items()}
+
+
+def mosaic_layout(count, columns, rows=None):
+    """返回 (列数, 行数, 入选切片序号)；指定行数且切片超出格位数时均匀抽取"""
+    columns = max(1, min(columns, count))
+    if rows and count > columns * rows:
+        capacity = columns * rows
+        picks = sorted({round(i * (count - 1) / (capacity - 1)) for i in range(capacity)} if capacity > 1
+                       else {count // 2})
+        return columns, rows, picks
+    return columns, -(-count // columns), list(range(count))
+
+
+def display_window(ds, image):
+    """显示窗 (下限, 上限, 是否先按 Rescale 换算)：优先使用 WindowCenter/Width（多个窗时取第一个），
+    没有时取图像自身的最小/最大值"""
+    from pydicom.multival import MultiValue
+
+    center, width = ds.get("WindowCenter"), ds.get("WindowWidth")
+    if center is not None and width is not None:
+        center = float(center[0] if isinstance(center, MultiValue) else center)
+        width = float(width[0] if isinstance(width, MultiValue) else width)
+        return center - width / 2, center + width / 2, True
+    return float(image.min()), float(image.max()), False
+
+
+def window_to_uint8(ds, image, out, window=None):
+    """按显示窗（默认由 display_window() 决定）将像素映射到 0-255 写入 out；彩色图像取亮度"""
+    import numpy as np
+
+    image = image.astype(np.float32)
+    if image.ndim == 3:
+        image = image.mean(axis=-1)
+    low, high, rescale = window or display_window(ds, image)
+    if rescale:
+        image = image * float(ds.get("RescaleSlope", 1) or 1) + float(ds.get("RescaleIntercept", 0) or 0)
+    scale = 255.0 / (high - low) if high > low else 0.0
+    np.clip((image - low) * scale, 0, 255, out=image)
+    if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+        np.subtract(255, image, out=image)
+    out[...] = image
+
+
+def fill_tile(canvas, slot, image, ds, columns, tile):
+    """将一个切片按最近邻降采样到 tile×tile 以内，居中写入画布的第 slot 个格位"""
+    import numpy as np
+
+    height, width = image.shape[:2]
+    scale = min(tile / height, tile / width)
+    out_height, out_width = max(1, int(height * scale)), max(1, int(width * scale))
+    # 只取落在格位中的像素，降采样后的小图再做窗宽窗位映射
+    sampled = image[(np.arange(out_height) * height // out_height)[:, None], np.arange(out_width) * width // out_width]
+    y0 = slot // columns * tile + (tile - out_height) // 2
+    x0 = slot % columns * tile + (tile - out_width) // 2
+    window_to_uint8(ds, sampled, canvas[y0:y0 + out_height, x0:x0 + out_width])
+
+
+def mosaic_sources(file_paths):
+    """拼图切片的来源：普通文件传路径、ZIP 成员传 (压缩包路径, 成员名)，由工作进程逐个读取；
+    TAR 成员只能顺序解压，由主进程读出内容后传递。返回 {文件路径: 来源}"""
+    tar_members = [file_path for file_path in file_paths
+                   if file_path in archive_index and not archive_index[file_path][0].lower().endswith(".zip")]
+    sources = {file_path: archive_index.get(file_path, file_path) for file_path in file_paths}
+    sources.update((file_path, future.result()) for file_path, future in prefetch_files(tar_members))
+    return sources
+
+
+def render_mosaic(entries, output_path, columns, rows, tile):
+    """entries 为 [(来源, [(帧序号, 格位)])]，来源见 mosaic_sources
+
+    切片在工作进程中逐个读取、解码并写入画布，同时只有一个切片在内存中；整张拼图只编码一次。
+    """
+    import pydicom
+    import numpy as np
+    from PIL import Image
+
+    canvas = np.zeros((rows * tile, columns * tile), dtype=np.uint8)
+    archive_reader = ArchiveReader()
+    try:
+        for source, placements in entries:
+            if isinstance(source, bytes):
+                source = io.BytesIO(source)
+            elif isinstance(source, tuple):
+                source = io.BytesIO(archive_reader.read(*source))
+            ds = pydicom.dcmread(source)
+            image = decode_pixel_data(ds)
+            multi_frame = int(ds.get("NumberOfFrames", 1) or 1) > 1
+            for frame, slot in placements:
+                fill_tile(canvas, slot, image[frame] if multi_frame else image, ds, columns, tile)
+            del ds, image
+    finally:
+        archive_reader.close()
+    with AtomicWriter().open(output_path, "wb") as f:
+        Image.fromarray(canvas).save(f, format="PNG")
+    return output_path
+
+
+def export_mosaics(all_files, input_root, output_root, columns=MOSAIC_COLUMNS, rows=None, tile=MOSAIC_TILE_SIZE,
+                   workers=WORKER_COUNT, progress=None):
+    """为每个序列导出一张拼图 PNG（按 InstanceNumber 排列，多帧文件每帧一格）
+
+    rows 为空时行数按切片数决定，否则切片超出格位数时均匀抽取。每个序列在工作进程中
+    逐个读取切片并降采样写入预分配的画布，最后只编码一次；主进程只传递路径。返回写出的拼图数。
+    """
+    calibrate_pixel_handlers(all_files)
+    series = group_series_frames(all_files, input_root)
+    total_series = len(series)
+    logging.info(f"共 {total_series} 个序列，每个序列生成一张拼图。")
+    written = 0
+    done = 0
+    in_flight = deque()
+    max_in_flight = max(1, workers) * 2
+
+    def finish(key, future):
+        nonlocal written, done
+        done += 1
+        try:
+            output_path = future.result()
+            written += 1
+            logging.info(f"序列 {key} 的拼图已保存到 {output_path}")
+        except Exception as e:
+            logging.error(f"生成序列 {key} 的拼图时出错: {e}")
+        if progress is not None:
+            progress(done, total_series)
+
+    with create_executor(workers) as executor:
+        for key, frames in series.items():
+            series_columns, series_rows, picks = mosaic_layout(len(frames), columns, rows)
+            placements = {}
+            for slot, pick in enumerate(picks):
+                file_path, frame = frames[pick]
+                placements.setdefault(file_path, []).append((frame, slot))
+            relative_dir = os.path.dirname(relative_source_path(frames[0][0], input_root))
+            output_path = os.path.join(output_root, relative_dir, f"{key.replace(os.sep, '_')}.png")
+            try:
+                sources = mosaic_sources(list(placements))
+                entries = [(sources[file_path], file_placements) for file_path, file_placements in placements.items()]
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            else:
+                future = executor.submit(render_mosaic, entries, output_path, series_columns, series_rows, tile)
+            in_flight.append((key, future))
+            while len(in_flight) >= max_in_flight:
+                finish(*in_flight.popleft())
+        while in_flight:
+            finish(*in_flight.popleft())
+    return written
+
+
+def iter_frames(ds):
+    """逐帧产出像素数组，任何时候只有一帧处于解码状态
+
+    未压缩像素按帧偏移直接从 PixelData 中取出；封装像素逐个取出帧片段，包装为单帧数据集后解码。
+    """
+    import numpy as np
+    import pydicom
+    from pydicom.encaps import encapsulate, generate_pixel_data_frame
+    from pydicom.pixel_data_handlers.util import pixel_dtype
+    from pydicom.uid import UID
+
+    frames = int(ds.get("NumberOfFrames", 1) or 1)
+    transfer_syntax = UID(ds.file_meta.get("TransferSyntaxUID", EXPLICIT_VR_LITTLE_ENDIAN))
+    if transfer_syntax.is_compressed:
+        for fragment in generate_pixel_data_frame(ds.PixelData, frames):
+            frame_ds = pydicom.Dataset(ds)
+            frame_ds.file_meta = ds.file_meta
+            frame_ds.is_little_endian, frame_ds.is_implicit_VR = ds.is_little_endian, ds.is_implicit_VR
+            frame_ds.NumberOfFrames = 1
+            frame_ds.PixelData = encapsulate([fragment])
+            yield decode_pixel_data(frame_ds)
+        return
+    if ds.BitsAllocated % 8:
+        # 位打包的像素无法按帧偏移读取，只能整体解码
+        yield from decode_pixel_data(ds)
+        return
+    samples = int(ds.get("SamplesPerPixel", 1))
+    dtype = pixel_dtype(ds)
+    count = ds.Rows * ds.Columns * samples
+    pixel_data = ds.PixelData
+    for index in range(frames):
+        frame = np.frombuffer(pixel_data, dtype=dtype, count=count, offset=index * count * dtype.itemsize)
+        if samples == 1:
+            yield frame.reshape(ds.Rows, ds.Columns)
+        elif ds.get("PlanarConfiguration", 0):
+            yield frame.reshape(samples, ds.Rows, ds.Columns).transpose(1, 2, 0)
+        else:
+            yield frame.reshape(ds.Rows, ds.Columns, samples)
+
+
+def frame_durations(ds, frames, step=1):
+    """抽帧后每个输出帧的显示时长（毫秒），由 FrameTimeVector、FrameTime、CineRate 或
+    RecommendedDisplayFrameRate 决定，被跳过的帧的时长累加到保留的帧上"""
+    vector = ds.get("FrameTimeVector")
+    if vector is not None and len(vector) == frames and frames > 1:
+        # FrameTimeVector 记录的是与前一帧的时间间隔，第一项为 0
+        times = [float(value) for value in vector[1:]]
+        times.append(sum(times) / len(times))
+    else:
+        frame_time = ds.get("FrameTime")
+        rate = ds.get("CineRate") or ds.get("RecommendedDisplayFrameRate")
+        if frame_time:
+            frame_time = float(frame_time)
+        elif rate:
+            frame_time = 1000.0 / float(rate)
+        else:
+            frame_time = CINE_DEFAULT_FRAME_TIME
+        times = [frame_time] * frames
+    return [max(1, round(sum(times[index:index + step]))) for index in range(0, frames, step)]
+
+
+def frame_to_image(ds, frame, window=None):
+    """将一帧转换为 8 位 PIL 图像：灰度按显示窗映射，YBR 彩色转换为 RGB"""
+    import numpy as np
+    from PIL import Image
+    from pydicom.pixel_data_handlers.util import convert_color_space
+
+    if frame.ndim == 3:
+        if ds.get("PhotometricInterpretation") in ("YBR_FULL", "YBR_FULL_422"):
+            frame = convert_color_space(frame, ds.PhotometricInterpretation, "RGB")
+        if frame.dtype != np.uint8:
+            frame = (frame >> max(0, int(ds.get("BitsStored", 8)) - 8)).astype(np.uint8)
+        return Image.fromarray(frame, "RGB")
+    out = np.empty(frame.shape, dtype=np.uint8)
+    window_to_uint8(ds, frame, out, window)
+    return Image.fromarray(out)
+
+
+def riff_chunk(fourcc, payload):
+    """RIFF 块：标识 + 小端长度 + 内容，奇数长度补一个字节"""
+    return fourcc + struct.pack("<I", len(payload)) + payload + (b"\0" if len(payload) % 2 else b"")
+
+
+class AnimatedWebPWriter:
+    """逐帧写出动画 WebP，已写出的帧不保留在内存中
+
+    每帧用 Pillow 单独编码为静态 WebP，取出其中的图像数据块封装为 ANMF 块追加写出，
+    RIFF 总长度在关闭时回填（Pillow 的 save_all 会先收集全部帧）。
+    """
+
+    def __init__(self, f, size, quality=CINE_WEBP_QUALITY, loop=0):
+        self.f = f
+        self.size = size
+        self.quality = quality
+        self.start = f.tell()
+        width, height = size
+        f.write(b"RIFF\0\0\0\0WEBP")
+        # VP8X 标志位 0x02 表示动画
+        f.write(riff_chunk(b"VP8X", b"\x02\0\0\0" + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")))
+        f.write(riff_chunk(b"ANIM", struct.pack("<IH", 0, loop)))
+
+    def add(self, image, duration):
+        buffer = io.BytesIO()
+        image.save(buffer, format="WEBP", quality=self.quality)
+        data = buffer.getvalue()
+        chunks = []
+        offset = 12
+        while offset + 8 <= len(data):
+            fourcc, size = data[offset:offset + 4], struct.unpack("<I", data[offset + 4:offset + 8])[0]
+            end = offset + 8 + size + size % 2
+            if fourcc in (b"ALPH", b"VP8 ", b"VP8L"):
+                chunks.append(data[offset:end])
+            offset = end
+        width, height = image.size
+        # 帧位置 (0, 0)、帧尺寸、时长，标志位 0x02 表示不与前一帧混合
+        header = (b"\0" * 6 + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")
+                  + min(duration, 0xFFFFFF).to_bytes(3, "little") + b"\x02")
+        self.f.write(riff_chunk(b"ANMF", header + b"".join(chunks)))
+
+    def close(self):
+        end = self.f.tell()
+        self.f.seek(self.start + 4)
+        self.f.write(struct.pack("<I", end - self.start - 8))
+        self.f.seek(end)
+
+
+class AnimatedGifWriter:
+    """逐帧写出动画 GIF：灰度帧共用全局灰度调色板，彩色帧各自量化并带局部调色板"""
+
+    def __init__(self, f, size, loop=0):
+        self.f = f
+        self.size = size
+        self.loop = loop
+        self.started = False
+
+    def add(self, image, duration):
+        from PIL import GifImagePlugin, Image
+
+        color = image.mode != "L"
+        if color:
+            image = image.quantize(256, method=Image.Quantize.MEDIANCUT)
+        if not self.started:
+            header, _ = GifImagePlugin.getheader(image, info={"loop": self.loop, "duration": duration})
+            self.f.write(b"".join(header))
+            self.started = True
+        self.f.write(b"".join(GifImagePlugin.getdata(image, duration=duration, include_color_table=color)))
+
+    def close(self):
+        self.f.write(b";")
+
+
+def render_cine(data, output_path, image_format="webp", step=1, max_size=None):
+    """将一个多帧文件逐帧解码、抽帧和缩小后流式写出为动画；单帧文件返回 0，否则返回写出的帧数"""
+    import pydicom
+    from PIL import Image
+
+    ds = pydicom.dcmread(io.BytesIO(data))
+    frames = int(ds.get("NumberOfFrames", 1) or 1)
+    if frames <= 1:
+        return 0
+    durations = frame_durations(ds, frames, step)
+    size = (ds.Columns, ds.Rows)
+    if max_size and max(size) > max_size:
+        scale = max_size / max(size)
+        size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    written = 0
+    window = None
+    with AtomicWriter().open(output_path, "wb") as f:
+        animation = AnimatedWebPWriter(f, size) if image_format == "webp" else AnimatedGifWriter(f, size)
+        for index, frame in enumerate(iter_frames(ds)):
+            if index % step:
+                continue
+            if window is None and frame.ndim == 2:
+                window = display_window(ds, frame)  # 整段使用同一显示窗，避免逐帧闪烁
+            image = frame_to_image(ds, frame, window)
+            if image.size != size:
+                image = image.resize(size, Image.BILINEAR)
+            animation.add(image, durations[written])
+            written += 1
+        animation.close()
+    return written
+
+
+def export_cines(all_files, input_root, output_root, image_format="webp", step=1, max_size=None,
+                 workers=WORKER_COUNT, progress=None):
+    """将多帧文件（超声、造影等电影）导出为动画 WebP 或 GIF，单帧文件跳过
+
+    帧按头中的帧时间播放；step 为抽帧间隔，max_size 为缩小后的最长边。返回写出的动画数。
+    """
+    calibrate_pixel_handlers(all_files)
+    total_files = len(all_files)
+    written = 0
+    done = 0
+    in_flight = deque()
+    max_in_flight = max(1, workers) * 2
+
+    def finish(file_path, output_path, future):
+        nonlocal written, done
+        done += 1
+        try:
+            frames = future.result()
+            if frames:
+                written += 1
+                logging.info(f"文件 {file_path} 的 {frames} 帧已保存为 {output_path}")
+        except Exception as e:
+            logging.error(f"处理文件 {file_path} 时出错: {e}")
+        if progress is not None:
+            progress(done, total_files)
+
+    with create_executor(workers) as executor:
+        for file_path, future in prefetch_files(all_files):
+            relative_path = relative_source_path(file_path, input_root)
+            output_path = os.path.join(output_root, os.path.splitext(relative_path)[0] + "." + image_format)
+            try:
+                future = executor.submit(render_cine, future.result(), output_path, image_format, step, max_size)
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            in_flight.append((file_path, output_path, future))
+            while len(in_flight) >= max_in_flight:
+                finish(*in_flight.popleft())
+        while in_flight:
+            finish(*in_flight.popleft())
+    logging.info(f"共写出 {written} 个动画，{total_files - written} 个文件为单帧或处理失败。")
+    return written
+
+
+def convert_dicom_to_png():
+    """将 DICOM 文件转换为 PNG"""
+    if not input_folder or not png_output_folder:
+        messagebox.showwarning("警告", "请先选择输入文件夹和 PNG 输出文件夹！")
+        logging.warning("未选择输入文件夹或 PNG 输出文件夹。")
+        return
+
+    logging.info("DICOM 文件转换为 PNG 开始。")
+    start_time = datetime.now()
+
+    # 获取所有 DICOM 文件
+    all_files = collect_dicom_files(input_folder)
+
+    total_files = len(all_files)
+    logging.info(f"总共找到 {total_files} 个 DICOM 文件。")
+
+    # 创建进度窗口
+    progress_window = tk.Toplevel(root)
+    progress_window.title("处理进度")
+    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
+    progress_label.pack(pady=20)
+
+    export_png(all_files, input_folder, png_output_folder, convert_to_grayscale.get(),
+               lambda current, total: update_progress(current, total, progress_label))
+
+    end_time = datetime.now()
+    logging.info(f"DICOM 文件转换为 PNG 完成。耗时: {end_time - start_time}")
+    progress_window.destroy()
+    messagebox.showinfo("完成", "DICOM 文件转换为 PNG 完成！")
+
+
+@functools.lru_cache(maxsize=None)
+def element_display(tag, vr):
+    """返回 (VR, 行前缀 "(gggg, eeee) 名称 VR: ")，每个 (标签, VR) 只查表和格式化一次"""
+    from pydicom.datadict import dictionary_description, dictionary_has_tag, dictionary_VR, repeater_has_tag
+    from pydicom.tag import Tag
+
+    tag = Tag(tag)
+    if tag.is_private:
+        name = "Private Creator" if 0x0010 <= tag.element <= 0x00FF else "Private tag data"
+        vr = vr or ("LO" if name == "Private Creator" else "UN")
+    elif dictionary_has_tag(tag) or repeater_has_tag(tag):
+        name = dictionary_description(tag)
+        vr = vr or dictionary_VR(tag)
+    else:
+        name = "Group Length" if tag.element == 0 else ""
+        vr = vr or "UN"
+    return vr, f"{tag} {name[:STRUCTURED_INFO_NAME_WIDTH]:<{STRUCTURED_INFO_NAME_WIDTH}} {vr}: "
+
+
+def is_bulk_element(raw, vr):
+    """较大的二进制值和私有值只输出长度，不转换为 Python 值"""
+    if vr in STRUCTURED_INFO_BULK_VRS or (raw.tag >> 16) & 1:
+        return raw.length == 0xFFFFFFFF or raw.length > STRUCTURED_INFO_MAX_BYTES
+    return False
+
+
+def format_value(elem):
+    """元素值的文本表示，与 pydicom 的显示一致，长文本截断"""
+    from pydicom.uid import UID
+
+    value = elem.value
+    if isinstance(value, UID):
+        return value.name
+    if isinstance(value, str) and len(value) > STRUCTURED_INFO_MAX_TEXT:
+        return repr(value[:STRUCTURED_INFO_MAX_TEXT]) + f"...（共 {len(value)} 个字符）"
+    return repr(value)
+
+
+def format_raw_value(raw, vr):
+    """常见 VR 直接从原始字节得到显示文本，跳过 pydicom 的值转换；不适用时返回 None"""
+    return format_raw_bytes(raw.value, vr, raw.is_little_endian)
+
+
+@functools.lru_cache(maxsize=65536)
+def unpack_raw_numbers(value, vr, little_endian):
+    """按标准字节宽度解析数值 VR 的原始字节；不是数值 VR 或长度不是宽度整数倍时返回 None"""
+    number_format = STRUCTURED_INFO_NUMBER_FORMATS.get(vr)
+    if number_format is None:
+        return None
+    byte_order = "<" if little_endian else ">"
+    # 带字节序前缀才是标准宽度（本机格式下 64 位 Linux 的 "L" 为 8 字节）
+    count, remainder = divmod(len(value), struct.calcsize(byte_order + number_format))
+    if remainder:
+        return None  # 长度异常，交给 pydicom 处理
+    return struct.unpack(byte_order + number_format * count, value)
+
+
+def format_raw_bytes(value, vr, little_endian):
+    """按 (原始字节, VR) 缓存显示文本，各实例间重复的值只格式化一次"""
+    from pydicom.uid import UID
+
+    if vr == "UN":
+        return repr(value)  # 隐式 VR 下未知 VR 的私有值按原始字节显示
+    if vr in STRUCTURED_INFO_TEXT_VRS:
+        if not value.isascii():
+            return None  # 非 ASCII 文本需按 SpecificCharacterSet 解码
+        text = value.decode("ascii").rstrip(" \0")
+        if len(text) > STRUCTURED_INFO_MAX_TEXT:
+            return repr(text[:STRUCTURED_INFO_MAX_TEXT]) + f"...（共 {len(text)} 个字符）"
+        if vr in STRUCTURED_INFO_SINGLE_TEXT_VRS or "\\" not in text:
+            return UID(text).name if vr == "UI" else repr(text.strip() if vr != "LT" else text)
+        return repr([item.strip(" \0") for item in text.split("\\")])
+    numbers = unpack_raw_numbers(value, vr, little_endian)
+    if numbers is not None:
+        return repr(numbers[0]) if len(numbers) == 1 else repr(list(numbers))
+    return None
+
+
+def write_structured_text(ds, lines, indent="  "):
+    """将数据集逐行追加到 lines，序列项缩进展开"""
+    from pydicom.dataelem import RawDataElement
+
+    for tag in ds.keys():
+        raw = ds.get_item(tag)
+        vr, prefix = element_display(tag, raw.VR)
+        if isinstance(raw, RawDataElement):
+            if is_bulk_element(raw, vr):
+                length = "未定义长度" if raw.length == 0xFFFFFFFF else f"{raw.length} 字节"
+                lines.append(f"{indent}{prefix}<{length}>\n")
+                continue
+            text = format_raw_value(raw, vr)
+            if text is not None:
+                lines.append(f"{indent}{prefix}{text}\n")
+                continue
+        elem = ds[tag]
+        if elem.VR == "SQ":
+            lines.append(f"{indent}{prefix}<Sequence, length {len(elem.value)}>\n")
+            for number, item in enumerate(elem.value, start=1):
+                lines.append(f"{indent}  Item {number}\n")
+                write_structured_text(item, lines, indent + "    ")
+        else:
+            lines.append(f"{indent}{prefix}{format_value(elem)}\n")
+
+
+def raw_json_values(raw, vr):
+    """常见 VR 直接从原始字节得到 DICOM JSON 的 Value 列表；不适用时返回 None"""
+    value = raw.value
+    if vr in STRUCTURED_INFO_TEXT_VRS:
+        if not value.isascii():
+            return None
+        text = value.decode("ascii").rstrip(" \0")
+        items = [text] if vr in STRUCTURED_INFO_SINGLE_TEXT_VRS else [item.strip(" \0") for item in text.split("\\")]
+        if vr == "PN":
+            return [dict(zip(("Alphabetic", "Ideographic", "Phonetic"), item.split("="))) if item else None
+                    for item in items]
+        if vr in ("DS", "IS"):
+            try:
+                return [None if not item else int(item) if vr == "IS" else float(item) for item in items]
+            except ValueError:
+                return None
+        return items
+    numbers = unpack_raw_numbers(value, vr, raw.is_little_endian)
+    return None if numbers is None else list(numbers)
+
+
+def structured_json(ds, source_name):
+    """DICOM JSON 模型；大值以指向源文件偏移的 BulkDataURI 表示，不转换其内容"""
+    from pydicom.dataelem import RawDataElement
+
+    result = {}
+    for tag in ds.keys():
+        raw = ds.get_item(tag)
+        vr, _ = element_display(tag, raw.VR)
+        key = f"{tag:08X}"
+        if isinstance(raw, RawDataElement):
+            if is_bulk_element(raw, vr):
+                result[key] = {"vr": vr.split(" ")[0],
+                               "BulkDataURI": f"{source_name}#offset={raw.value_tell}&length={raw.length}"}
+                continue
+            if vr == "UN":
+                result[key] = {"vr": "UN", "InlineBinary": base64.b64encode(raw.value).decode("ascii")}
+                continue
+            values = raw_json_values(raw, vr) if raw.length else []
+            if values is not None:
+                result[key] = {"vr": vr, "Value": values} if values else {"vr": vr}
+                continue
+        elem = ds[tag]
+        if elem.VR == "SQ":
+            result[key] = {"vr": "SQ", "Value": [structured_json(item, source_name) for item in elem.value]}
+        else:
+            result[key] = elem.to_json_dict(bulk_data_element_handler=lambda elem: source_name,
+                                            bulk_data_threshold=STRUCTURED_INFO_MAX_BYTES)
+    return result
+
+
+def dump_structured_info(all_files, input_root, output_root, as_json=False, progress=None):
+    """为每个 DICOM 文件单独保存结构化信息（文本或 DICOM JSON），返回成功的文件数"""
+    import pydicom
+
+    writer = AtomicWriter()
+    total_files = len(all_files)
+    written = 0
+    for index, (file_path, future) in enumerate(prefetch_files(all_files), start=1):
+        try:
+            ds = pydicom.dcmread(io.BytesIO(future.result()))
+            # 为每个 DICOM 文件生成一个单独的结构化信息文件
+            relative_path = relative_source_path(file_path, input_root)
+            output_dir = os.path.join(output_root, os.path.dirname(relative_path))
+            source_name = os.path.basename(file_path)
+            output_file_name = output_stem(source_name) + ("_info.json" if as_json else "_info.txt")
+            output_path = os.path.join(output_dir, output_file_name)
+            with writer.open(output_path, "w", encoding="utf-8", buffering=STRUCTURED_INFO_BUFFER) as file:
+                if as_json:
+                    file.write(json.dumps(structured_json(ds, source_name), ensure_ascii=False))
+                else:
+                    lines = [f"文件: {source_name}\n"]
+                    write_structured_text(ds, lines)
+                    file.write("".join(lines))
+            written += 1
+            logging.info(f"文件 {source_name} 的结构化信息已保存到 {output_path}")
+        except Exception as e:
+            logging.error(f"处理文件 {os.path.basename(file_path)} 时出错: {e}")
+        finally:
+            if progress is not None:
+                progress(index, total_files)
+    writer.close()
+    return written
+
+
+def save_structured_info():
+    """为每个 DICOM 文件单独保存结构化信息"""
+    if not input_folder or not structured_info_folder:
+        messagebox.showwarning("警告", "请先选择输入文件夹和结构化信息输出文件夹！")
+        logging.warning("未选择输入文件夹或结构化信息输出文件夹。")
+        return
+
+    logging.info("保存结构化信息开始。")
+    start_time = datetime.now()
+
+    # 获取所有 DICOM 文件
+    all_files = collect_dicom_files(input_folder)
+
+    total_files = len(all_files)
+    logging.info(f"总共找到 {total_files} 个 DICOM 文件。")
+
+    # 创建进度窗口
+    progress_window = tk.Toplevel(root)
+    progress_window.title("处理进度")
+    progress_label = tk.Label(progress_window, text="处理进度: 0% 完成")
+    progress_label.pack(pady=20)
+
+    dump_structured_info(all_files, input_folder, structured_info_folder, structured_info_json.get(),
+                         lambda current, total: update_progress(current, total, progress_label))
+
+    end_time = datetime.now()
+    logging.info(f"保存结构化信息完成。耗时: {end_time - start_time}")
+    progress_window.destroy()
+    messagebox.showinfo("完成", "结构化信息保存完成！")
+
+
+def add_anonymization_arguments(parser, outputs=True):
+    """命令行模式下的匿名化选项（标签规则使用默认配置）；outputs 为 False 时不含输出方式选项"""
+    parser.add_argument("--ts-policy", choices=sorted(set(TRANSFER_SYNTAX_POLICIES.values())), default="preserve",
+                        help="输出传输语法策略")
+    parser.add_argument("--mask-burned-in", action="store_true", help="按配置规则遮盖像素中烧录的标注")
+    parser.add_argument("--date-shift", action="store_true", help="按患者偏移日期（替代置空）")
+    parser.add_argument("--replace-uids", action="store_true",
+                        help="规则置空的 UID 改为由原 UID 确定性生成的新 UID（转发时必须指定）")
+    parser.add_argument("--audit", action="store_true", help="在运行状态库中记录修改审计（标签、动作、旧值哈希、新值）")
+    if outputs:
+        parser.add_argument("--format", choices=[value for value in OUTPUT_FORMATS.values() if value],
+                            help="按检查打包输出（默认输出到目录）")
+        parser.add_argument("--forward", metavar="AE@主机:端口", help="以 C-STORE 转发到远端，替代写出到本地")
+        parser.add_argument("--durable", action="store_true", help="可靠写入：按目录批量 fsync")
+        parser.add_argument("--collect-identifiers", action="store_true",
+                            help=f"按输出目录收集原始标识到 {PHI_IDENTIFIER_DB_FILE}，供 PHI 验证使用")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT, help="工作进程数（0 表示在主进程中处理）")
+    parser.add_argument("--state-db", help=f"运行状态库路径（默认为 {STATE_DB_FILE}，也可用环境变量 {STATE_DB_ENV} 指定），"
+                                           "各分片必须共用同一个")
+    parser.add_argument("--log-dir", help="日志文件夹（默认只输出到控制台）")
+
+
+def cli_options(args):
+    """由命令行参数构造 run_anonymization 等使用的选项"""
+    return {
+        "rules": dict(tags_to_modify),
+        "ts_policy": args.ts_policy,
+        "output_format": "forward" if getattr(args, "forward", None) else getattr(args, "format", None),
+        "mask_rules": app_config.get("pixel_mask_rules", []) if args.mask_burned_in else [],
+        "date_shift": args.date_shift,
+        "audit": args.audit,
+        "replace_uids": args.replace_uids,
+        "collect_identifiers": getattr(args, "collect_identifiers", False),
+        "durable": getattr(args, "durable", False),
+        "workers": args.workers,
+    }
+
+
+def cli_output_root(args, parser):
+    """输出位置：转发时为远端地址，否则为输出文件夹"""
+    if args.forward:
+        # C-STORE 要求实例 UID 非空，在启动时拒绝，而不是逐个文件发送失败
+        if not args.replace_uids and split_uid_rules(rule_tags(list(tags_to_modify.items())))[1]:
+            parser.error("标签规则会置空 UID，转发时需同时指定 --replace-uids")
+        return args.forward
+    if not args.output:
+        parser.error("需要指定 --output 或 --forward")
+    return args.output
+
+
+def add_dry_run_arguments(parser):
+    parser.add_argument("--dry-run", action="store_true", help="只抽样试运行，估算耗时、输出大小和峰值内存，不写出输出")
+    parser.add_argument("--sample-fraction", type=float, default=PLAN_SAMPLE_FRACTION, help="试运行的抽样比例")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="DICOM 工具（不带参数时启动图形界面）")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    anonymize_parser = commands.add_parser("anonymize", help="匿名化输入文件夹或压缩包")
+    anonymize_parser.add_argument("--input", required=True, help="输入文件夹或 ZIP/TAR(.gz) 压缩包")
+    anonymize_parser.add_argument("--output", help="输出文件夹")
+    anonymize_parser.add_argument("--dicomdir", action="store_true", help="为输出目录生成 DICOMDIR")
+    anonymize_parser.add_argument("--dedup", choices=[value for value in DEDUP_MODES.values() if value],
+                                  help="重复实例处理方式")
+    anonymize_parser.add_argument("--skip-existing", action="store_true", help="跳过已存在的输出文件")
+    anonymize_parser.add_argument("--shard", metavar="i/N", help="只处理第 i 个分片（i 从 0 开始，共 N 个）")
+    anonymize_parser.add_argument("--shard-by", choices=SHARD_MODES, default="study",
+                                  help="分片依据：study 按 StudyInstanceUID，path 按顶层目录")
+    anonymize_parser.add_argument("--shard-dir", help="分片清单和目录的保存位置（默认输出目录下的 .shards）")
+    add_dry_run_arguments(anonymize_parser)
+    add_anonymization_arguments(anonymize_parser)
+
+    merge_parser = commands.add_parser("merge", help="合并各分片的清单、目录（生成 DICOMDIR）和日志")
+    merge_parser.add_argument("--output", help="分片运行使用的输出文件夹")
+    merge_parser.add_argument("--forward", metavar="AE@主机:端口", help="分片运行使用的转发目标")
+    merge_parser.add_argument("--shard-dir", help="分片清单和目录的保存位置")
+    merge_parser.add_argument("--log-dir", help="分片日志所在的日志文件夹")
+
+    watch_parser = commands.add_parser("watch", help="监视输入文件夹，按检查增量匿名化新文件")
+    watch_parser.add_argument("--input", required=True, help="监视的输入文件夹")
+    watch_parser.add_argument("--output", help="输出文件夹")
+    watch_parser.add_argument("--quiet-period", type=float, default=WATCH_QUIET_PERIOD,
+                              help="检查最后一个文件到达后等待多少秒再处理")
+    watch_parser.add_argument("--poll-interval", type=float, default=WATCH_POLL_INTERVAL,
+                              help="无 inotify 时的轮询间隔（秒）")
+    add_anonymization_arguments(watch_parser)
+
+    png_parser = commands.add_parser("png", help="将 DICOM 文件转换为 PNG，并输出像素质控统计表")
+    png_parser.add_argument("--input", required=True, help="输入文件夹或 ZIP/TAR(.gz) 压缩包")
+    png_parser.add_argument("--output", required=True, help="PNG 输出文件夹")
+    png_parser.add_argument("--color", action="store_true", help="保留原始颜色（默认转换为灰度）")
+    png_parser.add_argument("--workers", type=int, default=WORKER_COUNT, help="工作进程数")
+    png_parser.add_argument("--timeout", type=float, default=TASK_TIMEOUT,
+                            help="单个文件的处理时限（秒），超时则结束并重启工作进程")
+    png_parser.add_argument("--retries", type=int, default=TASK_RETRIES, help="瞬时 I/O 错误的重试次数")
+    add_dry_run_arguments(png_parser)
+    png_parser.add_argument("--log-dir", help="日志文件夹（默认只输出到控制台）")
+
+    mosaic_parser = commands.add_parser("mosaic", help="为每个序列导出一张拼图 PNG，用于快速目视质控")
+    mosaic_parser.add_argument("--input", required=True, help="输入文件夹或 ZIP/TAR(.gz) 压缩包")
+    mosaic_parser.add_argument("--output", required=True, help="拼图输出文件夹")
+    mosaic_parser.add_argument("--columns", type=int, default=MOSAIC_COLUMNS, help="每行的格位数")
+    mosaic_parser.add_argument("--rows", type=int, help="行数（默认按切片数决定，指定时切片过多则均匀抽取）")
+    mosaic_parser.add_argument("--tile", type=int, default=MOSAIC_TILE_SIZE, help="格位边长（像素）")
+    mosaic_parser.add_argument("--workers", type=int, default=WORKER_COUNT, help="工作进程数")
+    mosaic_parser.add_argument("--log-dir", help="日志文件夹（默认只输出到控制台）")
+
+    cine_parser = commands.add_parser("cine", help="将多帧电影（超声、造影等）导出为动画 WebP/GIF")
+    cine_parser.add_argument("--input", required=True, help="输入文件夹或 ZIP/TAR(.gz) 压缩包")
+    cine_parser.add_argument("--output", required=True, help="动画输出文件夹")
+    cine_parser.add_argument("--format", choices=CINE_FORMATS, default="webp", help="动画格式")
+    cine_parser.add_argument("--step", type=int, default=1, help="每隔多少帧取一帧")
+    cine_parser.add_argument("--max-size", type=int, help="缩小到的最长边（像素）")
+    cine_parser.add_argument("--workers", type=int, default=WORKER_COUNT, help="工作进程数")
+    cine_parser.add_argument("--log-dir", help="日志文件夹（默认只输出到控制台）")
+
+    info_parser = commands.add_parser("info", help="为每个 DICOM 文件保存结构化信息")
+    info_parser.add_argument("--input", required=True, help="输入文件夹或 ZIP/TAR(.gz) 压缩包")
+    info_parser.add_argument("--output", required=True, help="结构化信息输出文件夹")
+    info_parser.add_argument("--json", action="store_true", help="输出 DICOM JSON")
+    info_parser.add_argument("--log-dir", help="日志文件夹（默认只输出到控制台）")
+
+    scp_parser = commands.add_parser("scp", help="作为 C-STORE 接收端运行，收到的实例匿名化后写出")
+    scp_parser.add_argument("--output", help="输出文件夹")
+    scp_parser.add_argument("--port", type=int, default=SCP_DEFAULT_PORT)
+    scp_parser.add_argument("--host", default="", help="监听地址（默认所有地址）")
+    scp_parser.add_argument("--ae-title", default=SCP_DEFAULT_AE_TITLE)
+    scp_parser.add_argument("--max-associations", type=int, default=SCP_MAX_ASSOCIATIONS)
+    add_anonymization_arguments(scp_parser)
+
+    serve_parser = commands.add_parser("serve", help="作为本地 HTTP 匿名化服务运行（POST /anonymize，GET /metrics）")
+    serve_parser.add_argument("--port", type=int, default=SERVICE_DEFAULT_PORT)
+    serve_parser.add_argument("--host", default=SERVICE_DEFAULT_HOST, help="监听地址（默认只监听本机）")
+    serve_parser.add_argument("--max-concurrent", type=int, default=SERVICE_MAX_CONCURRENT, help="同时处理的请求数")
+    add_anonymization_arguments(serve_parser, outputs=False)
+    return parser
+
+
+def run_anonymize(args, parser):
+    options = cli_options(args)
+    options.update({"write_dicomdir": args.dicomdir, "dedup_mode": args.dedup, "skip_existing": args.skip_existing})
+    output_root = cli_output_root(args, parser)
+    all_files = collect_dicom_files(args.input)
+    logging.info(f"总共找到 {len(all_files)} 个 DICOM 文件。")
+    if args.shard:
+        options.update({"shard": args.shard, "shard_dir": args.shard_dir})
+        all_files = select_shard(all_files, args.input, args.shard, args.shard_by)
+    if args.dry_run:
+        plan_run(all_files, args.input, output_root, "anonymize", options, args.sample_fraction)
+        return 0
+    stats = run_anonymization(all_files, args.input, output_root, options)
+    logging.info(f"匿名化完成：写出 {stats['written']} 个，跳过 {stats['skipped']} 个，重复 {stats['duplicates']} 个，"
+                 f"失败 {stats['failed']} 个")
+    return 1 if stats["failed"] else 0
+
+
+def run_merge(args, parser):
+    missing = merge_shards(cli_output_root(args, parser), args.shard_dir, args.log_dir,
+                           "forward" if args.forward else None)
+    return 1 if missing else 0
+
+
+def run_watch(args, parser):
+    try:
+        watch_folder(args.input, cli_output_root(args, parser), cli_options(args), args.quiet_period,
+                     args.poll_interval)
+    except KeyboardInterrupt:
+        logging.info("已停止监视。")
+    return 0
+
+
+def run_png(args, parser):
+    all_files = collect_dicom_files(args.input)
+    if args.dry_run:
+        plan_run(all_files, args.input, args.output, "png", {"grayscale": not args.color}, args.sample_fraction)
+        return 0
+    converted = export_png(all_files, args.input, args.output, not args.color, workers=args.workers,
+                           timeout=args.timeout, retries=args.retries)
+    return 0 if converted == len(all_files) else 1
+
+
+def run_mosaic(args, parser):
+    all_files = collect_dicom_files(args.input)
+    written = export_mosaics(all_files, args.input, args.output, args.columns, args.rows, args.tile, args.workers)
+    return 0 if written or not all_files else 1
+
+
+def run_cine(args, parser):
+    all_files = collect_dicom_files(args.input)
+    export_cines(all_files, args.input, args.output, args.format, max(1, args.step), args.max_size, args.workers)
+    return 0
+
+
+def run_info(args, parser):
+    all_files = collect_dicom_files(args.input)
+    written = dump_structured_info(all_files, args.input, args.output, args.json)
+    return 0 if written == len(all_files) else 1
+
+
+def run_scp(args, parser):
+    server, receiver = start_store_scp(cli_output_root(args, parser), cli_options(args), args.port, args.ae_title,
+                                       args.host, args.max_associations)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("正在停止 C-STORE 接收端...")
+    finally:
+        server.shutdown()
+        receiver.close()
+    return 0
+
+
+def run_serve(args, parser):
+    server, service = start_anonymization_service(cli_options(args), args.host, args.port, args.max_concurrent)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("正在停止 HTTP 匿名化服务...")
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+    return 0
+
+
+def run_cli(argv):
+    """命令行入口，返回进程退出码"""
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, "state_db", None):
+        use_state_db(args.state_db)
+    if getattr(args, "shard", None):
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(f"--shard 格式应为 i/N: {e}")
+    if args.log_dir and getattr(args, "shard", None):
+        # 各分片写各自的日志，由 merge 归并
+        setup_logging(args.log_dir, SHARD_LOG_NAME.format(index=args.shard[0], count=args.shard[1]))
+    elif args.log_dir:
+        setup_logging(args.log_dir)
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.getLogger("pynetdicom").setLevel(logging.WARNING)  # 关联细节过于冗长
+    commands = {"anonymize": run_anonymize, "merge": run_merge, "watch": run_watch, "png": run_png,
+                "mosaic": run_mosaic, "cine": run_cine, "info": run_info, "scp": run_scp,
+                "serve": run_serve}
+    try:
+        return commands[args.command](args, parser)
+    except ImportError as e:
+        logging.error(f"缺少可选依赖: {e.name}，请先安装（如 pip install pynetdicom）")
+        return 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 打包为 exe 后工作进程需要
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+
+    # 创建主窗口
+    root = tk.Tk()
+    root.title("DICOM 工具")
+    convert_to_grayscale = tk.BooleanVar(value=True)  # 默认勾选灰度转换
+    output_format = tk.StringVar(value="目录")  # DICOM 输出格式：目录或按检查打包
+    write_dicomdir = tk.BooleanVar(value=False)  # 是否为输出目录生成 DICOMDIR
+    dedup_option = tk.StringVar(value="不去重")  # 重复实例处理方式
+    transfer_syntax_option = tk.StringVar(value="保持原样")  # 输出传输语法策略
+    mask_burned_in = tk.BooleanVar(value=False)  # 按配置规则遮盖像素中烧录的标注
+    shift_dates_option = tk.BooleanVar(value=False)  # 按患者偏移日期（替代置空）
+    audit_changes = tk.BooleanVar(value=False)  # 在运行状态库中记录修改审计
+    replace_uids_option = tk.BooleanVar(value=False)  # 规则置空的 UID 改为确定性生成的新 UID
+    collect_phi_identifiers = tk.BooleanVar(value=False)  # 按输出目录收集原始标识，供 PHI 验证使用
+    durable_writes = tk.BooleanVar(value=False)  # 可靠写入：按目录批量 fsync
+    skip_existing_outputs = tk.BooleanVar(value=False)  # 跳过已存在的输出文件（断点续跑）
+    structured_info_json = tk.BooleanVar(value=False)  # 结构化信息输出为 DICOM JSON
+
+    # 日志显示区域
+    # log_text = tk.Text(root, height=10, width=60)
+    # log_text.pack(pady=10)
+    # log_text.config(state="disabled")  # 禁止用户编辑
+
+    # 文件夹选择区域
+    folder_frame = ttk.LabelFrame(root, text="文件夹选择")
+    folder_frame.pack(pady=10, padx=10, fill=tk.X)
+
+    input_label = tk.Label(folder_frame, text="输入文件夹: 未选择")
+    input_label.grid(row=0, column=0, padx=5, pady=5, sticky="w")
+    input_button = tk.Button(folder_frame, text="选择", command=select_input_folder)
+    input_button.grid(row=0, column=1, padx=5, pady=5)
+    input_archive_button = tk.Button(folder_frame, text="选择压缩包", command=select_input_archive)
+    input_archive_button.grid(row=0, column=2, padx=5, pady=5)
+
+    dicom_output_label = tk.Label(folder_frame, text="DICOM 输出文件夹: 未选择")
+    dicom_output_label.grid(row=1, column=0, padx=5, pady=5, sticky="w")
+    dicom_output_button = tk.Button(folder_frame, text="选择", command=select_dicom_output_folder)
+    dicom_output_button.grid(row=1, column=1, padx=5, pady=5)
+
+    # png_output_label = tk.Label(folder_frame, text="PNG 输出文件夹: 未选择")
+    # png_output_label.grid(row=2, column=0, padx=5, pady=5, sticky="w")
+    # png_output_button = tk.Button(folder_frame, text="选择", command=select_png_output_folder)
+    # png_output_button.grid(row=2, column=1, padx=5, pady=5)
+
+    structured_info_label = tk.Label(folder_frame, text="结构化信息输出文件夹: 未选择")
+    structured_info_label.grid(row=3, column=0, padx=5, pady=5, sticky="w")
+    structured_info_button = tk.Button(folder_frame, text="选择", command=select_structured_info_folder)
+    structured_info_button.grid(row=3, column=1, padx=5, pady=5)
+
+    log_label = tk.Label(folder_frame, text="日志文件夹: 未选择")
+    log_label.grid(row=4, column=0, padx=5, pady=5, sticky="w")
+    log_button = tk.Button(folder_frame, text="选择", command=select_log_folder)
+    log_button.grid(row=4, column=1, padx=5, pady=5)
+
+    # 配置化修改 DICOM 标签
+    config_frame = ttk.LabelFrame(root, text="DICOM匿名化字段配置")
+    config_frame.pack(pady=10, padx=10, fill=tk.X)
+
+    tk.Label(config_frame, text="标签名称").grid(row=0, column=0, padx=5, pady=5)
+    tag_name_entry = tk.Entry(config_frame)
+    tag_name_entry.grid(row=0, column=1, padx=5, pady=5)
+
+    tk.Label(config_frame, text="新值").grid(row=0, column=2, padx=5, pady=5)
+    new_value_entry = tk.Entry(config_frame)
+    new_value_entry.grid(row=0, column=3, padx=5, pady=5)
+
+    add_button = tk.Button(config_frame, text="添加", command=add_tag_to_modify)
+    add_button.grid(row=0, column=4, padx=5, pady=5)
+
+    remove_button = tk.Button(config_frame, text="移除", command=remove_tag_to_modify)
+    remove_button.grid(row=0, column=5, padx=5, pady=5)
+
+    reset_button = tk.Button(config_frame, text="重置为默认值", command=reset_tags_to_default)
+    reset_button.grid(row=0, column=6, padx=5, pady=5)
+
+    tag_listbox = tk.Listbox(config_frame, height=10, width=50)
+    tag_listbox.grid(row=1, column=0, columnspan=7, padx=5, pady=5)
+
+    # 初始化标签列表显示默认值
+    for tag, value in tags_to_modify.items():
+        tag_listbox.insert(tk.END, f"{tag}: {value}")
+
+    # 配置选项
+    options_frame = ttk.LabelFrame(root, text="其他配置")
+    options_frame.pack(pady=10, padx=10, fill=tk.X)
 
-# 初始化标签列表显示默认值
-for tag, value in tags_to_modify.items():
-    tag_listbox.insert(tk.END, f"{tag}: {value}")
+    # ttk.Checkbutton(options_frame, text="图像灰度转换", variable=convert_to_grayscale).pack(side=tk.LEFT, padx=10)
+    tk.Label(options_frame, text="DICOM 输出格式").pack(side=tk.LEFT, padx=5)
+    ttk.Combobox(options_frame, textvariable=output_format, values=list(OUTPUT_FORMATS),
+                 state="readonly", width=8).pack(side=tk.LEFT, padx=5)
+    ttk.Checkbutton(options_frame, text="生成 DICOMDIR", variable=write_dicomdir).pack(side=tk.LEFT, padx=10)
+    tk.Label(options_frame, text="重复实例").pack(side=tk.LEFT, padx=5)
+    ttk.Combobox(options_frame, textvariable=dedup_option, values=list(DEDUP_MODES),
+                 state="readonly", width=10).pack(side=tk.LEFT, padx=5)
+    tk.Label(options_frame, text="传输语法").pack(side=tk.LEFT, padx=5)
+    ttk.Combobox(options_frame, textvariable=transfer_syntax_option, values=list(TRANSFER_SYNTAX_POLICIES),
+                 state="readonly", width=14).pack(side=tk.LEFT, padx=5)
+    ttk.Checkbutton(options_frame, text="遮盖烧录信息", variable=mask_burned_in).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="按患者偏移日期", variable=shift_dates_option).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="记录修改审计", variable=audit_changes).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="替换 UID", variable=replace_uids_option).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="收集标识供 PHI 验证",
+                    variable=collect_phi_identifiers).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="可靠写入(fsync)", variable=durable_writes).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="跳过已存在输出", variable=skip_existing_outputs).pack(side=tk.LEFT, padx=10)
+    ttk.Checkbutton(options_frame, text="结构化信息 JSON", variable=structured_info_json).pack(side=tk.LEFT, padx=10)
 
-# 配置选项
-options_frame = ttk.LabelFrame(root, text="其他配置")
-options_frame.pack(pady=10, padx=10, fill=tk.X)
+    # 操作按钮
+    button_frame = ttk.Frame(root)
+    button_frame.pack(pady=10, padx=10, fill=tk.X)
 
-# ttk.Checkbutton(options_frame, text="图像灰度转换", variable=convert_to_grayscale).pack(side=tk.LEFT, padx=10)
+    modify_button = tk.Button(button_frame, text="DICOM文件匿名化", command=modify_dicom_tags)
+    modify_button.pack(side=tk.LEFT, padx=10)
 
-# 操作按钮
-button_frame = ttk.Frame(root)
-button_frame.pack(pady=10, padx=10, fill=tk.X)
+    # convert_button = tk.Button(button_frame, text="转换为 PNG", command=convert_dicom_to_png)
+    # convert_button.pack(side=tk.LEFT, padx=10)
 
-modify_button = tk.Button(button_frame, text="DICOM文件匿名化", command=modify_dicom_tags)
-modify_button.pack(side=tk.LEFT, padx=10)
+    info_button = tk.Button(button_frame, text="保存结构化信息", command=save_structured_info)
+    info_button.pack(side=tk.LEFT, padx=10)
 
-# convert_button = tk.Button(button_frame, text="转换为 PNG", command=convert_dicom_to_png)
-# convert_button.pack(side=tk.LEFT, padx=10)
+    verify_button = tk.Button(button_frame, text="PHI 验证", command=verify_phi)
+    verify_button.pack(side=tk.LEFT, padx=10)
 
-info_button = tk.Button(button_frame, text="保存结构化信息", command=save_structured_info)
-info_button.pack(side=tk.LEFT, padx=10)
+    # 窗口显示后再在后台加载重型模块
+    root.after_idle(on_window_shown)
 
-# 启动主循环
-root.mainloop()
\ No newline at end of file
+    # 启动主循环
+    root.mainloop()
\ No newline at end of file